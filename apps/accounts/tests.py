@@ -1,3 +1,53 @@
+from pathlib import Path
 from django.test import TestCase
+from django.urls import reverse
+from groups.benchmarks import ViewBenchmarkMixin, benchmark_sizes, seed_group
 
-# Create your tests here.
+class AccountViewPerformanceTests(ViewBenchmarkMixin, TestCase):
+    """Query count, latency and memory of every accounts view across group sizes"""
+    baseline_file = Path(__file__).with_name('perf_baselines.json')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sized_groups = {size: seed_group(size) for size in benchmark_sizes()}
+
+    def each_host(self):
+        for size, (group, host, guest) in self.sized_groups.items():
+            with self.subTest(size=size):
+                self.client.logout()
+                yield size, host
+
+    def test_signup(self):
+        for size, host in self.each_host():
+            self.benchmark('accounts:signup GET', size, 'get', reverse('accounts:signup'))
+            response = self.benchmark('accounts:signup POST', size, 'post', reverse('accounts:signup'), {
+                'username': 'newelf',
+                'first_name': 'New',
+                'email': 'newelf@example.com',
+                'password1': 'jingle-bells-2025',
+                'password2': 'jingle-bells-2025',
+            })
+            self.assertEqual(response.status_code, 302)
+
+    def test_login(self):
+        for size, host in self.each_host():
+            response = self.benchmark('accounts:login', size, 'get', reverse('accounts:login'))
+            self.assertEqual(response.status_code, 200)
+
+    def test_profile(self):
+        for size, host in self.each_host():
+            self.client.force_login(host)
+            response = self.benchmark('accounts:profile GET', size, 'get', reverse('accounts:profile'))
+            self.assertEqual(response.status_code, 200)
+            response = self.benchmark('accounts:profile POST', size, 'post', reverse('accounts:profile'), {
+                'first_name': 'Santa',
+                'last_name': 'Claus',
+                'email': 'santa@example.com',
+            })
+            self.assertEqual(response.status_code, 302)
+
+    def test_logout(self):
+        for size, host in self.each_host():
+            self.client.force_login(host)
+            response = self.benchmark('accounts:logout', size, 'get', reverse('accounts:logout'))
+            self.assertEqual(response.status_code, 302)
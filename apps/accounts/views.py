@@ -2,8 +2,12 @@ from django.shortcuts import render, redirect
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from groups.listings import user_groups, with_total
 from .forms import SignUpForm, ProfileUpdateForm
 
+# Groups listed on the profile page; the rest are on the my groups page
+RECENT_GROUPS = 5
+
 def signup(request):
     """Register a new user"""
     if request.user.is_authenticated:
@@ -29,9 +33,6 @@ def logout_view(request):
 @login_required
 def profile(request):
     """View and edit user profile"""
-    groups = request.user.memberships.select_related('group').all()
-    hosted = request.user.hosted_groups.all()
-    
     if request.method == 'POST':
         form = ProfileUpdateForm(request.POST, instance=request.user)
         if form.is_valid():
@@ -41,10 +42,12 @@ def profile(request):
     else:
         form = ProfileUpdateForm(instance=request.user)
     
+    # The latest few groups, each carrying the total so it isn't counted separately
+    recent_groups = list(with_total(user_groups(request.user))[:RECENT_GROUPS])
+    
     context = {
         'form': form,
-        'groups': groups,
-        'hosted_groups': hosted,
-        'total_groups': groups.count(),
+        'recent_groups': recent_groups,
+        'total_groups': recent_groups[0].total if recent_groups else 0,
     }
     return render(request, 'accounts/profile.html', context)
\ No newline at end of file
@@ -1,3 +1,38 @@
 from django.contrib import admin
+from .caching import bump_group_version
+from .models import Exclusion, Group, MatchRun, Member
 
-# Register your models here.
+class MemberInline(admin.TabularInline):
+    model = Member
+    fields = ['user', 'team']
+    raw_id_fields = ['user']
+    extra = 0
+
+class ExclusionInline(admin.TabularInline):
+    model = Exclusion
+    raw_id_fields = ['giver', 'receiver']
+    extra = 0
+
+class MatchRunInline(admin.TabularInline):
+    model = MatchRun
+    fields = ['created_at', 'kind', 'algorithm', 'seed', 'splice_seed', 'member_count', 'added', 'changed', 'removed']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
+@admin.register(Group)
+class GroupAdmin(admin.ModelAdmin):
+    list_display = ['name', 'host', 'invite_code', 'member_count', 'matching_done', 'created_at']
+    raw_id_fields = ['host', 'previous_group']
+    readonly_fields = ['member_count', 'wishlist_count', 'matched_count', 'match_seed', 'match_algorithm']
+    inlines = [MemberInline, ExclusionInline, MatchRunInline]
+    
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Members edited inline bypass the counter updates
+        form.instance.reconcile_counts()
+        # And the cached pages still show the group as it was
+        bump_group_version(form.instance.id)
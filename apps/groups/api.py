@@ -0,0 +1,240 @@
+"""REST API for groups, memberships, wishlists and matches.
+
+Mirrors the flows in ``views.py`` for mobile clients. Group-scoped reads
+carry an ETag built from the group's cache version, which every change to
+the group bumps, so a client polling with ``If-None-Match`` gets a 304
+without the response being rebuilt.
+"""
+import hashlib
+from functools import partial
+from django.db import transaction
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
+from rest_framework.pagination import CursorPagination
+from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
+from . import events, wishlists
+from .caching import group_id_for, group_version, is_member
+from .importer import format_for, import_members
+from .membership import add_member, remove_member, set_wishlist
+from .models import Group, Match, Member
+from .serializers import (
+    GroupSerializer, JoinSerializer, MatchingJobSerializer, MatchSerializer, MemberSerializer,
+    WishlistSearchSerializer, WishlistSerializer,
+)
+from .tasks import claim_matching_job, run_matching_job, with_receiver_wishlist
+
+class GroupPagination(CursorPagination):
+    ordering = '-id'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+class MemberPagination(CursorPagination):
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+class NotModified(Exception):
+    def __init__(self, etag):
+        self.etag = etag
+
+class GroupViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin,
+                   mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """Groups the user belongs to, addressed by invite code"""
+    serializer_class = GroupSerializer
+    pagination_class = GroupPagination
+    lookup_field = 'invite_code'
+
+    # Reads answered with 304 when the group hasn't changed
+    etag_actions = {'retrieve', 'members', 'my_match', 'wishlist'}
+
+    def get_queryset(self):
+        groups = Group.objects.select_related('host')
+        if self.action == 'list':
+            groups = groups.filter(id__in=Member.objects.filter(user=self.request.user).values('group_id'))
+        return groups
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        # Everything under /groups/<invite_code>/ is for members only
+        self.group_id = None
+        if self.lookup_field in kwargs:
+            self.group_id = group_id_for(kwargs[self.lookup_field])
+            if self.group_id is None or not is_member(self.group_id, request.user.id):
+                raise Http404("You are not a member of this group")
+
+        self.etag = None
+        if request.method in ('GET', 'HEAD') and self.action in self.etag_actions:
+            self.etag = self.get_etag(request)
+            if self.etag in parse_etags(request.headers.get('If-None-Match', '')):
+                raise NotModified(self.etag)
+
+    def get_etag(self, request):
+        query = hashlib.md5(request.META.get('QUERY_STRING', '').encode()).hexdigest()[:12]
+        return quote_etag(':'.join([
+            str(self.group_id), str(group_version(self.group_id)), str(request.user.id),
+            self.action, request.accepted_renderer.format, query,
+        ]))
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': exc.etag})
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) and response.status_code == status.HTTP_200_OK:
+            response['ETag'] = self.etag
+        return response
+
+    def get_object(self):
+        return self.get_queryset().get(id=self.group_id)
+
+    def get_group(self):
+        """The group without the counts, for actions that don't return it"""
+        return Group.objects.get(id=self.group_id)
+
+    def perform_create(self, serializer):
+        group = serializer.save(host=self.request.user, member_count=1)
+
+        # Auto-join creator as member
+        Member.objects.create(group=group, user=self.request.user)
+
+    def perform_destroy(self, group):
+        if group.host_id != self.request.user.id:
+            raise PermissionDenied("Only the host can delete this group.")
+        if group.matching_done:
+            raise ValidationError("Cannot delete a group after matching. People are expecting gifts!")
+        group.delete()
+
+    @action(detail=False, methods=['post'])
+    def join(self, request):
+        """Join a group by invite code - splices you into the matches if it is already matched"""
+        serializer = JoinSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        group_id = group_id_for(serializer.validated_data['invite_code'])
+        if group_id is None:
+            raise NotFound("Invalid invite code.")
+
+        created = not is_member(group_id, request.user.id)
+        if created:
+            try:
+                # Splicing in needs the current row, not the cached header
+                add_member(Group.objects.get(id=group_id), request.user)
+            except ValueError as e:
+                raise ValidationError(f"You cannot join this group after matching: {e}")
+
+        group = self.get_queryset().get(id=group_id)
+        data = self.get_serializer(group).data
+        return Response(data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+    @action(detail=True, methods=['post'])
+    def leave(self, request, invite_code=None):
+        """Leave a group - your Santa is handed your receiver if it is already matched"""
+        group = self.get_group()
+        if group.host_id == request.user.id:
+            raise PermissionDenied("As the host, you cannot leave. You can delete the group instead.")
+
+        member = get_object_or_404(Member, group=group, user=request.user)
+        try:
+            remove_member(group, member)
+        except ValueError as e:
+            raise ValidationError(f"You cannot leave after matching: {e}")
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=True, methods=['post'])
+    def match(self, request, invite_code=None):
+        """Start matching in the background - host only"""
+        group = self.get_group()
+        if group.host_id != request.user.id:
+            raise PermissionDenied("Only the group host can run the matching.")
+        if group.matching_done:
+            raise ValidationError("Matching has already been done for this group.")
+
+        member_count = group.member_count
+        if member_count < 2:
+            raise ValidationError(f"Need at least 2 participants. Currently have {member_count}.")
+        job = claim_matching_job(group.id, total=member_count)
+        if job is None:
+            raise ValidationError("Matching is already in progress.")
+
+        transaction.on_commit(partial(run_matching_job.delay, job.id))
+        return Response(MatchingJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['get'], url_path='match/status')
+    def match_status(self, request, invite_code=None):
+        """Progress of the latest matching run"""
+        group = self.get_group()
+        job = group.matching_jobs.order_by('-id').first()
+        return Response({
+            'matching_done': group.matching_done,
+            'job': MatchingJobSerializer(job).data if job else None,
+        })
+
+    @action(detail=True, methods=['get'])
+    def members(self, request, invite_code=None):
+        """Participants, oldest first, one cursor page at a time"""
+        members = (
+            Member.objects.filter(group_id=self.group_id)
+            .select_related('user')
+            .annotate(has_wishlist=wishlists.has_wishlist())
+        )
+        paginator = MemberPagination()
+        page = paginator.paginate_queryset(members, request, view=self)
+        serializer = MemberSerializer(page, many=True, context=self.get_serializer_context())
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['get'], url_path='my-match')
+    def my_match(self, request, invite_code=None):
+        """Who you are buying for, with their wishlist"""
+        matches = with_receiver_wishlist(Match.objects.filter(group_id=self.group_id, giver=request.user))
+        if not matches:
+            raise NotFound("Matching hasn't been done yet.")
+        return Response(MatchSerializer(matches[0], context=self.get_serializer_context()).data)
+
+    @action(detail=True, methods=['get', 'put', 'patch'])
+    def wishlist(self, request, invite_code=None):
+        """Read or edit your own wishlist"""
+        member = get_object_or_404(Member.objects.select_related('group'), group_id=self.group_id, user=request.user)
+        if request.method == 'GET':
+            return Response(WishlistSerializer({'items': wishlists.items_of(member)}).data)
+
+        # PUT and PATCH alike replace the whole list
+        serializer = WishlistSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        set_wishlist(member.group, member, serializer.validated_data['items'])
+        return Response(serializer.data)
+
+    @action(detail=True, methods=['get'], url_path='wishlists/search')
+    def wishlist_search(self, request, invite_code=None):
+        """Gift ideas on the group's wishlists matching ``?q=`` - host only"""
+        group = self.get_group()
+        if group.host_id != request.user.id:
+            raise PermissionDenied("Only the group host can search the wishlists.")
+        items = wishlists.search(group, request.query_params.get('q', ''))
+        return Response(WishlistSearchSerializer(items, many=True).data)
+
+    @action(detail=True, methods=['post'], url_path='import', parser_classes=[MultiPartParser])
+    def bulk_import(self, request, invite_code=None):
+        """Bulk-add members from an uploaded CSV or JSONL file - host only"""
+        group = self.get_group()
+        if group.host_id != request.user.id:
+            raise PermissionDenied("Only the group host can import members.")
+        upload = request.FILES.get('file')
+        if upload is None:
+            raise ValidationError({'file': "Upload a CSV or JSONL file."})
+
+        # Uploaded files iterate line by line, so the file is never read whole
+        lines = (line.decode('utf-8-sig') for line in upload)
+        try:
+            report = import_members(group, lines, request.data.get('format') or format_for(upload.name))
+        except ValueError as e:
+            raise ValidationError(str(e))
+        return Response(report.as_dict())
@@ -0,0 +1,9 @@
+from rest_framework.routers import DefaultRouter
+from . import api
+
+app_name = 'api'
+
+router = DefaultRouter()
+router.register('groups', api.GroupViewSet, basename='group')
+
+urlpatterns = router.urls
@@ -0,0 +1,138 @@
+"""Helpers for the view performance regression suites.
+
+Each measured request records its query count, wall time and peak Python
+memory, and is compared with the baselines stored next to the test module.
+
+Environment:
+    PERF_SIZES             comma-separated group sizes (default "10,1000";
+                           add 100000 for the full run)
+    PERF_TOLERANCE         allowed slowdown/memory growth factor (default 3)
+    PERF_UPDATE_BASELINES  set to 1 to rewrite the baselines instead of checking
+"""
+import json
+import os
+import time
+import tracemalloc
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from .matcher import SecretSantaMatcher
+from .models import Group, Member, WishlistItem
+
+User = get_user_model()
+
+# Timings and allocations below these floors are treated as noise
+MIN_MS = 50
+MIN_KB = 512
+
+def benchmark_sizes():
+    return [int(size) for size in os.environ.get('PERF_SIZES', '10,1000').split(',') if size.strip()]
+
+def seed_group(size, matched=True):
+    """Create a group of ``size`` members and return (group, host, guest)"""
+    prefix = f'perf{size}'
+    User.objects.bulk_create(
+        [
+            User(username=f'{prefix}-{i}', first_name=f'Elf {i}', email=f'{prefix}-{i}@example.com', password='!')
+            for i in range(size)
+        ],
+        batch_size=5000,
+    )
+    users = list(User.objects.filter(username__startswith=f'{prefix}-').order_by('id'))
+    host, guest = users[0], users[1]
+
+    group = Group.objects.create(name=f'Benchmark {size}', host=host, budget_limit=25)
+    Member.objects.bulk_create([Member(group=group, user=user) for user in users], batch_size=5000)
+    # Every other member lists three ideas
+    WishlistItem.objects.bulk_create(
+        [
+            WishlistItem(group=group, user=user, position=position, item=item)
+            for user in users[1::2]
+            for position, item in enumerate(['Socks', 'Mug', 'Book'])
+        ],
+        batch_size=5000,
+    )
+    group.reconcile_counts()
+    if matched:
+        SecretSantaMatcher(group).stream_matches()
+    return group, host, guest
+
+class ViewBenchmarkMixin:
+    """TestCase mixin comparing view measurements with stored baselines"""
+    baseline_file = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.update_baselines = os.environ.get('PERF_UPDATE_BASELINES') == '1'
+        cls.tolerance = float(os.environ.get('PERF_TOLERANCE', 3))
+        cls.baselines = {}
+        if cls.baseline_file and cls.baseline_file.exists():
+            cls.baselines = json.loads(cls.baseline_file.read_text())
+        cls.results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.update_baselines and cls.results:
+            baselines = dict(cls.baselines)
+            for name, sizes in cls.results.items():
+                baselines[name] = {**baselines.get(name, {}), **sizes}
+            cls.baseline_file.write_text(json.dumps(baselines, indent=2, sort_keys=True) + '\n')
+        super().tearDownClass()
+
+    def _request(self, method, url, data, setup):
+        # Every run starts cold and leaves no trace behind
+        cache.clear()
+        with transaction.atomic():
+            if setup:
+                setup()
+            if tracemalloc.is_tracing():
+                # Only what the measured request allocates counts, not the setup
+                tracemalloc.reset_peak()
+                self.traced_before, _ = tracemalloc.get_traced_memory()
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = getattr(self.client, method)(url, data)
+                if response.streaming:
+                    # Streamed bodies only hit the database as they are read
+                    response.streamed_bytes = sum(len(chunk) for chunk in response.streaming_content)
+                elapsed = time.perf_counter() - start
+            transaction.set_rollback(True)
+        return response, len(queries), elapsed
+
+    def benchmark(self, name, size, method, url, data=None, setup=None):
+        """Run one request, check it against the baseline and return the response"""
+        response, queries, elapsed = self._request(method, url, data, setup)
+
+        tracemalloc.start()
+        try:
+            self._request(method, url, data, setup)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        result = {'queries': queries, 'ms': round(elapsed * 1000, 1), 'kb': (peak - self.traced_before) // 1024}
+        self.results.setdefault(name, {})[str(size)] = result
+        if not self.update_baselines:
+            self.assertWithinBaseline(name, size, result)
+        return response
+
+    def assertWithinBaseline(self, name, size, result):
+        baseline = self.baselines.get(name, {}).get(str(size))
+        if baseline is None:
+            # New view or size - recorded on the next PERF_UPDATE_BASELINES run
+            return
+        label = f'{name} with {size} members'
+        self.assertLessEqual(
+            result['queries'], baseline['queries'],
+            f"{label} ran {result['queries']} queries (baseline {baseline['queries']})",
+        )
+        self.assertLessEqual(
+            result['ms'], max(baseline['ms'], MIN_MS) * self.tolerance,
+            f"{label} took {result['ms']}ms (baseline {baseline['ms']}ms)",
+        )
+        self.assertLessEqual(
+            result['kb'], max(baseline['kb'], MIN_KB) * self.tolerance,
+            f"{label} peaked at {result['kb']}KB (baseline {baseline['kb']}KB)",
+        )
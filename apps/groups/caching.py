@@ -0,0 +1,226 @@
+"""Cache keys and versioned caching for group pages.
+
+All group data lives under the ``group:<id>:`` namespace. Each group has a
+version number in the cache; cached fragments include the version in their
+key, so bumping it invalidates all of them at once and the stale entries
+simply expire.
+
+Invite codes never change, so the code in a page's URL is mapped to the
+group id once (``invite:<code>``) and every page under the code then reads
+the same cached group header for the current version.
+
+Whatever is cached is read from the primary database, even in read_replica
+views: a lagging replica would otherwise leave old rows cached under the
+new version until the next bump.
+"""
+import re
+import time
+from functools import partial
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_delete
+from .models import Group, Member
+from .wishlists import has_wishlist
+
+# Cached fragments live at most this long even if the group never changes
+FRAGMENT_TIMEOUT = 24 * 3600
+
+# Membership lookups are re-checked against the database at least this often
+MEMBERSHIP_TIMEOUT = 3600
+
+# Invite code to group id mappings are dropped when the group is deleted
+INVITE_CODE_TIMEOUT = 7 * 24 * 3600
+
+# The group page shows this many participants; the rest are loaded from the members API
+PARTICIPANTS_SHOWN = 100
+
+# Anything else in an <invite_code> URL can't be a group's code, and isn't a safe cache key
+_invite_code = re.compile(r'[A-Za-z0-9_-]{1,12}')
+
+def group_key(group_id, *parts):
+    """Cache key in a group's namespace, e.g. ``group:12:participants:3``"""
+    return ':'.join(['group', str(group_id), *(str(part) for part in parts)])
+
+def membership_key(group_id, user_id):
+    return group_key(group_id, 'member', user_id)
+
+def _version_key(group_id):
+    return group_key(group_id, 'version')
+
+def group_version(group_id):
+    version = cache.get(_version_key(group_id))
+    if version is None:
+        # Start from a timestamp so an evicted version never reuses old keys
+        cache.add(_version_key(group_id), int(time.time() * 1000), None)
+        version = cache.get(_version_key(group_id))
+    return version
+
+async def agroup_version(group_id):
+    version = await cache.aget(_version_key(group_id))
+    if version is None:
+        await cache.aadd(_version_key(group_id), int(time.time() * 1000), None)
+        version = await cache.aget(_version_key(group_id))
+    return version
+
+async def agroup_versions(group_ids):
+    """Versions of several groups, read together, as {group_id: version}"""
+    keys = {_version_key(group_id): group_id for group_id in group_ids}
+    found = await cache.aget_many(keys)
+    versions = {keys[key]: version for key, version in found.items()}
+    for group_id in group_ids:
+        if group_id not in versions:
+            versions[group_id] = await agroup_version(group_id)
+    return versions
+
+def bump_group_version(group_id):
+    """Invalidate everything cached for a group"""
+    try:
+        cache.incr(_version_key(group_id))
+    except ValueError:
+        cache.set(_version_key(group_id), int(time.time() * 1000), None)
+
+def _participant_rows(group):
+    return (
+        Member.objects.using(DEFAULT_DB_ALIAS).filter(group=group).order_by('id')
+        .annotate(has_wishlist=has_wishlist())
+        .values('user_id', 'user__username', 'user__first_name', 'user__last_name', 'has_wishlist')
+    )[:PARTICIPANTS_SHOWN]
+
+def _participant(row, group):
+    return {
+        'user_id': row['user_id'],
+        'name': row['user__first_name'] or row['user__username'],
+        'last_name': row['user__last_name'],
+        'initial': (row['user__first_name'] or row['user__username'])[:1].upper(),
+        'is_host': row['user_id'] == group.host_id,
+        'has_wishlist': row['has_wishlist'],
+    }
+
+def participant_list(group):
+    """The first ``PARTICIPANTS_SHOWN`` participants of a group, oldest first, as plain dicts.
+
+    Cached per group version. The order is the members API's, so its cursor picks up where this stops.
+    """
+    key = group_key(group.id, 'participants', group_version(group.id))
+    participants = cache.get(key)
+    if participants is None:
+        participants = [_participant(row, group) for row in _participant_rows(group)]
+        cache.set(key, participants, FRAGMENT_TIMEOUT)
+    return participants
+
+async def aparticipant_list(group, version=None):
+    if version is None:
+        version = await agroup_version(group.id)
+    key = group_key(group.id, 'participants', version)
+    participants = await cache.aget(key)
+    if participants is None:
+        participants = [_participant(row, group) async for row in _participant_rows(group)]
+        await cache.aset(key, participants, FRAGMENT_TIMEOUT)
+    return participants
+
+def is_member(group_id, user_id):
+    """Whether a user belongs to a group, cached until they join or leave"""
+    key = membership_key(group_id, user_id)
+    member = cache.get(key)
+    if member is None:
+        member = Member.objects.using(DEFAULT_DB_ALIAS).filter(group_id=group_id, user_id=user_id).exists()
+        cache.set(key, member, MEMBERSHIP_TIMEOUT)
+    return member
+
+async def ais_member(group_id, user_id):
+    key = membership_key(group_id, user_id)
+    member = await cache.aget(key)
+    if member is None:
+        member = await Member.objects.using(DEFAULT_DB_ALIAS).filter(group_id=group_id, user_id=user_id).aexists()
+        await cache.aset(key, member, MEMBERSHIP_TIMEOUT)
+    return member
+
+def forget_membership(group_id, user_id):
+    """Drop the cached membership flag after a join or leave"""
+    cache.delete(membership_key(group_id, user_id))
+
+def invite_code_key(invite_code):
+    return f'invite:{invite_code}'
+
+def group_id_for(invite_code):
+    """Id of the group with this invite code, or None"""
+    if not _invite_code.fullmatch(invite_code):
+        return None
+    key = invite_code_key(invite_code)
+    group_id = cache.get(key)
+    if group_id is None:
+        # Unknown codes are not cached; the code may be handed out later
+        group_id = Group.objects.using(DEFAULT_DB_ALIAS).filter(invite_code=invite_code).values_list('id', flat=True).first()
+        if group_id is not None:
+            cache.set(key, group_id, INVITE_CODE_TIMEOUT)
+    return group_id
+
+async def agroup_id_for(invite_code):
+    if not _invite_code.fullmatch(invite_code):
+        return None
+    key = invite_code_key(invite_code)
+    group_id = await cache.aget(key)
+    if group_id is None:
+        group_id = await (
+            Group.objects.using(DEFAULT_DB_ALIAS).filter(invite_code=invite_code).values_list('id', flat=True).afirst()
+        )
+        if group_id is not None:
+            await cache.aset(key, group_id, INVITE_CODE_TIMEOUT)
+    return group_id
+
+def _header_rows():
+    # The host comes along for the page header, minus anything secret
+    return Group.objects.using(DEFAULT_DB_ALIAS).select_related('host').defer('host__password')
+
+def group_header(invite_code):
+    """The group with this invite code, with its host loaded, or None.
+
+    Cached per group version and shared by every page under the code. It can
+    be a moment behind a change still being saved, so code that acts on the
+    group's state reloads it first.
+    """
+    if not _invite_code.fullmatch(invite_code):
+        return None
+    group_id = cache.get(invite_code_key(invite_code))
+    if group_id is None:
+        # The header is only cached under a version read before the row, so
+        # a first lookup just remembers the id
+        group = _header_rows().filter(invite_code=invite_code).first()
+        if group is not None:
+            cache.set(invite_code_key(invite_code), group.id, INVITE_CODE_TIMEOUT)
+        return group
+    key = group_key(group_id, 'header', group_version(group_id))
+    group = cache.get(key)
+    if group is None:
+        group = _header_rows().filter(id=group_id).first()
+        if group is not None:
+            cache.set(key, group, FRAGMENT_TIMEOUT)
+    return group
+
+async def agroup_header(invite_code):
+    if not _invite_code.fullmatch(invite_code):
+        return None
+    group_id = await cache.aget(invite_code_key(invite_code))
+    if group_id is None:
+        group = await _header_rows().filter(invite_code=invite_code).afirst()
+        if group is not None:
+            await cache.aset(invite_code_key(invite_code), group.id, INVITE_CODE_TIMEOUT)
+        return group
+    key = group_key(group_id, 'header', await agroup_version(group_id))
+    group = await cache.aget(key)
+    if group is None:
+        group = await _header_rows().filter(id=group_id).afirst()
+        if group is not None:
+            await cache.aset(key, group, FRAGMENT_TIMEOUT)
+    return group
+
+def forget_group(group_id, invite_code):
+    """Drop the invite code mapping and everything cached for a deleted group"""
+    cache.delete(invite_code_key(invite_code))
+    bump_group_version(group_id)
+
+def _group_deleted(sender, instance, using, **kwargs):
+    # After commit, so a page loaded meanwhile can't cache the group again
+    transaction.on_commit(partial(forget_group, instance.id, instance.invite_code), using=using)
+
+post_delete.connect(_group_deleted, sender=Group, dispatch_uid='groups.caching')
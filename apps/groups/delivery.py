@@ -0,0 +1,82 @@
+"""Throttling and idempotency for notification delivery.
+
+State lives in the shared cache so every Celery worker sees the same token
+buckets and delivery claims.
+"""
+import time
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+
+# (messages per second, burst size) when a domain has no explicit limit
+DEFAULT_RATE_LIMIT = (10, 50)
+
+# How long a delivered match is remembered, so a retried task never re-sends it
+SENT_MARKER_TIMEOUT = 7 * 24 * 3600
+
+# How long a worker may hold a match while sending before others may try again
+SENDING_CLAIM_TIMEOUT = 300
+
+def recipient_domain(email):
+    return email.rsplit('@', 1)[-1].lower()
+
+def rate_limit_for(domain):
+    limits = getattr(settings, 'NOTIFICATION_RATE_LIMITS', {})
+    return limits.get(domain) or limits.get('default') or DEFAULT_RATE_LIMIT
+
+@contextmanager
+def _cache_lock(key, timeout=5):
+    """Best-effort mutex built on cache.add (atomic SET NX on Redis)"""
+    lock_key = f'{key}:lock'
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + timeout
+    acquired = cache.add(lock_key, token, timeout)
+    # A crashed holder's lock expires on its own; don't stall delivery past it
+    while not acquired and time.monotonic() <= deadline:
+        time.sleep(0.01)
+        acquired = cache.add(lock_key, token, timeout)
+    try:
+        yield
+    finally:
+        # Only release our own lock, never one taken after ours expired
+        if acquired and cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+class TokenBucket:
+    """Token bucket limiting how fast we send to one recipient domain"""
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.rate, self.capacity = rate_limit_for(domain)
+        self.key = f'delivery:bucket:{domain}'
+
+    def take(self):
+        """Take one token, returning 0 on success or the seconds to wait for one"""
+        with _cache_lock(self.key):
+            now = time.time()
+            tokens, updated = cache.get(self.key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                cache.set(self.key, (tokens - 1, now), timeout=None)
+                return 0
+            cache.set(self.key, (tokens, now), timeout=None)
+            return (1 - tokens) / self.rate
+
+def _delivery_key(match):
+    # A match that is given a new receiver needs a new email
+    return f'delivery:match:{match.id}:{match.receiver_id}'
+
+def already_delivered(match):
+    return cache.get(_delivery_key(match)) == 'sent'
+
+def claim(match):
+    """Claim a match for sending; False if another worker is already on it"""
+    return cache.add(_delivery_key(match), 'sending', SENDING_CLAIM_TIMEOUT)
+
+def mark_delivered(match):
+    cache.set(_delivery_key(match), 'sent', SENT_MARKER_TIMEOUT)
+
+def release(match):
+    """Give up a claim after a failed send so a retry can pick it up"""
+    cache.delete(_delivery_key(match))
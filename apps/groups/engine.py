@@ -0,0 +1,324 @@
+"""Constraint-aware matching engine.
+
+Members are mapped to integer indexes 0..n-1 and matched on a compact
+constraint graph: a team label per member plus a sparse set of forbidden
+receivers per giver. The default solver builds a random Hamiltonian cycle
+over the members and repairs rule violations with local swaps, which runs in
+near-linear time for realistic rule sets.
+
+Matching algorithms are plain callables ``algorithm(graph, rng) -> receivers``
+registered in ``ALGORITHMS``, so they can be benchmarked and swapped without
+touching the database code.
+"""
+import random
+from collections import Counter
+
+# Groups up to this size fall back to an exact bipartite matching when the
+# randomized cycle construction cannot satisfy the rules.
+EXACT_SEARCH_LIMIT = 2000
+
+# Random swap partners tried for each rule violation before restarting.
+REPAIR_ATTEMPTS = 64
+
+RESTARTS = 5
+
+NO_TEAM = -1
+
+# Bump whenever a change makes any algorithm give a different assignment for
+# the same seed and rules; stored seeds from older versions can't be replayed.
+ENGINE_VERSION = 1
+
+
+class MatchingError(ValueError):
+    """Raised when no assignment could be made"""
+
+
+class MatchingImpossible(MatchingError):
+    """Raised when the exclusion rules leave no valid assignment"""
+
+
+class SearchExhausted(MatchingError):
+    """Raised when a randomized search gives up; a valid assignment may still exist"""
+
+
+class ConstraintGraph:
+    """Integer-indexed matching rules for a group of ``size`` members"""
+
+    def __init__(self, size, teams=None):
+        self.size = size
+        self.teams = list(teams) if teams is not None else [NO_TEAM] * size
+        self.forbidden = {}
+
+    def forbid(self, giver, receiver):
+        """Forbid ``giver`` from being assigned to ``receiver``"""
+        if giver != receiver:
+            self.forbidden.setdefault(giver, set()).add(receiver)
+
+    def allows(self, giver, receiver):
+        if giver == receiver:
+            return False
+        team = self.teams[giver]
+        if team != NO_TEAM and team == self.teams[receiver]:
+            return False
+        blocked = self.forbidden.get(giver)
+        return blocked is None or receiver not in blocked
+
+    def check_feasible(self):
+        """Cheap necessary conditions, raising with a readable reason"""
+        n = self.size
+        if n < 2:
+            raise MatchingImpossible("Need at least 2 members to create matches")
+
+        team_sizes = Counter(t for t in self.teams if t != NO_TEAM)
+        if team_sizes:
+            team, largest = team_sizes.most_common(1)[0]
+            if largest > n - largest:
+                raise MatchingImpossible(
+                    f"Team rules cannot be satisfied: {largest} of {n} members share "
+                    f"one team, but each needs a receiver from another team"
+                )
+
+        incoming = [0] * n
+        for giver, blocked in self.forbidden.items():
+            team = self.teams[giver]
+            extra = sum(
+                1 for r in blocked
+                if team == NO_TEAM or self.teams[r] != team
+            )
+            own_team = team_sizes[team] if team != NO_TEAM else 1
+            if n - own_team - extra <= 0:
+                raise MatchingImpossible(
+                    f"Member #{giver + 1} is excluded from every possible receiver"
+                )
+            for r in blocked:
+                incoming[r] += 1
+        for receiver, count in enumerate(incoming):
+            team = self.teams[receiver]
+            own_team = team_sizes[team] if team != NO_TEAM else 1
+            if count and count >= n - own_team:
+                # Counted loosely (team overlaps are double counted), so only
+                # give up after an exact check.
+                if not any(self.allows(g, receiver) for g in range(n)):
+                    raise MatchingImpossible(
+                        f"Member #{receiver + 1} is excluded from every possible giver"
+                    )
+
+
+def solve(graph, rng=None):
+    """Return ``receivers`` where ``receivers[giver]`` is the assigned index.
+
+    Raises ``MatchingImpossible`` when the rules cannot be satisfied, and
+    ``SearchExhausted`` when a group too large for the exact search defeats
+    every repair - another seed may still succeed.
+    """
+    rng = rng or random.Random()
+    graph.check_feasible()
+    n = graph.size
+
+    for _ in range(RESTARTS):
+        order = list(range(n))
+        rng.shuffle(order)
+        if _repair_cycle(graph, order, rng):
+            return _cycle_to_receivers(order)
+
+    # Large teams make a random start a poor fit; spread them out first.
+    order = _interleave_teams(graph, rng)
+    if _repair_cycle(graph, order, rng):
+        return _cycle_to_receivers(order)
+
+    if n <= EXACT_SEARCH_LIMIT:
+        return _exact_assignment(graph, rng)
+
+    raise SearchExhausted(
+        "Could not find an assignment that satisfies the exclusion rules. "
+        "Try again, or remove some rules."
+    )
+
+
+def _cycle_to_receivers(order):
+    n = len(order)
+    receivers = [0] * n
+    for i, giver in enumerate(order):
+        receivers[giver] = order[(i + 1) % n]
+    return receivers
+
+
+def _edges_ok(graph, order, positions):
+    """Check the cycle edges entering and leaving each of ``positions``"""
+    n = len(order)
+    for p in positions:
+        if not graph.allows(order[p - 1], order[p]):
+            return False
+        if not graph.allows(order[p], order[(p + 1) % n]):
+            return False
+    return True
+
+
+def _repair_cycle(graph, order, rng):
+    """Swap members until every edge of the cycle ``order`` is allowed.
+
+    A swap is only kept when all edges it touches are allowed, so each
+    accepted swap strictly reduces the number of violations.
+    """
+    n = len(order)
+    allows = graph.allows
+    for i in range(n):
+        if allows(order[i], order[(i + 1) % n]):
+            continue
+        p = (i + 1) % n
+        for _ in range(REPAIR_ATTEMPTS):
+            q = rng.randrange(n)
+            if q == p:
+                continue
+            order[p], order[q] = order[q], order[p]
+            if _edges_ok(graph, order, (p, q)):
+                break
+            order[p], order[q] = order[q], order[p]
+        else:
+            return False
+    return True
+
+
+def _interleave_teams(graph, rng):
+    """Order members so that no two neighbours share a team"""
+    buckets = {}
+    for index, team in enumerate(graph.teams):
+        key = team if team != NO_TEAM else ('solo', index)
+        buckets.setdefault(key, []).append(index)
+    groups = list(buckets.values())
+    for members in groups:
+        rng.shuffle(members)
+    rng.shuffle(groups)
+    groups.sort(key=len, reverse=True)
+
+    n = graph.size
+    order = [0] * n
+    slots = list(range(0, n, 2)) + list(range(1, n, 2))
+    flat = [index for members in groups for index in members]
+    for slot, index in zip(slots, flat):
+        order[slot] = index
+    return order
+
+
+def _exact_assignment(graph, rng):
+    """Bipartite perfect matching (Kuhn's algorithm) for small hard cases.
+
+    The result may consist of several gift loops rather than one cycle.
+    """
+    n = graph.size
+    receivers_of = []
+    for giver in range(n):
+        allowed = [r for r in range(n) if graph.allows(giver, r)]
+        rng.shuffle(allowed)
+        receivers_of.append(allowed)
+
+    giver_of = [None] * n
+    receiver_for = [None] * n
+    for root in range(n):
+        # Iterative DFS for an augmenting path from ``root``.
+        visited = [False] * n
+        parent = {}
+        stack = [(root, iter(receivers_of[root]))]
+        found = None
+        while stack and found is None:
+            giver, candidates = stack[-1]
+            for r in candidates:
+                if visited[r]:
+                    continue
+                visited[r] = True
+                parent[r] = giver
+                if giver_of[r] is None:
+                    found = r
+                else:
+                    stack.append((giver_of[r], iter(receivers_of[giver_of[r]])))
+                break
+            else:
+                stack.pop()
+        if found is None:
+            raise MatchingImpossible(
+                f"The exclusion rules make a match impossible: member #{root + 1} "
+                f"cannot be given a receiver without breaking another pairing"
+            )
+        r = found
+        while r is not None:
+            giver = parent[r]
+            previous = receiver_for[giver]
+            giver_of[r] = giver
+            receiver_for[giver] = r
+            r = previous
+    return receiver_for
+
+
+def shuffle_swap(graph, rng=None):
+    """The original algorithm: shuffle, then swap self-matches with the next slot.
+
+    Kept for comparison only - it ignores exclusion rules, and a later swap can
+    bring back a self-match.
+    """
+    rng = rng or random.Random()
+    _require_members(graph)
+    receivers = list(range(graph.size))
+    rng.shuffle(receivers)
+    for i in range(graph.size):
+        if receivers[i] == i:
+            j = (i + 1) % graph.size
+            receivers[i], receivers[j] = receivers[j], receivers[i]
+    return receivers
+
+
+def sattolo(graph, rng=None):
+    """Sattolo's algorithm: a uniformly random single cycle, ignoring exclusion rules"""
+    rng = rng or random.Random()
+    _require_members(graph)
+    receivers = list(range(graph.size))
+    for i in range(graph.size - 1, 0, -1):
+        j = rng.randrange(i)
+        receivers[i], receivers[j] = receivers[j], receivers[i]
+    return receivers
+
+
+def rejection(graph, rng=None, max_attempts=1000):
+    """Reshuffle until every rule holds - uniform over all valid assignments"""
+    rng = rng or random.Random()
+    graph.check_feasible()
+    receivers = list(range(graph.size))
+    for _ in range(max_attempts):
+        rng.shuffle(receivers)
+        if is_valid_assignment(graph, receivers):
+            return receivers
+    raise SearchExhausted(f"No valid assignment found in {max_attempts} shuffles")
+
+
+def bipartite(graph, rng=None):
+    """Exact bipartite matching - quadratic, so only suitable for small groups"""
+    rng = rng or random.Random()
+    graph.check_feasible()
+    return _exact_assignment(graph, rng)
+
+
+def _require_members(graph):
+    if graph.size < 2:
+        raise MatchingImpossible("Need at least 2 members to create matches")
+
+
+def is_valid_assignment(graph, receivers):
+    """Whether ``receivers`` is a permutation that respects every rule"""
+    if len(receivers) != graph.size or len(set(receivers)) != graph.size:
+        return False
+    allows = graph.allows
+    return all(allows(giver, receiver) for giver, receiver in enumerate(receivers))
+
+
+DEFAULT_ALGORITHM = 'cycle'
+
+# 'cycle' always makes one gift loop and is uniform without rules, but its
+# repairs favour some pairings once rules apply: ``benchmark_matcher
+# --exclusions 1 --seed 1`` puts it at z = 42 (bipartite 30). Only 'rejection'
+# is uniform over valid assignments, and it gives up when few shuffles are valid.
+ALGORITHMS = {
+    'cycle': solve,
+    'bipartite': bipartite,
+    'rejection': rejection,
+    'sattolo': sattolo,
+    'shuffle-swap': shuffle_swap,
+}
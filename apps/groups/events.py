@@ -0,0 +1,115 @@
+"""Live group events over Redis pub/sub, streamed to the group page as SSE.
+
+Changes to a group are published on its channel once the transaction that
+made them commits; the ``group_events`` view subscribes to that channel and
+forwards each message as a Server-Sent Event. Events are only delivered to
+pages that are connected at the time - a page that reconnects gets a fresh
+snapshot of the counts instead of a replay.
+
+Without ``EVENTS_REDIS_URL`` (or ``REDIS_URL``) publishing is a no-op and
+the page falls back to polling.
+"""
+import asyncio
+import json
+import logging
+from functools import partial
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Events a group page understands
+MEMBER_JOINED = 'member_joined'
+MEMBER_LEFT = 'member_left'
+MEMBERS_IMPORTED = 'members_imported'
+WISHLIST_UPDATED = 'wishlist_updated'
+MATCHING_PROGRESS = 'matching_progress'
+MATCHING_DONE = 'matching_done'
+MATCHING_FAILED = 'matching_failed'
+
+# A comment is sent this often so proxies don't close an idle stream
+HEARTBEAT_SECONDS = 15
+
+# Streams are closed after this long; the browser reconnects on its own
+STREAM_SECONDS = 300
+
+# How long the browser waits before reconnecting, in milliseconds
+RETRY_MS = 3000
+
+_client = None
+
+def enabled():
+    return bool(settings.EVENTS_REDIS_URL)
+
+def channel(group_id):
+    return f'{settings.EVENTS_CHANNEL_PREFIX}:group:{group_id}:events'
+
+def _redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.EVENTS_REDIS_URL)
+    return _client
+
+def publish_now(group_id, event, **data):
+    """Publish straight away, for state that isn't in the database (e.g. progress)"""
+    if not enabled():
+        return
+    try:
+        _redis().publish(channel(group_id), json.dumps({'event': event, 'data': data}))
+    except redis.RedisError as e:
+        # Live updates are best effort; the page still shows the truth on reload
+        logger.warning('Could not publish %s for group %s: %s', event, group_id, e)
+
+def publish(group_id, event, **data):
+    """Publish once the current transaction commits, so listeners never see rolled-back changes"""
+    if enabled():
+        transaction.on_commit(partial(publish_now, group_id, event, **data))
+
+def participant(user, group, has_wishlist=False):
+    """A participant as the group page renders them (see ``caching.participant_list``)"""
+    name = user.first_name or user.username
+    return {
+        'user_id': user.id,
+        'name': name,
+        'last_name': user.last_name,
+        'initial': name[:1].upper(),
+        'is_host': user.id == group.host_id,
+        'has_wishlist': has_wishlist,
+    }
+
+def counts(group):
+    return {'member_count': group.member_count, 'wishlist_count': group.wishlist_count}
+
+def encode(event, data):
+    """One Server-Sent Event"""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+async def stream(group_id, snapshot):
+    """Yield SSE text for a group's events for up to STREAM_SECONDS.
+
+    ``snapshot`` is an async callable returning the group's current state,
+    sent first so a page that missed events while disconnected can catch up.
+    """
+    client = redis.asyncio.Redis.from_url(settings.EVENTS_REDIS_URL)
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(channel(group_id))
+        # Read after subscribing, so no change falls between the snapshot and the events
+        yield f'retry: {RETRY_MS}\n\n'
+        yield encode('snapshot', await snapshot())
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STREAM_SECONDS
+        while (remaining := deadline - loop.time()) > 0:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(HEARTBEAT_SECONDS, remaining))
+            if message is None:
+                yield ': heartbeat\n\n'
+                continue
+            payload = json.loads(message['data'])
+            yield encode(payload['event'], payload['data'])
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+        await client.aclose()
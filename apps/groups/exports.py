@@ -0,0 +1,87 @@
+"""Streamed match manifests for hosts.
+
+Rows are read from the database in chunks and written to the response as
+they are produced, so exporting a group of any size uses constant memory.
+"""
+import csv
+import json
+from itertools import islice
+from django.db.models import OuterRef, Subquery
+from . import wishlists
+from .models import Match, Member, WishlistItem
+
+# Rows fetched per database round trip while streaming
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_FIELDS = [
+    'giver_username', 'giver_name', 'giver_email',
+    'receiver_username', 'receiver_name', 'receiver_team', 'receiver_wishlist',
+    'notification_sent', 'matched_at',
+]
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+def match_rows(group):
+    """Yield one dict per match, joined with giver, receiver and the receiver's membership and wishlist"""
+    receiver_member = Member.objects.filter(group=OuterRef('group'), user=OuterRef('receiver'))
+    rows = (
+        Match.objects.filter(group=group)
+        .order_by('id')
+        .annotate(receiver_team=Subquery(receiver_member.values('team')[:1]))
+        .values_list(
+            'giver__username', 'giver__first_name', 'giver__last_name', 'giver__email',
+            'receiver_id', 'receiver__username', 'receiver__first_name', 'receiver__last_name',
+            'receiver_team', 'notification_sent', 'created_at',
+        )
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    while chunk := list(islice(rows, EXPORT_CHUNK_SIZE)):
+        # The chunk's wishlists in one query
+        wishlist_text = _wishlists(group, [row[4] for row in chunk])
+        for (giver, giver_first, giver_last, giver_email, receiver_id, receiver, receiver_first, receiver_last,
+             team, sent, created_at) in chunk:
+            yield {
+                'giver_username': giver,
+                'giver_name': f'{giver_first} {giver_last}'.strip(),
+                'giver_email': giver_email,
+                'receiver_username': receiver,
+                'receiver_name': f'{receiver_first} {receiver_last}'.strip(),
+                'receiver_team': team or '',
+                'receiver_wishlist': wishlist_text.get(receiver_id, ''),
+                'notification_sent': sent,
+                'matched_at': created_at.isoformat(),
+            }
+
+def _wishlists(group, user_ids):
+    """Wishlists of the given members of ``group`` as text, by user id"""
+    lines = {}
+    rows = WishlistItem.objects.filter(group=group, user_id__in=user_ids).values_list(
+        'user_id', 'item', 'price_hint', 'link',
+    )
+    for user_id, *item in rows:
+        lines.setdefault(user_id, []).append(wishlists.line(*item))
+    return {user_id: '\n'.join(user_lines) for user_id, user_lines in lines.items()}
+
+class _Echo:
+    """File-like object whose write() hands the line straight back, for csv.writer"""
+
+    def write(self, value):
+        return value
+
+def stream_csv(rows):
+    writer = csv.DictWriter(_Echo(), fieldnames=EXPORT_FIELDS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+def stream_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+def stream_export(group, fmt):
+    """Text chunks of the group's manifest in ``fmt`` ('csv' or 'jsonl')"""
+    rows = match_rows(group)
+    return stream_csv(rows) if fmt == 'csv' else stream_jsonl(rows)
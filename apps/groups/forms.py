@@ -1,5 +1,6 @@
 from django import forms
-from .models import Group, Member
+from . import wishlists
+from .models import Group
 
 class GroupCreateForm(forms.ModelForm):
     class Meta:
@@ -21,17 +22,18 @@ class JoinGroupForm(forms.Form):
         })
     )
 
-class WishlistForm(forms.ModelForm):
-    class Meta:
-        model = Member
-        fields = ['wishlist']
-        widgets = {
-            'wishlist': forms.Textarea(attrs={
-                'class': 'form-control',
-                'rows': 5,
-                'placeholder': '1. Cozy blanket\n2. Coffee mug set\n3. Gift card to favorite store'
-            })
-        }
-        labels = {
-            'wishlist': 'Your Gift Wishlist (3 ideas)'
-        }
\ No newline at end of file
+class WishlistForm(forms.Form):
+    """Gift ideas as text, one per line; cleaned into WishlistItem field dicts"""
+    wishlist = forms.CharField(
+        required=False,
+        label='Your Gift Wishlist (3 ideas)',
+        help_text='One idea per line, optionally followed by | a price hint | a link',
+        widget=forms.Textarea(attrs={
+            'class': 'form-control',
+            'rows': 5,
+            'placeholder': '1. Cozy blanket | about $40\n2. Coffee mug set\n3. Gift card to favorite store'
+        })
+    )
+    
+    def clean_wishlist(self):
+        return wishlists.validate(wishlists.parse(self.cleaned_data['wishlist']))
\ No newline at end of file
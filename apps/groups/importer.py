@@ -0,0 +1,255 @@
+"""Bulk member import for onboarding whole organisations.
+
+Rows are read one at a time from a CSV or JSONL stream and written in
+batches, so memory stays flat however large the file is. Each row names a
+user and may carry their email, names, wishlist, team and the usernames
+they must not be matched with:
+
+    username,email,first_name,last_name,wishlist,team,exclude
+    alice,alice@example.com,Alice,,Socks,Sales,bob;carol
+
+Users are created by username and memberships upserted by (group, user)
+with ``bulk_create(update_conflicts=True)``. Only the columns present in the
+file are updated; a wishlist cell replaces the member's whole wishlist and
+is written like the wishlist form, one idea per line. Invalid rows are
+skipped and reported by line number.
+
+Hosts may only create new accounts: a row naming an existing account that
+is not yet in the group is skipped (they join with the invite code), and
+the email and names of existing accounts are never changed. The admin-only
+``import_members`` command passes ``update_users=True`` to enroll existing
+accounts and update their details from the file.
+"""
+import csv
+import json
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from . import events, wishlists
+from .caching import bump_group_version, membership_key
+from .models import Exclusion, Member, WishlistItem
+
+User = get_user_model()
+
+IMPORT_BATCH_SIZE = 2000
+
+# Only the first errors are kept in the report; the rest are just counted
+MAX_REPORTED_ERRORS = 1000
+
+USER_FIELDS = ['email', 'first_name', 'last_name']
+MEMBER_FIELDS = ['team']
+FORMATS = ['csv', 'jsonl']
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.users_created = 0
+        self.members_added = 0
+        self.members_updated = 0
+        self.exclusions = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'users_created': self.users_created,
+            'members_added': self.members_added,
+            'members_updated': self.members_updated,
+            'exclusions': self.exclusions,
+            'error_count': self.error_count,
+            'errors': [{'line': line, 'error': message} for line, message in self.errors],
+        }
+
+def format_for(filename, default='csv'):
+    """Guess the format from a file name"""
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return {'csv': 'csv', 'jsonl': 'jsonl', 'ndjson': 'jsonl'}.get(extension, default)
+
+def read_rows(lines, fmt):
+    """Yield (line number, row dict) from an iterable of text lines"""
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            # Blank cells read as ''; missing trailing cells as None
+            yield reader.line_num, {key.strip(): value for key, value in row.items() if key and value is not None}
+    elif fmt == 'jsonl':
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, e
+                continue
+            yield number, row if isinstance(row, dict) else ValueError('Each line must be a JSON object')
+    else:
+        raise ValueError(f"Unknown import format {fmt!r}. Choose from {', '.join(FORMATS)}")
+
+def _clean(row):
+    """Validate one row, returning it with normalised values"""
+    username = str(row.get('username') or '').strip()
+    if not username:
+        raise ValidationError('username is required')
+    User.username_validator(username)
+    if len(username) > 150:
+        raise ValidationError('username is longer than 150 characters')
+
+    cleaned = {'username': username}
+    for field in USER_FIELDS + MEMBER_FIELDS + ['wishlist']:
+        if field in row:
+            cleaned[field] = str(row[field] or '').strip()
+    if 'wishlist' in cleaned:
+        cleaned['wishlist'] = wishlists.validate(wishlists.parse(cleaned['wishlist']))
+    if cleaned.get('email'):
+        validate_email(cleaned['email'])
+    if len(cleaned.get('team', '')) > 100:
+        raise ValidationError('team is longer than 100 characters')
+
+    exclude = row.get('exclude') or []
+    if isinstance(exclude, str):
+        exclude = exclude.replace('|', ';').split(';')
+    cleaned['exclude'] = [str(name).strip() for name in exclude if str(name).strip()]
+    return cleaned
+
+def import_members(group, lines, fmt='csv', batch_size=IMPORT_BATCH_SIZE, update_users=False):
+    """Stream rows from ``lines`` into ``group`` and return an ImportReport"""
+    if group.matching_done:
+        raise ValueError("This group has already been matched; import members before matching")
+
+    report = ImportReport()
+    batch = {}
+    # Exclusions whose receiver hasn't been seen yet: (line, giver id, username)
+    pending = []
+
+    for line, row in read_rows(lines, fmt):
+        report.rows += 1
+        if isinstance(row, Exception):
+            report.error(line, f'Invalid JSON: {row}')
+            continue
+        try:
+            cleaned = _clean(row)
+        except ValidationError as e:
+            report.error(line, '; '.join(e.messages))
+            continue
+        # A username repeated within a batch keeps its last row, as it would across batches
+        batch.pop(cleaned['username'], None)
+        batch[cleaned['username']] = (line, cleaned)
+        if len(batch) >= batch_size:
+            pending = _write_batch(group, batch, pending, report, update_users)
+            batch = {}
+    if batch:
+        pending = _write_batch(group, batch, pending, report, update_users)
+
+    # Receivers that never turned up in the file or the database
+    for start in range(0, len(pending), batch_size):
+        with transaction.atomic():
+            _write_exclusions(group, pending[start:start + batch_size], report, final=True)
+
+    group.reconcile_counts()
+    bump_group_version(group.id)
+    events.publish(group.id, events.MEMBERS_IMPORTED, **events.counts(group))
+    return report
+
+def _write_batch(group, batch, pending, report, update_users):
+    with transaction.atomic():
+        existing = dict(User.objects.filter(username__in=list(batch)).values_list('username', 'id'))
+        if not update_users:
+            # Someone else's account can't be enrolled by a host, only invited
+            joined = set(
+                Member.objects.filter(group=group, user_id__in=existing.values()).values_list('user_id', flat=True)
+            )
+            for username, user_id in existing.items():
+                if user_id not in joined:
+                    line, _ = batch.pop(username)
+                    report.error(line, f'{username} already has an account; invite them with the group code instead')
+        rows = [cleaned for _, cleaned in batch.values()]
+        usernames = list(batch)
+        user_fields = [field for field in USER_FIELDS if any(field in row for row in rows)]
+        users = [
+            User(
+                username=row['username'],
+                # Imported people set a password through the reset flow
+                password=UNUSABLE_PASSWORD_PREFIX,
+                **{field: row.get(field, '') for field in user_fields},
+            )
+            for row in rows
+            if update_users or row['username'] not in existing
+        ]
+        if update_users and user_fields:
+            User.objects.bulk_create(users, update_conflicts=True, unique_fields=['username'], update_fields=user_fields)
+        else:
+            User.objects.bulk_create(users, ignore_conflicts=True)
+        report.users_created += len(usernames) - len(existing.keys() & set(usernames))
+        user_ids = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+
+        already = set(
+            Member.objects.filter(group=group, user_id__in=user_ids.values()).values_list('user_id', flat=True)
+        )
+        member_fields = [field for field in MEMBER_FIELDS if any(field in row for row in rows)]
+        members = [
+            Member(group=group, user_id=user_ids[row['username']], **{field: row.get(field, '') for field in member_fields})
+            for row in rows
+        ]
+        if member_fields:
+            Member.objects.bulk_create(
+                members, update_conflicts=True, unique_fields=['group', 'user'], update_fields=member_fields,
+            )
+        else:
+            Member.objects.bulk_create(members, ignore_conflicts=True)
+        report.members_added += len(members) - len(already)
+        with_wishlist = [row for row in rows if 'wishlist' in row]
+        report.members_updated += len(already) if member_fields or with_wishlist else 0
+        if with_wishlist:
+            _write_wishlists(group, with_wishlist, user_ids)
+
+        pending = pending + [
+            (line, user_ids[cleaned['username']], receiver)
+            for line, cleaned in batch.values()
+            for receiver in cleaned['exclude']
+        ]
+        pending = _write_exclusions(group, pending, report)
+
+    # Anyone who visited the group before being imported has a cached "not a member"
+    cache.delete_many([membership_key(group.id, user_id) for user_id in user_ids.values()])
+    return pending
+
+def _write_wishlists(group, rows, user_ids):
+    """Replace the wishlists of the members in ``rows``"""
+    WishlistItem.objects.filter(group=group, user_id__in=[user_ids[row['username']] for row in rows]).delete()
+    WishlistItem.objects.bulk_create(
+        WishlistItem(group=group, user_id=user_ids[row['username']], position=position, **item)
+        for row in rows
+        for position, item in enumerate(row['wishlist'])
+    )
+
+def _write_exclusions(group, pending, report, final=False):
+    """Save the exclusions whose receiver exists; return the rest, or report them when ``final``"""
+    if not pending:
+        return []
+    # Only members of the group can be excluded
+    receiver_ids = dict(
+        Member.objects.filter(group=group, user__username__in={receiver for _, _, receiver in pending})
+        .values_list('user__username', 'user_id')
+    )
+    rules = []
+    unresolved = []
+    for line, giver_id, receiver in pending:
+        if receiver in receiver_ids:
+            if receiver_ids[receiver] != giver_id:
+                rules.append(Exclusion(group=group, giver_id=giver_id, receiver_id=receiver_ids[receiver]))
+        elif final:
+            report.error(line, f'Unknown user {receiver!r} in exclude')
+        else:
+            unresolved.append((line, giver_id, receiver))
+    Exclusion.objects.bulk_create(rules, ignore_conflicts=True)
+    report.exclusions += len(rules)
+    return unresolved
@@ -0,0 +1,43 @@
+"""The groups a user belongs to, for the my groups and profile pages.
+
+Everything a card shows comes from one annotated query: the stored member
+count, whether the user hosts the group and whether they have been given
+someone to buy for. Pages are cut by group id (keyset paging), so a user
+in hundreds of groups costs the same number of queries as one in a few.
+"""
+from django.db.models import BooleanField, Count, Exists, ExpressionWrapper, OuterRef, Q, Window
+from .models import Group, Match, Member
+
+GROUPS_PAGE_SIZE = 24
+
+def user_groups(user):
+    """Groups ``user`` hosts or belongs to, newest first"""
+    return (
+        Group.objects.filter(Q(host=user) | Q(id__in=Member.objects.filter(user=user).values('group_id')))
+        .select_related('host')
+        .annotate(
+            is_host=ExpressionWrapper(Q(host_id=user.id), output_field=BooleanField()),
+            has_match=Exists(Match.objects.filter(group=OuterRef('pk'), giver=user)),
+        )
+        .order_by('-id')
+    )
+
+def with_total(groups):
+    """Annotate every row with the number of rows, saving a separate count query"""
+    return groups.annotate(total=Window(Count('id')))
+
+async def agroups_page(groups, after=None, size=GROUPS_PAGE_SIZE):
+    """One page of ``groups`` older than the group id ``after``; returns (groups, next cursor or None)"""
+    if after:
+        groups = groups.filter(id__lt=after)
+    page = [group async for group in groups[:size + 1]]
+    if len(page) > size:
+        return page[:size], page[size - 1].id
+    return page, None
+
+def parse_cursor(value):
+    """The ``after`` query parameter as a group id, ignoring anything malformed"""
+    try:
+        return max(int(value), 0) or None
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,116 @@
+import asyncio
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from groups.benchmarks import seed_group
+
+User = get_user_model()
+
+VIEWS = {
+    'detail': lambda group: reverse('groups:detail', args=[group.invite_code]),
+    'my_match': lambda group: reverse('groups:my_match', args=[group.invite_code]),
+    'my_groups': lambda group: reverse('groups:my_groups'),
+}
+
+class Command(BaseCommand):
+    help = (
+        "Compare the group pages served through Django's WSGI handler (a thread per request in flight) "
+        "and its ASGI handler (one event loop) at the same concurrency"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=1000, help='Members in the benchmark group')
+        parser.add_argument('--concurrency', type=int, default=100, help='Requests in flight at once')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per handler')
+        parser.add_argument('--views', default=','.join(VIEWS),
+                            help='Comma-separated pages to request in turn (default: all)')
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in options['views'].split(',') if name.strip()]
+        unknown = [name for name in names if name not in VIEWS]
+        if unknown:
+            raise CommandError(f"Unknown views: {', '.join(unknown)}. Choose from {', '.join(VIEWS)}")
+        if User.objects.filter(username__startswith=f"perf{options['size']}-").exists():
+            raise CommandError(f"Benchmark users perf{options['size']}-* already exist; delete them first")
+
+        # Seeded into the configured database and removed again afterwards
+        group, host, guest = seed_group(options['size'])
+        try:
+            # The test clients send Host: testserver
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                self.compare(group, guest, names, options)
+        finally:
+            User.objects.filter(username__startswith=f"perf{options['size']}-").delete()
+
+    def compare(self, group, guest, names, options):
+        client = Client()
+        client.force_login(guest)
+        cookies = {key: morsel.value for key, morsel in client.cookies.items()}
+        urls = [VIEWS[name](group) for name in names]
+        urls = [urls[i % len(urls)] for i in range(options['requests'])]
+
+        # Warm caches and connections so neither handler pays for the first requests
+        for url in set(urls):
+            self.expect_ok(url, client.get(url))
+
+        self.stdout.write(
+            f"{options['requests']} requests over {', '.join(names)} with {options['concurrency']} in flight, "
+            f"{options['size']} members"
+        )
+        self.stdout.write(f"{'handler':<10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'threads':>10}")
+        self.report('wsgi', *self.run_wsgi(urls, cookies, options['concurrency']))
+        self.report('asgi', *asyncio.run(self.run_asgi(urls, cookies, options['concurrency'])))
+
+    def expect_ok(self, url, response):
+        if response.status_code != 200:
+            raise CommandError(f"{url} answered {response.status_code}")
+
+    def run_wsgi(self, urls, cookies, concurrency):
+        local = threading.local()
+        peak_threads = 0
+
+        def request(url):
+            nonlocal peak_threads
+            if not hasattr(local, 'client'):
+                local.client = Client()
+                local.client.cookies.load(cookies)
+            start = time.perf_counter()
+            self.expect_ok(url, local.client.get(url))
+            peak_threads = max(peak_threads, threading.active_count())
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(request, urls))
+        return latencies, time.perf_counter() - start, peak_threads
+
+    async def run_asgi(self, urls, cookies, concurrency):
+        client = AsyncClient()
+        client.cookies.load(cookies)
+        pending = iter(urls)
+        latencies = []
+        peak_threads = 0
+
+        async def worker():
+            nonlocal peak_threads
+            for url in pending:
+                start = time.perf_counter()
+                self.expect_ok(url, await client.get(url))
+                latencies.append(time.perf_counter() - start)
+                peak_threads = max(peak_threads, threading.active_count())
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return latencies, time.perf_counter() - start, peak_threads
+
+    def report(self, handler, latencies, elapsed, threads):
+        cuts = statistics.quantiles([latency * 1000 for latency in latencies], n=100)
+        self.stdout.write(
+            f"{handler:<10}{len(latencies) / elapsed:>10.0f}{cuts[49]:>10.1f}{cuts[94]:>10.1f}{cuts[98]:>10.1f}{threads:>10}"
+        )
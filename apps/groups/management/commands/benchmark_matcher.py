@@ -0,0 +1,144 @@
+import math
+import random
+import time
+from collections import Counter
+from itertools import permutations
+from django.core.management.base import BaseCommand, CommandError
+from groups.engine import ALGORITHMS, EXACT_SEARCH_LIMIT, ConstraintGraph, MatchingError, is_valid_assignment
+
+# Quadratic algorithms are skipped above this size
+QUADRATIC = {'bipartite': EXACT_SEARCH_LIMIT}
+
+# The uniformity check enumerates every permutation of the test group
+MAX_UNIFORMITY_SIZE = 8
+
+class Command(BaseCommand):
+    help = "Time the matching algorithms and check that their output is valid and uniform"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--algorithms', default=','.join(ALGORITHMS),
+                            help='Comma-separated algorithms to compare (default: all)')
+        parser.add_argument('--sizes', default='10,100,1000,10000,100000,1000000',
+                            help='Comma-separated group sizes to time')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per algorithm and size')
+        parser.add_argument('--teams', type=int, default=0,
+                            help='Split members into this many random teams (0 = no team rules)')
+        parser.add_argument('--exclusions', type=int, default=0,
+                            help='Random exclusion rules per member')
+        parser.add_argument('--uniformity-size', type=int, default=6,
+                            help='Group size used for the uniformity check')
+        parser.add_argument('--uniformity-samples', type=int, default=20000,
+                            help='Assignments drawn for the uniformity check (0 to skip)')
+        parser.add_argument('--seed', type=int, default=None, help='Seed for reproducible runs')
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in options['algorithms'].split(',') if name.strip()]
+        unknown = [name for name in names if name not in ALGORITHMS]
+        if unknown:
+            raise CommandError(f"Unknown algorithms: {', '.join(unknown)}. Choose from {', '.join(ALGORITHMS)}")
+        sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        if not 2 <= options['uniformity_size'] <= MAX_UNIFORMITY_SIZE:
+            raise CommandError(f"--uniformity-size must be between 2 and {MAX_UNIFORMITY_SIZE}")
+        rng = random.Random(options['seed'])
+
+        self.stdout.write(f"{'algorithm':<14}{'size':>10}{'best ms':>12}{'mean ms':>12}{'invalid':>10}")
+        for size in sizes:
+            graph = self.make_graph(size, options['teams'], options['exclusions'], rng)
+            for name in names:
+                self.time_algorithm(name, graph, options['repeat'], rng)
+
+        if options['uniformity_samples']:
+            self.stdout.write('')
+            self.stdout.write(f"Uniformity over {options['uniformity_samples']} assignments of "
+                              f"{options['uniformity_size']} members (|z| > 3 means biased)")
+            self.stdout.write(f"{'algorithm':<14}{'chi2':>10}{'dof':>6}{'z':>8}{'max cell dev':>14}")
+            graph = self.make_graph(options['uniformity_size'], options['teams'], options['exclusions'], rng)
+            for name in names:
+                self.check_uniformity(name, graph, options['uniformity_samples'], rng)
+
+    def make_graph(self, size, teams, exclusions, rng):
+        graph = ConstraintGraph(size, [rng.randrange(teams) for _ in range(size)] if teams else None)
+        for giver in range(size):
+            for _ in range(exclusions):
+                graph.forbid(giver, rng.randrange(size))
+        return graph
+
+    def time_algorithm(self, name, graph, repeat, rng):
+        if graph.size > QUADRATIC.get(name, graph.size):
+            self.stdout.write(f"{name:<14}{graph.size:>10}{'skipped (quadratic)':>34}")
+            return
+
+        timings = []
+        invalid = 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                receivers = ALGORITHMS[name](graph, rng)
+            except MatchingError as e:
+                self.stdout.write(f"{name:<14}{graph.size:>10}  failed: {e}")
+                return
+            timings.append((time.perf_counter() - start) * 1000)
+            if not is_valid_assignment(graph, receivers):
+                invalid += 1
+
+        line = f"{name:<14}{graph.size:>10}{min(timings):>12.1f}{sum(timings) / len(timings):>12.1f}{invalid:>10}"
+        self.stdout.write(self.style.ERROR(line) if invalid else line)
+
+    def check_uniformity(self, name, graph, samples, rng):
+        """Chi-square test on how often each giver draws each receiver.
+
+        Expected frequencies come from enumerating every valid assignment, so
+        an algorithm that is uniform over valid assignments scores |z| < 3
+        and one that favours particular pairings does not.
+        """
+        expected_share = _exact_cell_shares(graph)
+        if not expected_share:
+            self.stdout.write(self.style.ERROR(f"{name:<14}  no valid assignment exists"))
+            return
+
+        counts = Counter()
+        invalid = 0
+        for _ in range(samples):
+            try:
+                receivers = ALGORITHMS[name](graph, rng)
+            except MatchingError as e:
+                self.stdout.write(f"{name:<14}  failed: {e}")
+                return
+            if not is_valid_assignment(graph, receivers):
+                invalid += 1
+                continue
+            counts.update(enumerate(receivers))
+
+        valid = samples - invalid
+        chi2 = 0.0
+        max_deviation = 0.0
+        for cell, share in expected_share.items():
+            expected = valid * share
+            if expected:
+                chi2 += (counts[cell] - expected) ** 2 / expected
+                max_deviation = max(max_deviation, abs(counts[cell] - expected) / expected)
+        dof = max(len(expected_share) - graph.size, 1)
+        z = _wilson_hilferty(chi2, dof)
+
+        line = f"{name:<14}{chi2:>10.1f}{dof:>6}{z:>8.1f}{max_deviation:>13.1%}"
+        if invalid:
+            line += f"  ({invalid} invalid outputs)"
+        self.stdout.write(self.style.ERROR(line) if invalid or abs(z) > 3 else line)
+
+def _exact_cell_shares(graph):
+    """Share of valid assignments in which each giver gets each receiver"""
+    cells = Counter()
+    total = 0
+    for receivers in permutations(range(graph.size)):
+        if is_valid_assignment(graph, receivers):
+            cells.update(enumerate(receivers))
+            total += 1
+    return {cell: count / total for cell, count in cells.items()}
+
+def _wilson_hilferty(chi2, dof):
+    """Approximate z-score of a chi-square statistic (no scipy needed)"""
+    if dof <= 0:
+        return 0.0
+    k = 2 / (9 * dof)
+    return ((chi2 / dof) ** (1 / 3) - (1 - k)) / math.sqrt(k)
@@ -0,0 +1,79 @@
+import copy
+import statistics
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.urls import reverse
+from groups.benchmarks import seed_group
+from groups.caching import group_version
+
+User = get_user_model()
+
+LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
+class Command(BaseCommand):
+    help = (
+        "Time the group page of a large group with templates compiled per request or once per process "
+        "(the cached loader), and with its participant list rendered or served from the fragment cache"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=5000, help='Members in the benchmark group')
+        parser.add_argument('--requests', type=int, default=50, help='Requests per combination')
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=f"perf{options['size']}-").exists():
+            raise CommandError(f"Benchmark users perf{options['size']}-* already exist; delete them first")
+
+        # Seeded into the configured database and removed again afterwards
+        group, host, guest = seed_group(options['size'])
+        try:
+            # The test client sends Host: testserver
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                self.compare(group, guest, options)
+        finally:
+            User.objects.filter(username__startswith=f"perf{options['size']}-").delete()
+
+    def compare(self, group, guest, options):
+        client = Client()
+        client.force_login(guest)
+        url = reverse('groups:detail', args=[group.invite_code])
+
+        self.stdout.write(f"{options['requests']} requests per row, {options['size']} members")
+        self.stdout.write(f"{'loader':<10}{'fragment':<10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+        for loader, loaders in [('plain', LOADERS), ('cached', [('django.template.loaders.cached.Loader', LOADERS)])]:
+            templates = copy.deepcopy(settings.TEMPLATES)
+            templates[0]['APP_DIRS'] = False
+            templates[0]['OPTIONS']['loaders'] = loaders
+            with override_settings(TEMPLATES=templates):
+                for fragment in ['rendered', 'cached']:
+                    self.report(loader, fragment, self.run(client, url, group, fragment == 'cached', options['requests']))
+
+    def run(self, client, url, group, warm, requests):
+        # The participant data stays cached either way; only the rendered fragment is dropped
+        self.expect_ok(url, client.get(url))
+        latencies = []
+        for _ in range(requests):
+            if not warm:
+                cache.delete(make_template_fragment_key('participants', [group.id, group_version(group.id)]))
+            start = time.perf_counter()
+            self.expect_ok(url, client.get(url))
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def expect_ok(self, url, response):
+        if response.status_code != 200:
+            raise CommandError(f"{url} answered {response.status_code}")
+
+    def report(self, loader, fragment, latencies):
+        cuts = statistics.quantiles([latency * 1000 for latency in latencies], n=100)
+        self.stdout.write(
+            f"{loader:<10}{fragment:<10}{cuts[49]:>10.1f}{cuts[94]:>10.1f}{max(latencies) * 1000:>10.1f}"
+        )
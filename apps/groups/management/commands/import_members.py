@@ -0,0 +1,46 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from groups.importer import FORMATS, IMPORT_BATCH_SIZE, format_for, import_members
+from groups.models import Group
+
+class Command(BaseCommand):
+    help = (
+        "Stream a CSV or JSONL file of users, memberships and exclusion rules into a group; "
+        "existing accounts are enrolled and their email and names updated from the file"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('invite_code')
+        parser.add_argument('path', help='File to import (- for stdin)')
+        parser.add_argument('--format', choices=FORMATS, default=None,
+                            help='File format (default: from the file extension, else csv)')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help='Rows written per batch')
+
+    def handle(self, *args, **options):
+        try:
+            group = Group.objects.get(invite_code=options['invite_code'])
+        except Group.DoesNotExist:
+            raise CommandError(f"No group with invite code {options['invite_code']}")
+
+        fmt = options['format'] or format_for(options['path'])
+        try:
+            if options['path'] == '-':
+                report = import_members(group, sys.stdin, fmt, options['batch_size'], update_users=True)
+            else:
+                with open(options['path'], newline='', encoding='utf-8-sig') as lines:
+                    report = import_members(group, lines, fmt, options['batch_size'], update_users=True)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        for line, message in report.errors:
+            self.stderr.write(f"line {line}: {message}")
+        if report.error_count > len(report.errors):
+            self.stderr.write(f"... and {report.error_count - len(report.errors)} more errors")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {report.rows - report.error_count} of {report.rows} rows into {group.name}: "
+            f"{report.members_added} members added, {report.members_updated} updated, "
+            f"{report.users_created} new users, {report.exclusions} exclusion rules"
+        ))
+
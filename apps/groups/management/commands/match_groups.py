@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+from groups.matcher import SecretSantaMatcher
+from groups.models import Group, Match, MatchingJob
+from groups.tasks import dispatch_bulk_matching, match_group, queue_notifications, ready_groups
+
+def _init_worker():
+    # Forked workers must not share the parent's database connections
+    django.setup()
+    connections.close_all()
+
+class Command(BaseCommand):
+    help = "Match every ready, unmatched group in parallel, then send all notifications in one fan-out"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Solve each group without saving anything and report the result')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Local worker processes (ignored with --celery)')
+        parser.add_argument('--celery', action='store_true',
+                            help='Dispatch the run to Celery workers instead of matching locally')
+        parser.add_argument('--chunk-size', type=int, default=50,
+                            help='Groups handed to a worker at a time')
+        parser.add_argument('--limit', type=int, default=None, help='Match at most this many groups')
+        parser.add_argument('--resume', action='store_true',
+                            help='Retry groups whose matching run crashed and notify groups left un-notified')
+        parser.add_argument('--no-notify', action='store_true', help='Skip the notification fan-out')
+
+    def handle(self, *args, **options):
+        if options['resume'] and not options['dry_run']:
+            self.recover_interrupted()
+
+        groups = ready_groups()
+        if options['limit']:
+            groups = groups[:options['limit']]
+        group_ids = list(groups.values_list('id', flat=True))
+
+        if options['dry_run']:
+            self.dry_run(group_ids)
+            return
+
+        if options['celery']:
+            if group_ids:
+                result = dispatch_bulk_matching(group_ids, options['chunk_size'])
+                self.stdout.write(self.style.SUCCESS(
+                    f"Dispatched {len(group_ids)} groups to Celery (chord {result.id})"
+                ))
+            else:
+                self.stdout.write("No groups are waiting for matching.")
+            matched = []
+        else:
+            matched = self.match_locally(group_ids, options['workers'], options['chunk_size'])
+
+        if options['no_notify']:
+            return
+
+        notify_ids = set(matched)
+        if options['resume']:
+            # Groups matched by a run that died before its fan-out
+            notify_ids.update(
+                Group.objects.filter(matching_done=True, matches__notification_sent=False)
+                .values_list('id', flat=True).distinct()
+            )
+        if notify_ids:
+            queued, batches = queue_notifications(Match.objects.filter(group_id__in=notify_ids))
+            self.stdout.write(f"Queued {queued} notifications in {batches} batches for {len(notify_ids)} groups")
+
+    def recover_interrupted(self):
+        candidates = MatchingJob.objects.filter(
+            status__in=[MatchingJob.QUEUED, MatchingJob.RUNNING],
+            group__matching_done=False,
+            updated_at__lt=timezone.now() - MatchingJob.STALE_AFTER,
+        )
+        # Long runs keep reporting progress without saving the job
+        stale = MatchingJob.objects.filter(id__in=[job.id for job in candidates if job.is_stale])
+        count = stale.update(status=MatchingJob.FAILED, error='Interrupted - retried by match_groups --resume')
+        if count:
+            self.stdout.write(f"Recovered {count} interrupted matching runs")
+
+    def match_locally(self, group_ids, workers, chunk_size):
+        if not group_ids:
+            self.stdout.write("No groups are waiting for matching.")
+            return []
+
+        self.stdout.write(f"Matching {len(group_ids)} groups with {workers} worker(s)...")
+        if workers <= 1:
+            results = map(match_group, group_ids)
+            matched = [group_id for group_id, ok in zip(group_ids, results) if ok]
+        else:
+            # Each group is matched in its own transaction inside a worker
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+                results = pool.map(match_group, group_ids, chunksize=chunk_size)
+                matched = [group_id for group_id, ok in zip(group_ids, results) if ok]
+
+        failed = len(group_ids) - len(matched)
+        self.stdout.write(self.style.SUCCESS(f"Matched {len(matched)} groups"))
+        if failed:
+            self.stdout.write(self.style.WARNING(
+                f"{failed} groups failed or were claimed by another run - see their latest matching job"
+            ))
+        return matched
+
+    def dry_run(self, group_ids):
+        ready = 0
+        for group in Group.objects.filter(id__in=group_ids).order_by('id'):
+            try:
+                count = sum(1 for _ in SecretSantaMatcher(group).assign())
+            except ValueError as e:
+                self.stdout.write(self.style.WARNING(f"{group.invite_code} {group.name}: cannot match - {e}"))
+            else:
+                ready += 1
+                self.stdout.write(f"{group.invite_code} {group.name}: would match {count} members")
+        self.stdout.write(self.style.SUCCESS(f"Dry run: {ready} of {len(group_ids)} groups can be matched"))
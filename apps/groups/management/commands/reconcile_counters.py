@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from groups.caching import bump_group_version
+from groups.models import Group, count_expressions
+
+COUNTERS = ['member_count', 'wishlist_count', 'matched_count']
+
+class Command(BaseCommand):
+    help = "Recount each group's member, wishlist and match counters and fix any that have drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument('invite_codes', nargs='*',
+                            help='Only check these groups (default: all)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report drifted groups without fixing them')
+
+    def handle(self, *args, **options):
+        groups = Group.objects.all()
+        if options['invite_codes']:
+            groups = groups.filter(invite_code__in=options['invite_codes'])
+
+        # Recount in the database, one row per group streamed alongside its stored counters
+        actual = {f'actual_{field}': expression for field, expression in count_expressions().items()}
+        groups = groups.annotate(**actual)
+        rows = groups.values_list('id', 'invite_code', *COUNTERS, *actual).order_by('id').iterator()
+
+        fixed = 0
+        for group_id, invite_code, *values in rows:
+            stored, counted = values[:len(COUNTERS)], values[len(COUNTERS):]
+            if stored == counted:
+                continue
+            fixed += 1
+            changes = ', '.join(
+                f'{field} {old} -> {new}' for field, old, new in zip(COUNTERS, stored, counted) if old != new
+            )
+            self.stdout.write(f"{invite_code}: {changes}")
+            if not options['dry_run']:
+                Group.objects.filter(id=group_id).update(**dict(zip(COUNTERS, counted)))
+                bump_group_version(group_id)
+
+        verb = 'would be fixed' if options['dry_run'] else 'fixed'
+        self.stdout.write(self.style.SUCCESS(f"{fixed} drifted group{'s' if fixed != 1 else ''} {verb}"))
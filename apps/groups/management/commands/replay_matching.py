@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from groups.caching import bump_group_version
+from groups.matcher import SecretSantaMatcher
+from groups.models import Group, Match
+from groups.tasks import queue_notifications
+
+class Command(BaseCommand):
+    help = "Regenerate a group's matches from its stored seed, or re-run them and write only the changed pairs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('invite_code')
+        parser.add_argument('--rerun', action='store_true',
+                            help='Re-run the matching and save the differences')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Seed for --rerun (default: the stored seed)')
+
+    def handle(self, *args, **options):
+        try:
+            group = Group.objects.get(invite_code=options['invite_code'])
+        except Group.DoesNotExist:
+            raise CommandError(f"No group with invite code {options['invite_code']}")
+
+        if options['seed'] is not None and not options['rerun']:
+            raise CommandError("--seed only applies to --rerun; a replay always uses the stored seed")
+
+        try:
+            if options['rerun']:
+                SecretSantaMatcher.from_group(group, seed=options['seed']).stream_matches()
+            else:
+                self.verify(group)
+                return
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        bump_group_version(group.id)
+        run = group.match_runs.latest('id')
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-ran {group.name} with seed {run.seed}: {run.changed} changed, "
+            f"{run.added} added, {run.removed} removed of {run.member_count} matches"
+        ))
+        # Givers with a new receiver were marked unsent by the re-run
+        queued, batches = queue_notifications(group.matches.all())
+        self.stdout.write(f"Queued {queued} notifications in {batches} batches")
+
+    def verify(self, group):
+        stored = dict(Match.objects.filter(group=group).values_list('giver_id', 'receiver_id').iterator())
+        regenerated = SecretSantaMatcher.regenerate(group)
+        differing = sum(1 for giver_id, receiver_id in regenerated if stored.pop(giver_id, None) != receiver_id)
+        differing += len(stored)
+        if differing:
+            raise CommandError(
+                f"{differing} stored matches differ from seed {group.match_seed} - "
+                f"members or rules have changed since the last run"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"All matches of {group.name} regenerate from seed {group.match_seed} ({group.match_algorithm})"
+        ))
@@ -1,51 +1,393 @@
 import random
-from django.db import transaction
-from .models import Match, Member
+import secrets
+from itertools import islice
+from django.db import connections, transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+from .engine import ALGORITHMS, DEFAULT_ALGORITHM, ENGINE_VERSION, NO_TEAM, ConstraintGraph, is_valid_assignment
+from .models import Exclusion, Group, Match, MatchRun
+
+# Rows written per round trip when streaming matches to the database
+MATCH_BATCH_SIZE = 5000
 
 class SecretSantaMatcher:
-    def __init__(self, group):
+    """Seeded matcher: the same seed, members and rules always give the same pairs"""
+
+    def __init__(self, group, seed=None, algorithm=DEFAULT_ALGORITHM):
         self.group = group
-    
+        self.seed = seed if seed is not None else secrets.randbits(63)
+        self.algorithm = algorithm
+
+    @classmethod
+    def from_group(cls, group, seed=None):
+        """Matcher reusing the group's stored seed and algorithm"""
+        if group.match_seed is None or not group.match_algorithm:
+            raise ValueError("This group has not been matched with a stored seed")
+        algorithm, _, version = group.match_algorithm.partition('@')
+        if version != str(ENGINE_VERSION):
+            raise ValueError(
+                f"The matches were made by matching engine v{version or '?'}; "
+                f"this is v{ENGINE_VERSION}, which gives different pairs for the same seed"
+            )
+        return cls(group, seed=group.match_seed if seed is None else seed, algorithm=algorithm)
+
+    @property
+    def algorithm_version(self):
+        return f'{self.algorithm}@{ENGINE_VERSION}'
+
+    def build_graph(self):
+        """Load members and exclusion rules into an integer-indexed constraint graph"""
+        rows = list(self.group.members.order_by('id').values_list('user_id', 'team'))
+        user_ids = [user_id for user_id, _ in rows]
+        index = {user_id: i for i, user_id in enumerate(user_ids)}
+
+        team_ids = {}
+        teams = [team_ids.setdefault(team, len(team_ids)) if team else NO_TEAM for _, team in rows]
+        graph = ConstraintGraph(len(user_ids), teams)
+
+        def forbid(giver_id, receiver_id):
+            # Rules may mention people who are no longer in the group
+            if giver_id in index and receiver_id in index:
+                graph.forbid(index[giver_id], index[receiver_id])
+
+        rules = Exclusion.objects.filter(group=self.group).values_list('giver_id', 'receiver_id', 'mutual')
+        for giver_id, receiver_id, mutual in rules:
+            forbid(giver_id, receiver_id)
+            if mutual:
+                forbid(receiver_id, giver_id)
+
+        # Don't repeat last year's pairs
+        if self.group.previous_group_id:
+            pairs = Match.objects.filter(group_id=self.group.previous_group_id).values_list('giver_id', 'receiver_id')
+            for giver_id, receiver_id in pairs:
+                forbid(giver_id, receiver_id)
+
+        return graph, user_ids
+
+    def assign(self):
+        """Solve the group and return an iterator of (giver_id, receiver_id) pairs"""
+        graph, user_ids = self.build_graph()
+
+        # Raises MatchingImpossible when the rules can't be satisfied, SearchExhausted when a solver gives up
+        receivers = ALGORITHMS[self.algorithm](graph, random.Random(self.seed))
+        if not is_valid_assignment(graph, receivers):
+            raise ValueError(f"The {self.algorithm} algorithm produced an invalid assignment")
+
+        return ((user_ids[giver], user_ids[receiver]) for giver, receiver in enumerate(receivers))
+
+    @classmethod
+    def regenerate(cls, group):
+        """Recompute a group's stored assignment from its stored seed and algorithm.
+
+        Only reproduces the saved matches while the members and rules are
+        unchanged since the last run.
+        """
+        return cls.from_group(group).assign()
+
     def create_matches(self):
         """Create Secret Santa matches for a group"""
-        members = list(self.group.members.all())
-        
-        if len(members) < 2:
-            raise ValueError("Need at least 2 members to create matches")
-        
-        # Get list of users
-        users = [m.user for m in members]
-        receivers = users.copy()
-        
-        # Shuffle receivers
-        random.shuffle(receivers)
-        
-        # Ensure no one gets themselves
-        for i, giver in enumerate(users):
-            if giver == receivers[i]:
-                # Swap with next person (wrap around if at end)
-                j = (i + 1) % len(receivers)
-                receivers[i], receivers[j] = receivers[j], receivers[i]
-        
-        # Create matches in database
+        self.stream_matches()
+        return list(Match.objects.filter(group=self.group).order_by('id'))
+
+    def stream_matches(self, batch_size=MATCH_BATCH_SIZE, progress=None):
+        """Create matches without holding Match objects in memory.
+
+        Pairs are written in fixed-size batches (COPY on PostgreSQL), so memory
+        stays flat as the group grows. A re-run only writes the pairs that
+        differ from the stored ones. ``progress`` is called with the number of
+        pairs processed after each batch. Returns the number of matches.
+        """
+        pairs = self.assign()
+
         with transaction.atomic():
-            # Delete old matches if rerunning
-            Match.objects.filter(group=self.group).delete()
-            
-            # Create new matches
-            matches = []
-            for giver, receiver in zip(users, receivers):
-                match = Match(
-                    group=self.group,
-                    giver=giver,
-                    receiver=receiver
+            existing = {
+                giver_id: (match_id, receiver_id)
+                for match_id, giver_id, receiver_id in Match.objects.filter(group=self.group)
+                .values_list('id', 'giver_id', 'receiver_id').iterator()
+            }
+            kind = MatchRun.RERUN if existing else MatchRun.MATCH
+            if existing:
+                count, added, changed, removed = self._apply_diff(pairs, existing, batch_size, progress)
+            else:
+                connection = connections[Match.objects.db]
+                if connection.vendor == 'postgresql':
+                    count = self._copy_pairs(connection, pairs, batch_size, progress)
+                else:
+                    count = self._insert_pairs(pairs, batch_size, progress)
+                added, changed, removed = count, 0, 0
+
+            self._mark_done(count)
+            MatchRun.objects.create(
+                group=self.group,
+                kind=kind,
+                seed=self.seed,
+                algorithm=self.algorithm_version,
+                member_count=count,
+                added=added,
+                changed=changed,
+                removed=removed,
+            )
+
+        return count
+
+    def _apply_diff(self, pairs, existing, batch_size, progress=None):
+        """Write only the pairs that differ from ``existing``.
+
+        ``existing`` maps giver id to (match id, receiver id) and is consumed.
+        Returns (matches, added, changed, removed).
+        """
+        count = added = changed = 0
+        new, updated = [], []
+
+        def flush():
+            Match.objects.bulk_create(new, batch_size=batch_size)
+            Match.objects.bulk_update(updated, ['receiver', 'notification_sent'], batch_size=batch_size)
+            new.clear()
+            updated.clear()
+            if progress:
+                progress(count)
+
+        for giver_id, receiver_id in pairs:
+            count += 1
+            match_id, old_receiver_id = existing.pop(giver_id, (None, None))
+            if match_id is None:
+                new.append(Match(group_id=self.group.id, giver_id=giver_id, receiver_id=receiver_id))
+                added += 1
+            elif old_receiver_id != receiver_id:
+                # A new receiver means the giver has to be told again
+                updated.append(Match(id=match_id, receiver_id=receiver_id, notification_sent=False))
+                changed += 1
+            if len(new) + len(updated) >= batch_size:
+                flush()
+        flush()
+
+        # Whoever is left has left the group
+        removed = [match_id for match_id, _ in existing.values()]
+        for start in range(0, len(removed), batch_size):
+            Match.objects.filter(id__in=removed[start:start + batch_size]).delete()
+
+        return count, added, changed, len(removed)
+
+    def add_member(self, user_id):
+        """Splice a member who joined after matching into the existing cycle.
+
+        A randomly chosen pair A -> B that the rules allow becomes
+        A -> new member -> B, so only two Match rows are written. Falls back
+        to a full re-run (written as a diff) when no pair fits.
+
+        Returns the ids of the matches whose giver must be told again, or None
+        after a full re-run, when every unsent match needs its email.
+        """
+        with transaction.atomic():
+            self._lock_group()
+            notify = self._splice_in(user_id)
+            if notify is None:
+                self.stream_matches()
+                return None
+            self.group.adjust_counts(matched_count=1)
+            self._log_splice(MatchRun.JOIN, added=1, changed=1)
+        return notify
+
+    def remove_member(self, user_id):
+        """Close the cycle around a member who left after matching.
+
+        Their giver X takes over their receiver Y, so one Match row is
+        updated and one deleted. If X and Y were each other's Santa, X is
+        spliced in elsewhere instead. Call after the Member row is deleted.
+        Returns the ids to notify as ``add_member`` does.
+        """
+        with transaction.atomic():
+            self._lock_group()
+            outgoing = Match.objects.filter(group=self.group, giver_id=user_id).first()
+            incoming = Match.objects.filter(group=self.group, receiver_id=user_id).first()
+            if outgoing is None or incoming is None:
+                # Never matched, so nobody else is affected
+                deleted, _ = (
+                    Match.objects.filter(group=self.group).filter(Q(giver_id=user_id) | Q(receiver_id=user_id)).delete()
                 )
-                matches.append(match)
-            
-            Match.objects.bulk_create(matches)
-            
-            # Mark group as matched
-            self.group.matching_done = True
-            self.group.save()
-        
-        return matches
\ No newline at end of file
+                self.group.adjust_counts(matched_count=-deleted)
+                return []
+
+            outgoing.delete()
+            self.group.adjust_counts(matched_count=-1)
+            if incoming.giver_id == outgoing.receiver_id:
+                # A gift loop of two: the partner needs both a giver and a receiver
+                notify = self._splice_in(incoming.giver_id, match=incoming)
+            elif self._allows(incoming.giver_id, outgoing.receiver_id):
+                self._reassign(incoming, outgoing.receiver_id)
+                notify = [incoming.id]
+            else:
+                notify = None
+
+            if notify is None:
+                self.stream_matches()
+                return None
+            self._log_splice(MatchRun.LEAVE, changed=len(notify), removed=1)
+        return notify
+
+    def _lock_group(self):
+        # Serialise splices so two late joiners can't claim the same pair
+        Group.objects.select_for_update().filter(id=self.group.id).values_list('id').first()
+
+    def _blocked(self, user_id):
+        """(users ``user_id`` must not give to, users who must not give to them)"""
+        gives_to, receives_from = set(), set()
+        rules = (
+            Exclusion.objects.filter(group=self.group)
+            .filter(Q(giver_id=user_id) | Q(receiver_id=user_id))
+            .values_list('giver_id', 'receiver_id', 'mutual')
+        )
+        for giver_id, receiver_id, mutual in rules:
+            if giver_id == user_id:
+                gives_to.add(receiver_id)
+                if mutual:
+                    receives_from.add(receiver_id)
+            else:
+                receives_from.add(giver_id)
+                if mutual:
+                    gives_to.add(giver_id)
+
+        if self.group.previous_group_id:
+            pairs = (
+                Match.objects.filter(group_id=self.group.previous_group_id)
+                .filter(Q(giver_id=user_id) | Q(receiver_id=user_id))
+                .values_list('giver_id', 'receiver_id')
+            )
+            for giver_id, receiver_id in pairs:
+                if giver_id == user_id:
+                    gives_to.add(receiver_id)
+                else:
+                    receives_from.add(giver_id)
+
+        return gives_to, receives_from
+
+    def _allows(self, giver_id, receiver_id):
+        if giver_id == receiver_id or receiver_id in self._blocked(giver_id)[0]:
+            return False
+        teams = dict(self.group.members.filter(user_id__in=[giver_id, receiver_id]).values_list('user_id', 'team'))
+        return not teams.get(giver_id) or teams.get(giver_id) != teams.get(receiver_id)
+
+    def _splice_in(self, user_id, match=None):
+        """Insert ``user_id`` into a random allowed pair A -> B.
+
+        ``match`` is the member's own Match row to reuse, if they have one.
+        Returns the ids of the two rewritten matches, or None if no pair fits.
+        """
+        gives_to, receives_from = self._blocked(user_id)
+        candidates = (
+            Match.objects.filter(group=self.group)
+            .exclude(giver_id=user_id)
+            .exclude(receiver_id=user_id)
+            .exclude(giver_id__in=receives_from)
+            .exclude(receiver_id__in=gives_to)
+        )
+        team = self.group.members.filter(user_id=user_id).values_list('team', flat=True).first()
+        if team:
+            teammates = self.group.members.filter(team=team).values('user_id')
+            candidates = candidates.exclude(giver_id__in=teammates).exclude(receiver_id__in=teammates)
+
+        # A random point in the giver id range, then the first allowed pair at or
+        # after it, wrapping around: index lookups however big the group is
+        bounds = Match.objects.filter(group=self.group).aggregate(low=Min('giver_id'), high=Max('giver_id'))
+        if bounds['low'] is None:
+            return None
+        pivot = random.Random(self.seed).randint(bounds['low'], bounds['high'])
+        candidates = candidates.order_by('giver_id').only('id', 'receiver_id')
+        pair = candidates.filter(giver_id__gte=pivot).first() or candidates.first()
+        if pair is None:
+            return None
+
+        receiver_id = pair.receiver_id
+        self._reassign(pair, user_id)
+        if match is None:
+            match = Match.objects.create(group=self.group, giver_id=user_id, receiver_id=receiver_id)
+        else:
+            self._reassign(match, receiver_id)
+        return [pair.id, match.id]
+
+    def _reassign(self, match, receiver_id):
+        match.receiver_id = receiver_id
+        match.notification_sent = False
+        match.save(update_fields=['receiver', 'notification_sent'])
+
+    def _log_splice(self, kind, added=0, changed=0, removed=0):
+        MatchRun.objects.create(
+            group=self.group,
+            kind=kind,
+            seed=self.seed if self.group.match_seed is None else self.group.match_seed,
+            splice_seed=self.seed,
+            algorithm=self.group.match_algorithm or self.algorithm_version,
+            member_count=self.group.matched_count,
+            added=added,
+            changed=changed,
+            removed=removed,
+        )
+
+    def _insert_pairs(self, pairs, batch_size, progress=None):
+        count = 0
+        while True:
+            batch = [
+                Match(group_id=self.group.id, giver_id=giver_id, receiver_id=receiver_id)
+                for giver_id, receiver_id in islice(pairs, batch_size)
+            ]
+            if not batch:
+                return count
+            Match.objects.bulk_create(batch, batch_size=batch_size)
+            count += len(batch)
+            if progress:
+                progress(count)
+
+    def _copy_pairs(self, connection, pairs, batch_size, progress=None):
+        """Stream pairs into the match table with PostgreSQL's COPY"""
+        created_at = timezone.now().isoformat()
+        written = [0]
+
+        def lines():
+            for giver_id, receiver_id in pairs:
+                written[0] += 1
+                if progress and written[0] % batch_size == 0:
+                    progress(written[0])
+                yield f'{self.group.id},{giver_id},{receiver_id},f,{created_at}\n'
+
+        sql = (
+            f'COPY {Match._meta.db_table} (group_id, giver_id, receiver_id, notification_sent, created_at) '
+            f'FROM STDIN WITH (FORMAT csv)'
+        )
+        with connection.cursor() as cursor:
+            raw = cursor.cursor
+            if hasattr(raw, 'copy_expert'):
+                # psycopg2
+                raw.copy_expert(sql, _LineStream(lines()))
+            else:
+                # psycopg 3
+                with raw.copy(sql) as copy:
+                    for line in lines():
+                        copy.write(line)
+        if progress:
+            progress(written[0])
+        return written[0]
+
+    def _mark_done(self, count):
+        self.group.matching_done = True
+        self.group.match_seed = self.seed
+        self.group.match_algorithm = self.algorithm_version
+        self.group.matched_count = count
+        self.group.save(update_fields=['matching_done', 'match_seed', 'match_algorithm', 'matched_count'])
+
+class _LineStream:
+    """Minimal file-like reader over an iterator of text lines, for COPY"""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
@@ -0,0 +1,75 @@
+"""Joining, leaving and editing wishlists, shared by the pages and the API.
+
+These are the only places a single member's rows change, so each one keeps
+the group's counters, cached membership flags and participant lists in step
+in the same transaction as the write, and splices people into the matches
+when the group has already been matched.
+"""
+from functools import partial
+from django.db import transaction
+from . import events, wishlists
+from .caching import bump_group_version, forget_membership
+from .matcher import SecretSantaMatcher
+from .models import Member
+from .tasks import send_all_match_notifications, send_match_notification_batch
+
+def _renotify(group, match_ids):
+    """Email the givers whose receiver changed once the transaction commits"""
+    if match_ids is None:
+        # Fell back to a full re-run: every unsent match needs its email
+        transaction.on_commit(partial(send_all_match_notifications.delay, group.id))
+    elif match_ids:
+        transaction.on_commit(partial(send_match_notification_batch.delay, match_ids))
+
+def _delete(member):
+    """Delete a member and their wishlist; returns whether they had one"""
+    had_wishlist, _ = wishlists.items_of(member).delete()
+    member.delete()
+    return bool(had_wishlist)
+
+def add_member(group, user):
+    """Add ``user`` to ``group`` and return the new Member.
+
+    Raises ValueError when the group is matched and the rules leave no
+    place for them.
+    """
+    if group.matching_done:
+        # Late joiner: splice them into the existing matches
+        with transaction.atomic():
+            member = Member.objects.create(group=group, user=user)
+            group.adjust_counts(member_count=1)
+            _renotify(group, SecretSantaMatcher(group).add_member(user.id))
+    else:
+        member = Member.objects.create(group=group, user=user)
+        group.adjust_counts(member_count=1)
+    forget_membership(group.id, user.id)
+    bump_group_version(group.id)
+    events.publish(group.id, events.MEMBER_JOINED, participant=events.participant(user, group), **events.counts(group))
+    return member
+
+def remove_member(group, member):
+    """Remove a member, handing their receiver to their own Santa if matched"""
+    if group.matching_done:
+        with transaction.atomic():
+            had_wishlist = _delete(member)
+            group.adjust_counts(member_count=-1, wishlist_count=-had_wishlist)
+            _renotify(group, SecretSantaMatcher(group).remove_member(member.user_id))
+    else:
+        had_wishlist = _delete(member)
+        group.adjust_counts(member_count=-1, wishlist_count=-had_wishlist)
+    forget_membership(group.id, member.user_id)
+    bump_group_version(group.id)
+    events.publish(group.id, events.MEMBER_LEFT, user_id=member.user_id, **events.counts(group))
+
+def set_wishlist(group, member, items):
+    """Make ``items`` (field dicts) the member's whole wishlist"""
+    with transaction.atomic():
+        # Two saves by the same member must not both count a new wishlist
+        Member.objects.select_for_update().filter(id=member.id).values_list('id').first()
+        had_wishlist = wishlists.replace(member, items)
+        group.adjust_counts(wishlist_count=bool(items) - had_wishlist)
+        events.publish(
+            group.id, events.WISHLIST_UPDATED,
+            user_id=member.user_id, has_wishlist=bool(items), **events.counts(group),
+        )
+    bump_group_version(group.id)
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='previous_group',
+            field=models.ForeignKey(blank=True, help_text="Last year's exchange - its pairs will not be repeated", null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='groups.group'),
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='team',
+            field=models.CharField(blank=True, help_text='Members of the same team are never matched', max_length=100),
+        ),
+        migrations.CreateModel(
+            name='Exclusion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mutual', models.BooleanField(default=True, help_text='Also exclude the reverse pairing')),
+                ('giver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exclusions', to='groups.group')),
+                ('receiver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('group', 'giver', 'receiver')},
+            },
+        ),
+    ]
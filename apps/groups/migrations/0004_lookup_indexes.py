@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0003_matchingjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(fields=['group', 'receiver'], name='match_group_receiver_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='match',
+            index=models.Index(condition=models.Q(('notification_sent', False)), fields=['group'], name='match_unsent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='member',
+            index=models.Index(condition=models.Q(('wishlist', ''), _negated=True), fields=['group'], name='member_wishlist_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0004_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='match_algorithm',
+            field=models.CharField(blank=True, editable=False, max_length=30),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='match_seed',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='MatchRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('match', 'Initial matching'), ('rerun', 'Re-run')], max_length=10)),
+                ('seed', models.BigIntegerField()),
+                ('algorithm', models.CharField(max_length=30)),
+                ('member_count', models.PositiveIntegerField(default=0)),
+                ('added', models.PositiveIntegerField(default=0)),
+                ('changed', models.PositiveIntegerField(default=0)),
+                ('removed', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='match_runs', to='groups.group')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0005_seeded_matching'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='matchrun',
+            name='kind',
+            field=models.CharField(choices=[('match', 'Initial matching'), ('rerun', 'Re-run'), ('join', 'Late join'), ('leave', 'Member left')], max_length=10),
+        ),
+    ]
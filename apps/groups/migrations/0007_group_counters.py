@@ -0,0 +1,47 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:19
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counts(apps, schema_editor):
+    Group = apps.get_model('groups', 'Group')
+    Member = apps.get_model('groups', 'Member')
+    Match = apps.get_model('groups', 'Match')
+
+    def count(rows):
+        rows = rows.filter(group=OuterRef('pk')).order_by().values('group')
+        return Coalesce(Subquery(rows.annotate(n=Count('id')).values('n')), 0)
+
+    Group.objects.update(
+        member_count=count(Member.objects.all()),
+        wishlist_count=count(Member.objects.exclude(wishlist='')),
+        matched_count=count(Match.objects.all()),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0006_splice_run_kinds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='matched_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='wishlist_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_counts, migrations.RunPython.noop),
+    ]
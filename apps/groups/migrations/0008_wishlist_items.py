@@ -0,0 +1,141 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:02
+
+import re
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+FTS_TABLE = 'groups_wishlistitem_fts'
+
+# SQLite: an external-content FTS5 table over WishlistItem.item, kept in step
+# by triggers. A later migration that rebuilds groups_wishlistitem on SQLite
+# drops the triggers with the old table and must create them again.
+SQLITE_SEARCH_INDEX = [
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+    f"item, content='groups_wishlistitem', content_rowid='id', tokenize='porter unicode61')",
+    f"CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON groups_wishlistitem BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, item) VALUES (new.id, new.item); END",
+    f"CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON groups_wishlistitem BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, item) VALUES ('delete', old.id, old.item); END",
+    f"CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF item ON groups_wishlistitem BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, item) VALUES ('delete', old.id, old.item); "
+    f"INSERT INTO {FTS_TABLE}(rowid, item) VALUES (new.id, new.item); END",
+]
+
+
+def _gin_index():
+    from django.contrib.postgres.indexes import GinIndex
+    from django.contrib.postgres.search import SearchVector
+
+    # Must match groups.wishlists.search()
+    return GinIndex(SearchVector('item', config='english'), name='wishlist_item_search_idx')
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.add_index(apps.get_model('groups', 'WishlistItem'), _gin_index())
+    elif vendor == 'sqlite':
+        for statement in SQLITE_SEARCH_INDEX:
+            schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.remove_index(apps.get_model('groups', 'WishlistItem'), _gin_index())
+    elif vendor == 'sqlite':
+        for action in ('insert', 'delete', 'update'):
+            schema_editor.execute(f'DROP TRIGGER {FTS_TABLE}_{action}')
+        schema_editor.execute(f'DROP TABLE {FTS_TABLE}')
+
+
+BULLET = re.compile(r'^\s*(?:[-*•]|\d+[.)])\s+')
+URL = re.compile(r'https?://\S+')
+
+
+def parse_wishlist(text):
+    # A frozen copy of groups.wishlists.parse, truncating to the column sizes
+    for line in text.splitlines():
+        line = BULLET.sub('', line).strip()
+        if not line:
+            continue
+        item, *extras = [part.strip() for part in line.split('|')]
+        price_hint = link = ''
+        if not extras and (found := URL.search(item)):
+            link = found.group()
+            item = ' '.join(f'{item[:found.start()]} {item[found.end():]}'.split())
+        for extra in extras:
+            if URL.fullmatch(extra):
+                link = extra
+            elif extra:
+                price_hint = extra
+        if len(link) > 500:
+            item, link = f'{item} {link}', ''
+        yield {'item': (item or link)[:300], 'price_hint': price_hint[:50], 'link': link}
+
+
+def split_wishlists(apps, schema_editor):
+    Member = apps.get_model('groups', 'Member')
+    WishlistItem = apps.get_model('groups', 'WishlistItem')
+    items = []
+    members = Member.objects.exclude(wishlist='').values_list('group_id', 'user_id', 'wishlist')
+    for group_id, user_id, wishlist in members.iterator():
+        items += [
+            WishlistItem(group_id=group_id, user_id=user_id, position=position, **item)
+            for position, item in enumerate(parse_wishlist(wishlist))
+        ]
+        if len(items) >= 5000:
+            WishlistItem.objects.bulk_create(items)
+            items = []
+    WishlistItem.objects.bulk_create(items)
+
+
+def join_wishlists(apps, schema_editor):
+    Member = apps.get_model('groups', 'Member')
+    WishlistItem = apps.get_model('groups', 'WishlistItem')
+    lines = {}
+    for item in WishlistItem.objects.order_by('group_id', 'user_id', 'position').iterator():
+        parts = [part for part in (item.item, item.price_hint, item.link) if part]
+        lines.setdefault((item.group_id, item.user_id), []).append(' | '.join(parts))
+    for (group_id, user_id), member_lines in lines.items():
+        Member.objects.filter(group_id=group_id, user_id=user_id).update(wishlist='\n'.join(member_lines))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0007_group_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WishlistItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField()),
+                ('item', models.CharField(max_length=300)),
+                ('price_hint', models.CharField(blank=True, max_length=50)),
+                ('link', models.URLField(blank=True, max_length=500)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='wishlist_items', to='groups.group')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['group', 'user', 'position'],
+                'unique_together': {('group', 'user', 'position')},
+            },
+        ),
+        # Before the items are written, so the SQLite triggers index them
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(split_wishlists, join_wishlists),
+        migrations.RemoveIndex(
+            model_name='member',
+            name='member_wishlist_idx',
+        ),
+        migrations.RemoveField(
+            model_name='member',
+            name='wishlist',
+        ),
+    ]
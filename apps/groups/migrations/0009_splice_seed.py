@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0008_wishlist_items'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matchrun',
+            name='splice_seed',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,10 +1,26 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils import timezone
 import uuid
 import secrets
+from datetime import timedelta
 
 User = get_user_model()
 
+# Crockford's base32: upper case without I, L, O or U, so codes read aloud or
+# typed in any case come out the same. 12 characters give 2**60 codes; with
+# tens of millions of groups a new code collides about once in 10**10 tries,
+# and Group.save() draws again when it does.
+INVITE_CODE_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+INVITE_CODE_LENGTH = 12
+INVITE_CODE_ATTEMPTS = 5
+
+def generate_invite_code():
+    return ''.join(secrets.choice(INVITE_CODE_ALPHABET) for _ in range(INVITE_CODE_LENGTH))
+
 class Group(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField(blank=True)
@@ -14,11 +30,55 @@ class Group(models.Model):
     matching_done = models.BooleanField(default=False)
     reveal_mode = models.BooleanField(default=False)
     budget_limit = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    previous_group = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+        help_text="Last year's exchange - its pairs will not be repeated"
+    )
+    match_seed = models.BigIntegerField(null=True, blank=True, editable=False)
+    match_algorithm = models.CharField(max_length=30, blank=True, editable=False)
+    
+    # Denormalized counts, kept in step by adjust_counts() wherever the rows are
+    # written (membership, matcher) and recounted by reconcile_counts() after
+    # bulk writes (importer) or by the reconcile_counters command
+    member_count = models.PositiveIntegerField(default=0, editable=False)
+    wishlist_count = models.PositiveIntegerField(default=0, editable=False)
+    matched_count = models.PositiveIntegerField(default=0, editable=False)
     
     def save(self, *args, **kwargs):
-        if not self.invite_code:
-            self.invite_code = secrets.token_urlsafe(8)[:12].upper()
-        super().save(*args, **kwargs)
+        if self.invite_code:
+            return super().save(*args, **kwargs)
+        
+        for attempt in range(1, INVITE_CODE_ATTEMPTS + 1):
+            self.invite_code = generate_invite_code()
+            try:
+                # A savepoint, so a taken code doesn't abort the caller's transaction
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                taken = Group.objects.filter(invite_code=self.invite_code).exists()
+                self.invite_code = ''
+                if not taken or attempt == INVITE_CODE_ATTEMPTS:
+                    raise
+    
+    def adjust_counts(self, **deltas):
+        """Add to the stored counters in the database, e.g. adjust_counts(member_count=1).
+        
+        All counters are then reloaded in the same transaction, so they hold
+        what was written even when this instance came from the cache.
+        """
+        deltas = {field: delta for field, delta in deltas.items() if delta}
+        # Nothing to roll back on its own, so no savepoint when already in a transaction
+        with transaction.atomic(savepoint=False):
+            if deltas:
+                Group.objects.filter(id=self.id).update(**{field: F(field) + delta for field, delta in deltas.items()})
+            self.refresh_from_db(fields=['member_count', 'wishlist_count', 'matched_count'])
+    
+    def reconcile_counts(self):
+        """Recount the counters from scratch after bulk changes; returns the counts"""
+        counts = count_expressions()
+        Group.objects.filter(id=self.id).update(**counts)
+        self.refresh_from_db(fields=list(counts))
+        return {field: getattr(self, field) for field in counts}
     
     def __str__(self):
         return self.name
@@ -26,7 +86,7 @@ class Group(models.Model):
 class Member(models.Model):
     group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='members')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='memberships')
-    wishlist = models.TextField(blank=True, help_text="Enter 3 gift ideas, one per line")
+    team = models.CharField(max_length=100, blank=True, help_text="Members of the same team are never matched")
     joined_at = models.DateTimeField(auto_now_add=True)
     
     class Meta:
@@ -35,6 +95,26 @@ class Member(models.Model):
     def __str__(self):
         return f"{self.user.username} in {self.group.name}"
 
+class WishlistItem(models.Model):
+    """One gift idea on a member's wishlist (see groups.wishlists).
+
+    Keyed by group and user like Match, not by Member, so members, groups
+    and users can all still be deleted with a single query each.
+    """
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='wishlist_items')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    position = models.PositiveSmallIntegerField()
+    item = models.CharField(max_length=300)
+    price_hint = models.CharField(max_length=50, blank=True)
+    link = models.URLField(max_length=500, blank=True)
+    
+    class Meta:
+        ordering = ['group', 'user', 'position']
+        unique_together = ('group', 'user', 'position')
+    
+    def __str__(self):
+        return self.item
+
 class Match(models.Model):
     group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='matches')
     giver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='giving_to')
@@ -44,6 +124,123 @@ class Match(models.Model):
     
     class Meta:
         unique_together = ('group', 'giver')
+        indexes = [
+            # "Who is buying for me" lookups
+            models.Index(fields=['group', 'receiver'], name='match_group_receiver_idx'),
+            # Notification fan-out only reads matches still waiting for an email
+            models.Index(fields=['group'], condition=models.Q(notification_sent=False), name='match_unsent_idx'),
+        ]
     
     def __str__(self):
         return f"{self.giver.username} → {self.receiver.username}"
+
+class Exclusion(models.Model):
+    """A pairing the matcher must avoid, e.g. spouses"""
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='exclusions')
+    giver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    mutual = models.BooleanField(default=True, help_text="Also exclude the reverse pairing")
+    
+    class Meta:
+        unique_together = ('group', 'giver', 'receiver')
+    
+    def __str__(self):
+        arrow = '↔' if self.mutual else '→'
+        return f"{self.giver.username} {arrow} {self.receiver.username}"
+
+class MatchingJob(models.Model):
+    """A background matching run started by the host"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+    
+    # A queued or running job not heard from for this long has lost its worker
+    STALE_AFTER = timedelta(minutes=10)
+    
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='matching_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        get_latest_by = 'created_at'
+    
+    @property
+    def is_active(self):
+        return self.status in (self.QUEUED, self.RUNNING)
+    
+    @property
+    def is_stale(self):
+        """Still marked active, but neither saved nor reporting progress for STALE_AFTER"""
+        return (
+            self.is_active
+            and self.updated_at < timezone.now() - self.STALE_AFTER
+            and cache.get(self.progress_key(self.id)) is None
+        )
+    
+    @staticmethod
+    def progress_key(job_id):
+        return f'matching-job:{job_id}:progress'
+    
+    @property
+    def live_progress(self):
+        """Rows written so far, including progress not yet saved on the job"""
+        if self.status == self.RUNNING:
+            return cache.get(self.progress_key(self.id), self.progress)
+        return self.progress
+    
+    def __str__(self):
+        return f"Matching {self.group.name} ({self.status})"
+
+class MatchRun(models.Model):
+    """Audit log entry for each time a group's matches were written"""
+    MATCH = 'match'
+    RERUN = 'rerun'
+    JOIN = 'join'
+    LEAVE = 'leave'
+    KIND_CHOICES = [
+        (MATCH, 'Initial matching'),
+        (RERUN, 'Re-run'),
+        (JOIN, 'Late join'),
+        (LEAVE, 'Member left'),
+    ]
+    
+    group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='match_runs')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    # The seed of the stored assignment; a join or leave also records the seed that picked its pair
+    seed = models.BigIntegerField()
+    splice_seed = models.BigIntegerField(null=True, blank=True)
+    algorithm = models.CharField(max_length=30)
+    member_count = models.PositiveIntegerField(default=0)
+    added = models.PositiveIntegerField(default=0)
+    changed = models.PositiveIntegerField(default=0)
+    removed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} of {self.group.name} ({self.algorithm}, seed {self.seed})"
+
+def _count(rows):
+    """Subquery counting ``rows`` of the outer group"""
+    rows = rows.filter(group=OuterRef('pk')).order_by().values('group')
+    return Coalesce(Subquery(rows.annotate(n=Count('id')).values('n')), 0)
+
+def count_expressions():
+    """How each Group counter is recounted from the rows it summarises"""
+    return {
+        'member_count': _count(Member.objects.all()),
+        'wishlist_count': _count(Member.objects.filter(Exists(
+            WishlistItem.objects.filter(group=OuterRef('group'), user=OuterRef('user'))
+        ))),
+        'matched_count': _count(Match.objects.all()),
+    }
@@ -0,0 +1,85 @@
+from django.contrib.auth import get_user_model
+from rest_framework import serializers
+from .models import Group, Match, MatchingJob, Member, WishlistItem
+from .wishlists import MAX_ITEMS
+
+User = get_user_model()
+
+class FieldSelectionMixin:
+    """Return only the fields named in ``?fields=a,b`` so polling clients fetch less"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        selected = request.query_params.get('fields') if request else None
+        if selected:
+            wanted = {name.strip() for name in selected.split(',')}
+            for name in set(self.fields) - wanted:
+                self.fields.pop(name)
+
+class UserSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'first_name', 'last_name']
+
+class GroupSerializer(FieldSelectionMixin, serializers.ModelSerializer):
+    """Expects ``select_related('host')``"""
+    host = UserSerializer(read_only=True)
+    
+    class Meta:
+        model = Group
+        fields = [
+            'invite_code', 'name', 'description', 'budget_limit', 'reveal_mode',
+            'matching_done', 'host', 'member_count', 'wishlist_count', 'matched_count', 'created_at',
+        ]
+        read_only_fields = ['invite_code', 'matching_done', 'member_count', 'wishlist_count', 'matched_count', 'created_at']
+
+class MemberSerializer(FieldSelectionMixin, serializers.ModelSerializer):
+    """Expects ``select_related('user')`` and a ``has_wishlist`` annotation.
+
+    Wishlists themselves are only shown to the member and their Santa.
+    """
+    user = UserSerializer(read_only=True)
+    has_wishlist = serializers.BooleanField(read_only=True)
+    
+    class Meta:
+        model = Member
+        fields = ['id', 'user', 'team', 'has_wishlist', 'joined_at']
+
+class WishlistItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WishlistItem
+        fields = ['item', 'price_hint', 'link']
+
+class WishlistSerializer(serializers.Serializer):
+    """A member's whole wishlist; writing it replaces every item"""
+    items = WishlistItemSerializer(many=True, max_length=MAX_ITEMS)
+
+class WishlistSearchSerializer(WishlistItemSerializer):
+    """Expects ``select_related('user')``"""
+    user = UserSerializer(read_only=True)
+    
+    class Meta(WishlistItemSerializer.Meta):
+        fields = ['user', *WishlistItemSerializer.Meta.fields]
+
+class MatchSerializer(FieldSelectionMixin, serializers.ModelSerializer):
+    """Expects a match loaded by ``tasks.with_receiver_wishlist``"""
+    receiver = UserSerializer(read_only=True)
+    receiver_wishlist = WishlistItemSerializer(many=True, read_only=True)
+    
+    class Meta:
+        model = Match
+        fields = ['receiver', 'receiver_wishlist', 'notification_sent', 'created_at']
+
+class MatchingJobSerializer(serializers.ModelSerializer):
+    progress = serializers.IntegerField(source='live_progress', read_only=True)
+    
+    class Meta:
+        model = MatchingJob
+        fields = ['id', 'status', 'progress', 'total', 'error', 'created_at', 'updated_at']
+
+class JoinSerializer(serializers.Serializer):
+    invite_code = serializers.CharField(max_length=12)
+    
+    def validate_invite_code(self, value):
+        return value.upper().strip()
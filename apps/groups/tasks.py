@@ -1,20 +1,62 @@
-from celery import shared_task
-from django.core.mail import send_mail
+import asyncio
+import math
+import time
+from itertools import islice
+from smtplib import SMTPException, SMTPRecipientsRefused
+from celery import chord, shared_task
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
 from django.conf import settings
-from .models import Match, Member
+from django.db import transaction
+from django.utils import timezone
+from . import delivery, events, wishlists
+from .caching import bump_group_version
+from .matcher import SecretSantaMatcher
+from .models import Group, Match, MatchingJob
 
-@shared_task
-def send_match_notification(match_id):
-    """Send email notification to a giver about their match"""
-    try:
-        match = Match.objects.select_related('giver', 'receiver', 'group').get(id=match_id)
-        
-        # Get receiver's wishlist
-        receiver_member = Member.objects.get(group=match.group, user=match.receiver)
-        wishlist = receiver_member.wishlist if receiver_member.wishlist else "No wishlist provided"
-        
-        subject = f"🎅 Your Secret Santa Match for {match.group.name}"
-        message = f"""
+# Notifications sent per task over a single mail connection
+NOTIFICATION_BATCH_SIZE = 100
+
+# Rate-limit waits shorter than this are slept through instead of rescheduled
+MAX_INLINE_WAIT = 1.0
+
+# Transient mail errors are retried with exponential backoff
+MAIL_RETRY = {
+    'autoretry_for': (SMTPException, OSError),
+    'retry_backoff': True,
+    'retry_backoff_max': 600,
+    'retry_jitter': True,
+    'max_retries': 8,
+}
+
+def with_receiver_wishlist(matches):
+    """Load matches with giver, receiver and group, and the receiver's wishlist items as ``receiver_wishlist``"""
+    matches = matches.select_related('giver', 'receiver', 'group')
+    return _attach_wishlists(list(matches), list(wishlists.for_receivers(matches)))
+
+async def awith_receiver_wishlist(matches):
+    """``with_receiver_wishlist`` for async views, running both queries at once"""
+    async def fetch(queryset):
+        return [row async for row in queryset]
+    
+    matches = matches.select_related('giver', 'receiver', 'group')
+    rows, items = await asyncio.gather(fetch(matches), fetch(wishlists.for_receivers(matches)))
+    return _attach_wishlists(rows, items)
+
+def _attach_wishlists(matches, items):
+    by_receiver = {}
+    for item in items:
+        by_receiver.setdefault((item.group_id, item.user_id), []).append(item)
+    for match in matches:
+        match.receiver_wishlist = by_receiver.get((match.group_id, match.receiver_id), [])
+    return matches
+
+def build_notification(match):
+    """Email telling a giver who they are buying for"""
+    wishlist = wishlists.as_text(match.receiver_wishlist) or "No wishlist provided"
+    
+    subject = f"🎅 Your Secret Santa Match for {match.group.name}"
+    message = f"""
 Hi {match.giver.first_name or match.giver.username}!
 
 You're the Secret Santa for: {match.receiver.first_name or match.receiver.username}
@@ -29,32 +71,226 @@ Remember - keep it a secret! 🤫
 Happy gifting!
 - Secret Santa Matcher
         """
-        
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [match.giver.email],
-            fail_silently=False,
-        )
-        
-        match.notification_sent = True
-        match.save()
-        
-        return f"Notification sent to {match.giver.email}"
     
-    except Exception as e:
-        return f"Error sending notification: {str(e)}"
+    return EmailMessage(subject, message, settings.DEFAULT_FROM_EMAIL, [match.giver.email])
+
+@shared_task(**MAIL_RETRY)
+def send_match_notification(match_id):
+    """Send email notification to a giver about their match"""
+    return deliver_notifications([match_id])
+
+@shared_task(**MAIL_RETRY)
+def send_match_notification_batch(match_ids):
+    """Send notifications for a chunk of matches over one reused mail connection"""
+    return deliver_notifications(match_ids)
+
+def deliver_notifications(match_ids):
+    """Send the notifications of ``match_ids`` over one mail connection.
+    
+    Sends are throttled per recipient domain and anything over the limit is
+    rescheduled. Transient mail errors raise so the calling task retries with
+    exponential backoff; matches already delivered are skipped on retry.
+    """
+    matches = with_receiver_wishlist(Match.objects.filter(id__in=match_ids, notification_sent=False))
+    sent = []
+    unreachable = []
+    deferred = []
+    rejected = []
+    failure = None
+    wait = 0
+    
+    with get_connection() as connection:
+        for match in matches:
+            if not match.giver.email:
+                # Nothing to send, ever; settled so resumed runs stop queueing it
+                unreachable.append(match.id)
+                continue
+            if delivery.already_delivered(match):
+                # Sent by an earlier attempt that died before recording it
+                sent.append(match.id)
+                continue
+            if not delivery.claim(match):
+                continue
+            
+            bucket = delivery.TokenBucket(delivery.recipient_domain(match.giver.email))
+            delay = bucket.take()
+            if 0 < delay <= MAX_INLINE_WAIT:
+                time.sleep(delay)
+                delay = bucket.take()
+            if delay:
+                delivery.release(match)
+                deferred.append(match.id)
+                wait = max(wait, delay)
+                continue
+            
+            try:
+                connection.send_messages([build_notification(match)])
+            except SMTPRecipientsRefused as e:
+                # Permanent - retrying won't help
+                delivery.release(match)
+                rejected.append(f"{match.giver.email}: {str(e)}")
+            except (SMTPException, OSError) as e:
+                # The connection is likely gone; retry the rest of the batch later
+                delivery.release(match)
+                failure = e
+                break
+            else:
+                delivery.mark_delivered(match)
+                sent.append(match.id)
+    
+    # One UPDATE for the whole chunk instead of a save() per match
+    Match.objects.filter(id__in=sent + unreachable).update(notification_sent=True)
+    # notification_sent is in the API payloads, so their ETags must change with it
+    settled = set(sent + unreachable)
+    for group_id in {match.group_id for match in matches if match.id in settled}:
+        bump_group_version(group_id)
+    
+    if deferred:
+        send_match_notification_batch.apply_async((deferred,), countdown=math.ceil(wait))
+    if failure is not None:
+        raise failure
+    
+    result = f"Sent {len(sent)} of {len(matches)} notifications"
+    if unreachable:
+        result += f", {len(unreachable)} without an email address"
+    if deferred:
+        result += f", {len(deferred)} rescheduled by rate limits"
+    if rejected:
+        result += f" ({len(rejected)} rejected: {'; '.join(rejected)})"
+    return result
+
+def queue_notifications(matches):
+    """Queue one batch task per NOTIFICATION_BATCH_SIZE unsent matches.
+    
+    Returns (notifications queued, batches queued).
+    """
+    match_ids = (
+        matches.filter(notification_sent=False)
+        .order_by('id')
+        .values_list('id', flat=True)
+        .iterator(chunk_size=NOTIFICATION_BATCH_SIZE * 10)
+    )
+    
+    queued = 0
+    batches = 0
+    while True:
+        batch = list(islice(match_ids, NOTIFICATION_BATCH_SIZE))
+        if not batch:
+            break
+        send_match_notification_batch.delay(batch)
+        queued += len(batch)
+        batches += 1
+    return queued, batches
 
 @shared_task
 def send_all_match_notifications(group_id):
-    """Send notifications to all members of a group"""
-    from .models import Group
-    
+    """Send notifications to all members of a group, one task per batch"""
     group = Group.objects.get(id=group_id)
-    matches = group.matches.all()
+    queued, batches = queue_notifications(group.matches.all())
     
-    for match in matches:
-        send_match_notification.delay(match.id)
+    return f"Queued {queued} notifications in {batches} batches for {group.name}"
+
+def claim_matching_job(group_id, total=0):
+    """Create a queued MatchingJob for an unmatched group, or None if it has one running.
+    
+    The check and the insert happen under a lock on the group row, so two
+    callers can't both start a run; a caller finding the row locked backs
+    off. Jobs whose worker has died are marked failed instead of blocking.
+    """
+    with transaction.atomic():
+        locked = (
+            Group.objects.select_for_update(skip_locked=True)
+            .filter(id=group_id, matching_done=False).values_list('id').first()
+        )
+        if locked is None:
+            return None
+        active = list(MatchingJob.objects.filter(
+            group_id=group_id, status__in=[MatchingJob.QUEUED, MatchingJob.RUNNING],
+        ))
+        if not all(job.is_stale for job in active):
+            return None
+        MatchingJob.objects.filter(id__in=[job.id for job in active]).update(
+            status=MatchingJob.FAILED, error='Interrupted - the worker stopped responding', updated_at=timezone.now(),
+        )
+        return MatchingJob.objects.create(group_id=group_id, total=total)
+
+@shared_task
+def run_matching_job(job_id, notify=True):
+    """Run the matcher for a queued MatchingJob, recording progress as it goes"""
+    job = MatchingJob.objects.select_related('group').get(id=job_id)
+    group = job.group
+    jobs = MatchingJob.objects.filter(id=job_id)
+    # A job given up as stale may still be waiting in the queue
+    if not jobs.filter(status=MatchingJob.QUEUED).update(
+        status=MatchingJob.RUNNING, total=group.member_count, updated_at=timezone.now(),
+    ):
+        return f"Matching job {job_id} is no longer queued"
+    
+    # Rows written inside the matching transaction stay invisible to pollers
+    # until it commits, so live progress goes through the cache instead. It
+    # expires with the job's staleness window, so it doubles as a heartbeat.
+    progress_key = MatchingJob.progress_key(job_id)
+    
+    def report(written):
+        cache.set(progress_key, written, timeout=MatchingJob.STALE_AFTER.total_seconds())
+        events.publish_now(group.id, events.MATCHING_PROGRESS, progress=written, total=group.member_count)
+    
+    try:
+        count = SecretSantaMatcher(group).stream_matches(progress=report)
+    except Exception as e:
+        jobs.update(status=MatchingJob.FAILED, error=str(e), updated_at=timezone.now())
+        events.publish(group.id, events.MATCHING_FAILED)
+        return f"Error during matching: {str(e)}"
+    finally:
+        cache.delete(progress_key)
+    
+    jobs.update(status=MatchingJob.DONE, progress=count, updated_at=timezone.now())
+    bump_group_version(group.id)
+    events.publish(group.id, events.MATCHING_DONE, matched_count=count)
+    if notify:
+        send_all_match_notifications.delay(group.id)
+    
+    return f"Matched {count} Secret Santas in {group.name}"
+
+
+def ready_groups():
+    """Unmatched groups with enough members and no matching run in flight"""
+    return (
+        Group.objects.filter(matching_done=False, member_count__gte=2)
+        .exclude(matching_jobs__status__in=[MatchingJob.QUEUED, MatchingJob.RUNNING])
+        .order_by('id')
+    )
+
+def match_group(group_id):
+    """Match one group in its own transaction without notifying; returns success.
+    
+    The group is claimed first, so a group matched or being matched since it
+    was listed by ``ready_groups`` is skipped rather than matched twice.
+    """
+    job = claim_matching_job(group_id)
+    if job is None:
+        return False
+    run_matching_job(job.id, notify=False)
+    return MatchingJob.objects.filter(id=job.id, status=MatchingJob.DONE).exists()
+
+@shared_task
+def match_groups_chunk(group_ids):
+    """Match a chunk of groups one after another; returns the ids that matched"""
+    return [group_id for group_id in group_ids if match_group(group_id)]
+
+@shared_task
+def notify_matched_groups(results):
+    """Chord callback - a single notification fan-out for a whole bulk run"""
+    group_ids = [group_id for chunk in results for group_id in chunk]
+    queued, batches = queue_notifications(Match.objects.filter(group_id__in=group_ids))
+    
+    return f"Queued {queued} notifications in {batches} batches for {len(group_ids)} groups"
+
+def dispatch_bulk_matching(group_ids, chunk_size=50):
+    """Match groups across Celery workers, then notify everyone in one fan-out.
     
-    return f"Queued {matches.count()} notifications for {group.name}"
\ No newline at end of file
+    Groups are handed out in chunks, so the number of tasks in flight is
+    bounded by the worker pool rather than the number of groups.
+    """
+    chunks = [group_ids[i:i + chunk_size] for i in range(0, len(group_ids), chunk_size)]
+    return chord(match_groups_chunk.s(chunk) for chunk in chunks)(notify_matched_groups.s())
@@ -1,3 +1,1338 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from functools import partial
+from importlib.util import find_spec
+from pathlib import Path
+from smtplib import SMTPException
+from unittest import mock, skipIf
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.db.models import F
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from config import metrics
+from config.db_routers import read_replica
+from . import delivery, events, wishlists
+from .benchmarks import ViewBenchmarkMixin, benchmark_sizes, seed_group
+from .caching import (
+    bump_group_version, group_header, group_id_for, group_version, is_member, membership_key, participant_list,
+)
+from .importer import import_members
+from .listings import GROUPS_PAGE_SIZE
+from .engine import (
+    ALGORITHMS, EXACT_SEARCH_LIMIT, ConstraintGraph, MatchingImpossible, SearchExhausted, is_valid_assignment, solve,
+)
+from .matcher import SecretSantaMatcher
+from .membership import add_member, remove_member, set_wishlist
+from .models import INVITE_CODE_ALPHABET, INVITE_CODE_LENGTH, Exclusion, Group, Member, Match, MatchingJob, MatchRun, WishlistItem
+from .tasks import (
+    claim_matching_job, match_group, queue_notifications, run_matching_job, send_match_notification,
+    send_match_notification_batch,
+)
 
-# Create your tests here.
+User = get_user_model()
+
+class LookupIndexTests(TestCase):
+    """The hot lookups must be served by an index, never a table scan"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.host = User.objects.create_user(username='host')
+        cls.guest = User.objects.create_user(username='guest')
+        cls.group = Group.objects.create(name='Office', host=cls.host)
+        Member.objects.create(group=cls.group, user=cls.host)
+        WishlistItem.objects.create(group=cls.group, user=cls.host, position=0, item='Socks')
+        Member.objects.create(group=cls.group, user=cls.guest)
+        Match.objects.create(group=cls.group, giver=cls.host, receiver=cls.guest)
+        Match.objects.create(group=cls.group, giver=cls.guest, receiver=cls.host)
+
+    def assertUsesIndex(self, queryset, index_name=None):
+        if connection.vendor == 'postgresql':
+            # Tiny test tables would otherwise always be scanned sequentially
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+            self.assertNotIn('Seq Scan', plan)
+        elif connection.vendor == 'sqlite':
+            plan = queryset.explain()
+            self.assertNotRegex(plan, r'\bSCAN groups_', plan)
+        else:
+            self.skipTest(f'No query plan checks for {connection.vendor}')
+        if index_name:
+            self.assertIn(index_name, plan)
+
+    def test_member_by_group_and_user(self):
+        self.assertUsesIndex(Member.objects.filter(group=self.group, user=self.guest))
+
+    def test_match_by_group_and_giver(self):
+        self.assertUsesIndex(Match.objects.filter(group=self.group, giver=self.guest))
+
+    def test_match_by_group_and_receiver(self):
+        self.assertUsesIndex(
+            Match.objects.filter(group=self.group, receiver=self.guest),
+            'match_group_receiver_idx',
+        )
+
+    def test_wishlist_items_by_member(self):
+        self.assertUsesIndex(WishlistItem.objects.filter(group=self.group, user=self.host))
+
+    def test_unsent_notifications(self):
+        self.assertUsesIndex(
+            Match.objects.filter(group=self.group, notification_sent=False).values('id'),
+            'match_unsent_idx',
+        )
+
+class MatchingTests(TestCase):
+    """Every solver honours the rules, and a stored seed reproduces its run"""
+    # sattolo and shuffle-swap ignore the rules and are only kept for benchmarks
+    solvers = ['cycle', 'bipartite', 'rejection']
+
+    def setUp(self):
+        self.group, self.host, self.guest = seed_group(12, matched=False)
+        self.users = list(self.group.members.order_by('id').values_list('user_id', flat=True))
+
+    def pairs(self):
+        return dict(Match.objects.filter(group=self.group).values_list('giver_id', 'receiver_id'))
+
+    def test_no_one_draws_themselves(self):
+        for algorithm in self.solvers:
+            for seed in range(5):
+                with self.subTest(algorithm=algorithm, seed=seed):
+                    pairs = dict(SecretSantaMatcher(self.group, seed=seed, algorithm=algorithm).assign())
+                    self.assertEqual(sorted(pairs), sorted(self.users))
+                    self.assertEqual(sorted(pairs.values()), sorted(self.users))
+                    self.assertTrue(all(giver != receiver for giver, receiver in pairs.items()))
+
+    def test_exclusions_and_teams_are_respected(self):
+        teams = {user_id: f'Team {i % 3}' for i, user_id in enumerate(self.users)}
+        for user_id, team in teams.items():
+            Member.objects.filter(group=self.group, user_id=user_id).update(team=team)
+        Exclusion.objects.create(group=self.group, giver_id=self.users[0], receiver_id=self.users[1])
+        Exclusion.objects.create(group=self.group, giver_id=self.users[2], receiver_id=self.users[4], mutual=False)
+        forbidden = {(self.users[0], self.users[1]), (self.users[1], self.users[0]), (self.users[2], self.users[4])}
+        for algorithm in self.solvers:
+            for seed in range(5):
+                with self.subTest(algorithm=algorithm, seed=seed):
+                    pairs = SecretSantaMatcher(self.group, seed=seed, algorithm=algorithm).assign()
+                    for giver, receiver in pairs:
+                        self.assertNotEqual(teams[giver], teams[receiver])
+                        self.assertNotIn((giver, receiver), forbidden)
+
+    def test_impossible_rules_raise(self):
+        # Seven teammates can't all give to the five people outside their team
+        Member.objects.filter(group=self.group, user_id__in=self.users[:7]).update(team='Elves')
+        for algorithm in self.solvers:
+            with self.subTest(algorithm=algorithm):
+                with self.assertRaises(MatchingImpossible):
+                    SecretSantaMatcher(self.group, seed=1, algorithm=algorithm).stream_matches()
+        self.group.refresh_from_db()
+        self.assertFalse(self.group.matching_done)
+        self.assertFalse(Match.objects.filter(group=self.group).exists())
+
+    def test_matches_are_written_in_batches(self):
+        progress = []
+        with CaptureQueriesContext(connection) as queries:
+            count = SecretSantaMatcher(self.group, seed=3).stream_matches(batch_size=5, progress=progress.append)
+        self.assertEqual(count, 12)
+        self.assertEqual(progress, [5, 10, 12])
+        inserts = [q['sql'] for q in queries if q['sql'].startswith('INSERT INTO "groups_match"')]
+        self.assertEqual(len(inserts), 3)
+        # Only ids are needed; users are never loaded
+        self.assertFalse([q['sql'] for q in queries if 'auth_user' in q['sql']])
+        self.assertEqual(sorted(self.pairs()), sorted(self.users))
+        self.assertEqual(sorted(self.pairs().values()), sorted(self.users))
+
+    def test_a_search_that_gives_up_is_not_called_impossible(self):
+        graph = ConstraintGraph(EXACT_SEARCH_LIMIT + 1)
+        # Past the exact search, failed repairs prove nothing about the rules
+        with mock.patch('groups.engine._repair_cycle', return_value=False):
+            with self.assertRaises(SearchExhausted):
+                solve(graph, random.Random(1))
+        self.assertTrue(is_valid_assignment(graph, solve(graph, random.Random(1))))
+        self.assertFalse(issubclass(SearchExhausted, MatchingImpossible))
+
+    def test_replay_reproduces_the_run(self):
+        SecretSantaMatcher(self.group, seed=2024).stream_matches()
+        run = self.group.match_runs.get()
+        self.assertEqual((run.kind, run.seed, run.member_count), (MatchRun.MATCH, 2024, 12))
+        out = io.StringIO()
+        call_command('replay_matching', self.group.invite_code, stdout=out)
+        self.assertIn('regenerate from seed 2024', out.getvalue())
+        self.group.refresh_from_db()
+        self.assertEqual(dict(SecretSantaMatcher.regenerate(self.group)), self.pairs())
+        with self.assertRaisesMessage(CommandError, '--seed only applies to --rerun'):
+            call_command('replay_matching', self.group.invite_code, '--seed', '7')
+
+    def test_rerun_writes_only_changed_rows(self):
+        SecretSantaMatcher(self.group, seed=1).stream_matches()
+        Match.objects.filter(group=self.group).update(notification_sent=True)
+        before = {match.giver_id: match for match in Match.objects.filter(group=self.group)}
+
+        # The same seed changes nothing, so nothing is written
+        with CaptureQueriesContext(connection) as queries:
+            SecretSantaMatcher(self.group, seed=1).stream_matches()
+        match_writes = ('INSERT INTO "groups_match"', 'UPDATE "groups_match"')
+        self.assertEqual([q['sql'] for q in queries if q['sql'].startswith(match_writes)], [])
+        self.assertEqual(self.group.match_runs.latest('id').changed, 0)
+
+        with mock.patch('groups.management.commands.replay_matching.queue_notifications', return_value=(0, 0)) as queue:
+            call_command('replay_matching', self.group.invite_code, '--rerun', '--seed', '7', stdout=io.StringIO())
+        [(matches,), _] = queue.call_args
+        self.assertEqual(set(matches.values_list('group_id', flat=True)), {self.group.id})
+        run = self.group.match_runs.latest('id')
+        after = {match.giver_id: match for match in Match.objects.filter(group=self.group)}
+        changed = [giver for giver in after if after[giver].receiver_id != before[giver].receiver_id]
+        self.assertEqual(
+            (run.kind, run.seed, run.changed, run.added, run.removed), (MatchRun.RERUN, 7, len(changed), 0, 0),
+        )
+        self.assertTrue(changed)
+        for giver, match in after.items():
+            self.assertEqual(match.id, before[giver].id)
+            self.assertEqual(match.notification_sent, giver not in changed)
+
+class MatchingJobTests(TestCase):
+    """One matching run per group at a time, and a dead run doesn't block the next"""
+
+    def setUp(self):
+        cache.clear()
+        self.group, self.host, self.guest = seed_group(6, matched=False)
+        self.client.force_login(self.host)
+
+    def run_matching(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('groups:run_matching', args=[self.group.invite_code]))
+        return callbacks
+
+    def test_active_job_blocks_another(self):
+        MatchingJob.objects.create(group=self.group, status=MatchingJob.RUNNING)
+        self.assertEqual(self.run_matching(), [])
+        self.assertEqual(self.group.matching_jobs.count(), 1)
+        self.assertIsNone(claim_matching_job(self.group.id))
+
+    def test_stale_job_is_replaced(self):
+        stale = MatchingJob.objects.create(group=self.group, status=MatchingJob.RUNNING)
+        MatchingJob.objects.filter(id=stale.id).update(updated_at=timezone.now() - MatchingJob.STALE_AFTER * 2)
+        self.assertEqual(len(self.run_matching()), 1)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, MatchingJob.FAILED)
+        self.assertEqual(self.group.matching_jobs.latest('id').status, MatchingJob.QUEUED)
+
+    def test_job_reporting_progress_is_not_stale(self):
+        job = MatchingJob.objects.create(group=self.group, status=MatchingJob.RUNNING)
+        MatchingJob.objects.filter(id=job.id).update(updated_at=timezone.now() - MatchingJob.STALE_AFTER * 2)
+        cache.set(MatchingJob.progress_key(job.id), 5000)
+        self.assertIsNone(claim_matching_job(self.group.id))
+
+    def test_superseded_job_does_not_run(self):
+        job = MatchingJob.objects.create(group=self.group, status=MatchingJob.FAILED)
+        self.assertIn('no longer queued', run_matching_job(job.id, notify=False))
+        self.assertFalse(Match.objects.filter(group=self.group).exists())
+        job = claim_matching_job(self.group.id, total=6)
+        run_matching_job(job.id, notify=False)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress), (MatchingJob.DONE, 6))
+
+@mock.patch('groups.management.commands.match_groups.queue_notifications', return_value=(0, 0))
+class MatchGroupsCommandTests(TestCase):
+    """Bulk matching claims each ready group once and can pick up after a crash"""
+
+    def setUp(self):
+        cache.clear()
+        self.first, _, _ = seed_group(4, matched=False)
+        self.second, _, _ = seed_group(5, matched=False)
+        self.matched, _, _ = seed_group(7)
+
+    def match_groups(self, *args):
+        out = io.StringIO()
+        call_command('match_groups', '--workers', '1', *args, stdout=out)
+        return out.getvalue()
+
+    def notified(self, queue_notifications):
+        [(matches,), _] = queue_notifications.call_args
+        return set(matches.values_list('group_id', flat=True))
+
+    def test_matches_every_ready_group(self, queue_notifications):
+        self.assertIn('Matched 2 groups', self.match_groups())
+        for group in [self.first, self.second]:
+            group.refresh_from_db()
+            self.assertTrue(group.matching_done)
+            self.assertEqual(group.matching_jobs.get().status, MatchingJob.DONE)
+        self.assertFalse(self.matched.matching_jobs.exists())
+        self.assertEqual(self.notified(queue_notifications), {self.first.id, self.second.id})
+
+    def test_dry_run_saves_nothing(self, queue_notifications):
+        out = self.match_groups('--dry-run')
+        self.assertIn(f'{self.first.invite_code} {self.first.name}: would match 4 members', out)
+        self.assertIn('Dry run: 2 of 2 groups can be matched', out)
+        self.assertFalse(Match.objects.filter(group__in=[self.first, self.second]).exists())
+        self.assertFalse(MatchingJob.objects.exists())
+        queue_notifications.assert_not_called()
+
+    def test_resume_retries_dead_runs_and_notifies_the_rest(self, queue_notifications):
+        dead = MatchingJob.objects.create(group=self.first, status=MatchingJob.RUNNING)
+        MatchingJob.objects.filter(id=dead.id).update(updated_at=timezone.now() - MatchingJob.STALE_AFTER * 2)
+        MatchingJob.objects.create(group=self.second, status=MatchingJob.RUNNING)
+        self.assertIn('No groups are waiting', self.match_groups())
+
+        out = self.match_groups('--resume')
+        self.assertIn('Recovered 1 interrupted matching runs', out)
+        dead.refresh_from_db()
+        self.assertEqual(dead.status, MatchingJob.FAILED)
+        self.first.refresh_from_db()
+        self.assertTrue(self.first.matching_done)
+        # Still running elsewhere, so left alone
+        self.assertEqual(self.second.matching_jobs.count(), 1)
+        # The matched group never sent its emails
+        self.assertEqual(self.notified(queue_notifications), {self.first.id, self.matched.id})
+
+    def test_group_claimed_since_listing_is_skipped(self, queue_notifications):
+        MatchingJob.objects.create(group=self.second, status=MatchingJob.RUNNING)
+        self.assertFalse(match_group(self.second.id))
+        self.assertEqual(self.second.matching_jobs.count(), 1)
+        self.assertTrue(match_group(self.first.id))
+        self.assertFalse(match_group(self.first.id))
+
+class MatchingAlgorithmTests(SimpleTestCase):
+    """Algorithms work on integer indexes alone and can be timed and checked side by side"""
+
+    def benchmark(self, *args):
+        out = io.StringIO()
+        call_command('benchmark_matcher', *args, stdout=out)
+        return out.getvalue()
+
+    def test_every_algorithm_returns_a_permutation_reproducible_from_its_seed(self):
+        graph = ConstraintGraph(50)
+        for name, algorithm in ALGORITHMS.items():
+            with self.subTest(algorithm=name):
+                receivers = algorithm(graph, random.Random(7))
+                self.assertEqual(sorted(receivers), list(range(50)))
+                self.assertEqual(algorithm(graph, random.Random(7)), receivers)
+
+    def test_sattolo_makes_a_single_loop(self):
+        receivers = ALGORITHMS['sattolo'](ConstraintGraph(30), random.Random(1))
+        giver, seen = 0, set()
+        while giver not in seen:
+            seen.add(giver)
+            giver = receivers[giver]
+        self.assertEqual(len(seen), 30)
+
+    def test_benchmark_times_every_algorithm_and_flags_bias(self):
+        output = self.benchmark('--sizes', '10', '--repeat', '1', '--uniformity-size', '4', '--seed', '1')
+        timings, uniformity = output.split('Uniformity')
+        for name in ALGORITHMS:
+            self.assertRegex(timings, rf'{name} +10 .* 0\n')
+        # Swapping self-matches with the next slot favours some pairings
+        z = {line.split()[0]: float(line.split()[3]) for line in uniformity.splitlines()[2:]}
+        self.assertGreater(z['shuffle-swap'], 3)
+        self.assertLess(abs(z['sattolo']), 3)
+
+    def test_benchmark_catches_invalid_output(self):
+        with mock.patch.dict(ALGORITHMS, {'identity': lambda graph, rng: list(range(graph.size))}):
+            output = self.benchmark(
+                '--algorithms', 'identity', '--sizes', '10', '--repeat', '2', '--uniformity-samples', '0',
+            )
+        self.assertRegex(output, r'identity +10 .* 2\n')
+        with self.assertRaisesMessage(CommandError, 'Unknown algorithms: nope'):
+            self.benchmark('--algorithms', 'nope')
+
+class IncrementalMatchingTests(TestCase):
+    """Late joins and departures rewrite a constant number of matches"""
+
+    def setUp(self):
+        self.group, self.host, self.guest = seed_group(50)
+        self.newcomer = User.objects.create_user(username='newcomer')
+        Match.objects.filter(group=self.group).update(notification_sent=True)
+
+    def assertSingleCycleOver(self, members):
+        pairs = dict(Match.objects.filter(group=self.group).values_list('giver_id', 'receiver_id'))
+        self.assertEqual(set(pairs), set(members))
+        # Following the gifts from anyone visits everybody before coming back
+        start = giver = members[0]
+        length = 0
+        while True:
+            giver = pairs[giver]
+            length += 1
+            if giver == start or length > len(members):
+                break
+        self.assertEqual(length, len(members))
+
+    def members(self):
+        return list(self.group.members.values_list('user_id', flat=True))
+
+    def test_join_splices_two_matches(self):
+        Member.objects.create(group=self.group, user=self.newcomer)
+        matcher = SecretSantaMatcher(self.group)
+        with CaptureQueriesContext(connection) as queries:
+            notify = matcher.add_member(self.newcomer.id)
+        self.assertEqual(len(notify), 2)
+        self.assertSingleCycleOver(self.members())
+        unsent = Match.objects.filter(group=self.group, notification_sent=False)
+        self.assertEqual(sorted(unsent.values_list('id', flat=True)), sorted(notify))
+        # The pair is found through the giver index, not by counting and skipping rows
+        self.assertFalse([q['sql'] for q in queries if 'OFFSET' in q['sql'] or 'COUNT(' in q['sql']])
+        run = self.group.match_runs.latest('id')
+        self.assertEqual((run.kind, run.seed, run.splice_seed), (MatchRun.JOIN, self.group.match_seed, matcher.seed))
+
+    def test_cycle_check_spots_two_loops(self):
+        users = self.members()
+        Match.objects.filter(group=self.group).delete()
+        Match.objects.bulk_create([
+            Match(group=self.group, giver_id=giver, receiver_id=receiver)
+            for half in [users[:25], users[25:]]
+            for giver, receiver in zip(half, half[1:] + half[:1])
+        ])
+        with self.assertRaises(AssertionError):
+            self.assertSingleCycleOver(users)
+
+    def test_join_respects_exclusions(self):
+        Member.objects.create(group=self.group, user=self.newcomer)
+        others = [user_id for user_id in self.members() if user_id not in (self.newcomer.id, self.guest.id)]
+        Exclusion.objects.bulk_create([
+            Exclusion(group=self.group, giver=self.newcomer, receiver_id=user_id, mutual=False) for user_id in others
+        ])
+        SecretSantaMatcher(self.group).add_member(self.newcomer.id)
+        self.assertEqual(Match.objects.get(group=self.group, giver=self.newcomer).receiver_id, self.guest.id)
+        self.assertEqual(self.group.match_runs.latest('id').kind, MatchRun.JOIN)
+
+    def test_leave_closes_the_cycle(self):
+        santa_id = Match.objects.get(group=self.group, receiver=self.guest).giver_id
+        Member.objects.filter(group=self.group, user=self.guest).delete()
+        notify = SecretSantaMatcher(self.group).remove_member(self.guest.id)
+        self.assertEqual(notify, [Match.objects.get(group=self.group, giver_id=santa_id).id])
+        self.assertSingleCycleOver(self.members())
+        self.assertEqual(Match.objects.filter(group=self.group, notification_sent=False).count(), 1)
+
+    def test_leave_from_a_loop_of_two(self):
+        Match.objects.filter(group=self.group).delete()
+        users = self.members()
+        # 0 <-> 1 plus a separate loop over everyone else
+        pairs = [(users[0], users[1]), (users[1], users[0])]
+        rest = users[2:]
+        pairs += list(zip(rest, rest[1:] + rest[:1]))
+        Match.objects.bulk_create([
+            Match(group=self.group, giver_id=giver, receiver_id=receiver, notification_sent=True)
+            for giver, receiver in pairs
+        ])
+        Member.objects.filter(group=self.group, user_id=users[1]).delete()
+        notify = SecretSantaMatcher(self.group).remove_member(users[1])
+        self.assertEqual(len(notify), 2)
+        self.assertSingleCycleOver(self.members())
+
+    def test_views_allow_join_and_leave_after_matching(self):
+        self.client.force_login(self.newcomer)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('groups:join'), {'invite_code': self.group.invite_code})
+        self.assertTrue(Member.objects.filter(group=self.group, user=self.newcomer).exists())
+        self.assertEqual(len(callbacks), 1)
+        self.assertSingleCycleOver(self.members())
+
+        self.client.post(reverse('groups:leave', args=[self.group.invite_code]))
+        self.assertFalse(Member.objects.filter(group=self.group, user=self.newcomer).exists())
+        self.assertSingleCycleOver(self.members())
+
+@override_settings(NOTIFICATION_RATE_LIMITS={'example.com': (0.01, 3)})
+class NotificationDeliveryTests(TestCase):
+    """Sends are throttled per domain and never repeated for a delivered match"""
+
+    def setUp(self):
+        cache.clear()
+        self.group, self.host, self.guest = seed_group(5)
+        self.match_ids = list(Match.objects.filter(group=self.group).values_list('id', flat=True))
+
+    def send(self):
+        with mock.patch.object(send_match_notification_batch, 'apply_async') as reschedule:
+            send_match_notification_batch.apply(args=[self.match_ids])
+        return reschedule
+
+    def test_bucket_runs_dry_after_the_burst(self):
+        bucket = delivery.TokenBucket('example.com')
+        self.assertEqual([bucket.take() for _ in range(3)], [0, 0, 0])
+        self.assertGreater(bucket.take(), 90)
+        self.assertEqual(delivery.TokenBucket('other.example').take(), 0)
+
+    def test_sends_over_the_limit_are_rescheduled(self):
+        reschedule = self.send()
+        self.assertEqual(len(mail.outbox), 3)
+        [(args, kwargs)] = reschedule.call_args_list
+        self.assertEqual(len(args[0][0]), 2)
+        self.assertGreater(kwargs['countdown'], 90)
+        self.assertEqual(Match.objects.filter(id__in=self.match_ids, notification_sent=True).count(), 3)
+
+    @override_settings(NOTIFICATION_RATE_LIMITS={'example.com': (100, 100)})
+    def test_delivered_and_claimed_matches_are_not_resent(self):
+        first, second, *_ = Match.objects.filter(id__in=self.match_ids).order_by('id')
+        # Delivered by an attempt that died before recording it, and in flight elsewhere
+        delivery.mark_delivered(first)
+        self.assertTrue(delivery.claim(second))
+        self.send()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertNotIn(first.giver.email, [message.to[0] for message in mail.outbox])
+        first.refresh_from_db()
+        self.assertTrue(first.notification_sent)
+        self.send()
+        self.assertEqual(len(mail.outbox), 3)
+
+    @mock.patch('groups.tasks.NOTIFICATION_BATCH_SIZE', 2)
+    def test_unsent_matches_are_queued_in_batches(self):
+        Match.objects.filter(id=self.match_ids[0]).update(notification_sent=True)
+        with mock.patch.object(send_match_notification_batch, 'delay') as delay:
+            self.assertEqual(queue_notifications(Match.objects.filter(group=self.group)), (4, 2))
+        self.assertEqual([call.args[0] for call in delay.call_args_list], [self.match_ids[1:3], self.match_ids[3:]])
+
+    @override_settings(NOTIFICATION_RATE_LIMITS={'example.com': (100, 100)})
+    def test_a_batch_shares_one_connection_and_a_fixed_number_of_queries(self):
+        def send(match_ids):
+            with mock.patch('groups.tasks.get_connection', wraps=get_connection) as connect:
+                with CaptureQueriesContext(connection) as queries:
+                    send_match_notification_batch.apply(args=[match_ids])
+            self.assertEqual(connect.call_count, 1)
+            return len(queries)
+
+        self.assertEqual(send(self.match_ids[:2]), send(self.match_ids[2:]))
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertFalse(Match.objects.filter(id__in=self.match_ids, notification_sent=False).exists())
+
+    def test_single_sends_are_retried(self):
+        match = Match.objects.get(id=self.match_ids[0])
+        backend = 'django.core.mail.backends.locmem.EmailBackend.send_messages'
+        with mock.patch(backend, side_effect=[SMTPException('Connection lost'), 1]) as send:
+            send_match_notification.apply(args=[match.id])
+        self.assertEqual(send.call_count, 2)
+        match.refresh_from_db()
+        self.assertTrue(match.notification_sent)
+
+    def test_givers_without_an_email_are_settled(self):
+        match = Match.objects.select_related('giver').get(id=self.match_ids[0])
+        User.objects.filter(id=match.giver_id).update(email='')
+        self.send()
+        self.assertNotIn(match.giver.email, [message.to[0] for message in mail.outbox])
+        self.assertFalse(Match.objects.filter(id=match.id, notification_sent=False).exists())
+        self.assertEqual(queue_notifications(Match.objects.filter(id=match.id)), (0, 0))
+
+    def test_lock_waiter_leaves_the_holders_lock_alone(self):
+        cache.add('delivery:test:lock', 'holder', 60)
+        with delivery._cache_lock('delivery:test', timeout=0.05):
+            pass
+        self.assertEqual(cache.get('delivery:test:lock'), 'holder')
+        cache.delete('delivery:test:lock')
+        with delivery._cache_lock('delivery:test'):
+            self.assertIsNotNone(cache.get('delivery:test:lock'))
+        self.assertIsNone(cache.get('delivery:test:lock'))
+
+class GroupApiTests(TestCase):
+    """The JSON API mirrors the page flows and supports cheap polling"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.group, cls.host, cls.guest = seed_group(30)
+        cls.outsider = User.objects.create_user(username='outsider')
+
+    def setUp(self):
+        self.client.force_login(self.guest)
+        self.url = reverse('api:group-detail', args=[self.group.invite_code])
+
+    def test_conditional_get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.json()['member_count'], 30)
+        etag = response['ETag']
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        self.client.patch(
+            reverse('api:group-wishlist', args=[self.group.invite_code]),
+            {'items': [{'item': 'Kite'}]}, content_type='application/json',
+        )
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_field_selection(self):
+        response = self.client.get(self.url, {'fields': 'name,matching_done'})
+        self.assertEqual(response.json(), {'name': self.group.name, 'matching_done': True})
+
+    def test_members_cursor_pagination(self):
+        url = reverse('api:group-members', args=[self.group.invite_code])
+        seen = []
+        while url:
+            page = self.client.get(url, {'page_size': 7} if not seen else None).json()
+            seen += [member['user']['id'] for member in page['results']]
+            url = page['next']
+        self.assertEqual(seen, list(self.group.members.order_by('id').values_list('user_id', flat=True)))
+
+    def test_my_match(self):
+        response = self.client.get(reverse('api:group-my-match', args=[self.group.invite_code]))
+        match = Match.objects.get(group=self.group, giver=self.guest)
+        self.assertEqual(response.json()['receiver']['id'], match.receiver_id)
+
+    def test_my_match_etag_changes_once_notified(self):
+        url = reverse('api:group-my-match', args=[self.group.invite_code])
+        response = self.client.get(url)
+        self.assertFalse(response.json()['notification_sent'])
+
+        match = Match.objects.get(group=self.group, giver=self.guest)
+        with mock.patch.object(send_match_notification_batch, 'apply_async'):
+            send_match_notification_batch.apply(args=[[match.id]])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['notification_sent'])
+
+    def test_outsider_cannot_see_group(self):
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_join_after_matching(self):
+        self.client.force_login(self.outsider)
+        with self.captureOnCommitCallbacks():
+            response = self.client.post(reverse('api:group-join'), {'invite_code': self.group.invite_code})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['member_count'], 31)
+        self.assertTrue(Match.objects.filter(group=self.group, giver=self.outsider).exists())
+
+    def test_join_resolves_the_code_from_the_cache(self):
+        self.client.force_login(self.outsider)
+        group_id_for(self.group.invite_code)
+        with self.captureOnCommitCallbacks(), CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('api:group-join'), {'invite_code': self.group.invite_code})
+        lookups = [q['sql'] for q in queries if '"invite_code" = ' in q['sql']]
+        self.assertEqual(lookups, [])
+
+        response = self.client.post(reverse('api:group-join'), {'invite_code': 'nope'})
+        self.assertEqual(response.status_code, 404)
+
+class MemberImportTests(TestCase):
+    """Bulk imports create users, upsert members in batches and report bad rows"""
+
+    def setUp(self):
+        cache.clear()
+        self.host = User.objects.create_user(username='host')
+        self.group = Group.objects.create(name='Org', host=self.host)
+
+    def test_csv_import(self):
+        bob = User.objects.create_user(username='bob', first_name='Robert', email='robert@example.com')
+        Member.objects.create(group=self.group, user=bob)
+        csv = (
+            'username,email,first_name,wishlist,team,exclude\n'
+            'alice,alice@example.com,Alice,"Socks\nMug",Sales,bob;carol\n'
+            'bob,bob@example.com,Bob,,Sales,\n'
+            'not valid!,x@example.com,,,,\n'
+            'carol,not-an-email,,,,\n'
+            'dave,,,,,nobody\n'
+        )
+        report = import_members(self.group, io.StringIO(csv), batch_size=2)
+        self.assertEqual(report.rows, 5)
+        self.assertEqual(report.members_added, 2)
+        self.assertEqual(report.users_created, 2)
+        # carol's row is invalid, so alice's rule against her can't be saved either
+        self.assertEqual(sorted(line for line, _ in report.errors), [3, 5, 6, 7])
+        # bob's membership is updated, his account is not
+        bob.refresh_from_db()
+        self.assertEqual((bob.first_name, bob.email), ('Robert', 'robert@example.com'))
+        self.assertEqual(Member.objects.get(group=self.group, user=bob).team, 'Sales')
+        self.assertEqual(
+            list(WishlistItem.objects.filter(group=self.group, user__username='alice').values_list('item', flat=True)),
+            ['Socks', 'Mug'],
+        )
+        self.assertEqual(
+            list(Exclusion.objects.filter(group=self.group).values_list('giver__username', 'receiver__username')),
+            [('alice', 'bob')],
+        )
+
+    def test_jsonl_reimport_updates_in_place(self):
+        lines = ['{"username": "erin", "team": "Ops", "exclude": ["frank"]}\n', '{"username": "frank"}\n']
+        import_members(self.group, lines, 'jsonl')
+        report = import_members(self.group, ['{"username": "erin", "team": "Support"}\n', '[1]\n'], 'jsonl')
+        self.assertEqual((report.members_added, report.members_updated, report.error_count), (0, 1, 1))
+        self.assertEqual(Member.objects.get(group=self.group, user__username='erin').team, 'Support')
+        self.assertEqual(Exclusion.objects.filter(group=self.group).count(), 1)
+
+    def test_clears_cached_membership(self):
+        user = User.objects.create_user(username='gina')
+        self.assertFalse(is_member(self.group.id, user.id))
+        import_members(self.group, io.StringIO('username\ngina\n'), update_users=True)
+        self.assertTrue(is_member(self.group.id, user.id))
+
+    def test_host_import_cannot_touch_other_accounts(self):
+        victim = User.objects.create_user(username='victim', first_name='Vic', email='victim@example.com')
+        Member.objects.create(group=self.group, user=self.host)
+        self.client.force_login(self.host)
+        upload = SimpleUploadedFile('people.csv', b'username,email,first_name\nvictim,evil@example.com,Evil\n')
+        response = self.client.post(reverse('api:group-bulk-import', args=[self.group.invite_code]), {'file': upload})
+        self.assertEqual((response.json()['members_added'], response.json()['error_count']), (0, 1))
+        victim.refresh_from_db()
+        self.assertEqual((victim.email, victim.first_name), ('victim@example.com', 'Vic'))
+        self.assertFalse(Member.objects.filter(group=self.group, user=victim).exists())
+
+    def test_command_updates_existing_accounts(self):
+        user = User.objects.create_user(username='ivy', email='old@example.com')
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as upload:
+            upload.write('username,email\nivy,new@example.com\n')
+            upload.flush()
+            call_command('import_members', self.group.invite_code, upload.name, stdout=io.StringIO())
+        user.refresh_from_db()
+        self.assertEqual(user.email, 'new@example.com')
+        self.assertTrue(Member.objects.filter(group=self.group, user=user).exists())
+
+    def test_api_import_is_host_only(self):
+        url = reverse('api:group-bulk-import', args=[self.group.invite_code])
+        upload = SimpleUploadedFile('people.csv', b'username,email\nhank,hank@example.com\n')
+        guest = User.objects.create_user(username='guest')
+        Member.objects.bulk_create([Member(group=self.group, user=self.host), Member(group=self.group, user=guest)])
+        self.client.force_login(guest)
+        self.assertEqual(self.client.post(url, {'file': upload}).status_code, 403)
+
+        upload.seek(0)
+        self.client.force_login(self.host)
+        response = self.client.post(url, {'file': upload})
+        self.assertEqual(response.json()['members_added'], 1)
+
+class MatchExportTests(TestCase):
+    """Hosts can download the full match manifest as CSV or JSONL"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.group, cls.host, cls.guest = seed_group(12)
+
+    def export(self, user, **params):
+        self.client.force_login(user)
+        return self.client.get(reverse('groups:export', args=[self.group.invite_code]), params)
+
+    def test_csv(self):
+        response = self.export(self.host)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 12)
+        match = Match.objects.select_related('giver', 'receiver').get(group=self.group, giver=self.guest)
+        row = next(row for row in rows if row['giver_username'] == self.guest.username)
+        self.assertEqual(row['receiver_username'], match.receiver.username)
+        items = WishlistItem.objects.filter(group=self.group, user=match.receiver)
+        self.assertEqual(row['receiver_wishlist'], '\n'.join(item.item for item in items))
+
+    def test_jsonl(self):
+        response = self.export(self.host, format='jsonl')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual({json.loads(line)['giver_username'] for line in lines},
+                         set(self.group.members.values_list('user__username', flat=True)))
+
+    def test_host_only(self):
+        response = self.export(self.guest)
+        self.assertRedirects(response, reverse('groups:detail', args=[self.group.invite_code]), fetch_redirect_response=False)
+
+class WishlistTests(TestCase):
+    """Wishlists are stored as items, edited as text and searchable by the host"""
+
+    def setUp(self):
+        cache.clear()
+        self.group, self.host, self.guest = seed_group(6, matched=False)
+        self.url = reverse('groups:edit_wishlist', args=[self.group.invite_code])
+
+    def test_parse(self):
+        self.assertEqual(wishlists.parse(
+            '1. Wool socks | about $15\n\n- Mug | https://example.com/mug\nBook https://example.com/book here\n3.5mm cable'
+        ), [
+            {'item': 'Wool socks', 'price_hint': 'about $15', 'link': ''},
+            {'item': 'Mug', 'price_hint': '', 'link': 'https://example.com/mug'},
+            {'item': 'Book here', 'price_hint': '', 'link': 'https://example.com/book'},
+            {'item': '3.5mm cable', 'price_hint': '', 'link': ''},
+        ])
+
+    def test_edit_round_trip(self):
+        self.client.force_login(self.guest)
+        self.client.post(self.url, {'wishlist': 'Kite | $20\nScarf | https://example.com/scarf'})
+        member = Member.objects.get(group=self.group, user=self.guest)
+        self.assertEqual(
+            list(wishlists.items_of(member).values_list('position', 'item', 'price_hint', 'link')),
+            [(0, 'Kite', '$20', ''), (1, 'Scarf', '', 'https://example.com/scarf')],
+        )
+        self.assertContains(self.client.get(self.url), 'Kite | $20\nScarf | https://example.com/scarf')
+        for invalid in ['Kite | | https://-bad-.example', '\n'.join(['Kite'] * (wishlists.MAX_ITEMS + 1))]:
+            response = self.client.post(self.url, {'wishlist': invalid})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(wishlists.items_of(member).count(), 2)
+
+    def test_search(self):
+        member = Member.objects.get(group=self.group, user=self.guest)
+        wishlists.replace(member, wishlists.parse('Striped wool sock\nDark chocolate'))
+        other = Group.objects.create(name='Other', host=self.host)
+        wishlists.replace(Member.objects.create(group=other, user=self.host), wishlists.parse('Wool socks'))
+        self.assertEqual([item.item for item in wishlists.search(self.group, 'socks wool')], ['Striped wool sock'])
+        self.assertEqual(list(wishlists.search(self.group, '"chocolate')), list(wishlists.items_of(member).filter(position=1)))
+        self.assertFalse(wishlists.search(self.group, 'kite'))
+        WishlistItem.objects.filter(item='Dark chocolate').update(item='Kite')
+        self.assertEqual([item.item for item in wishlists.search(self.group, 'kite')], ['Kite'])
+
+    def test_api_search_is_host_only(self):
+        url = reverse('api:group-wishlist-search', args=[self.group.invite_code])
+        self.client.force_login(self.guest)
+        self.assertEqual(self.client.get(url, {'q': 'mug'}).status_code, 403)
+        self.client.force_login(self.host)
+        results = self.client.get(url, {'q': 'mug'}).json()
+        self.assertEqual(len(results), 3)
+        self.assertEqual(set(results[0]), {'user', 'item', 'price_hint', 'link'})
+
+class GroupCounterTests(TestCase):
+    """Stored member, wishlist and match counters follow every change"""
+
+    def setUp(self):
+        cache.clear()
+        self.group, self.host, self.guest = seed_group(10)
+        self.newcomer = User.objects.create_user(username='newcomer')
+
+    def assertCounts(self, members, wishlists, matched):
+        self.group.refresh_from_db()
+        self.assertEqual(
+            (self.group.member_count, self.group.wishlist_count, self.group.matched_count),
+            (members, wishlists, matched),
+        )
+
+    def test_counts_follow_joins_wishlists_and_leaves(self):
+        self.assertCounts(10, 5, 10)
+        self.client.force_login(self.newcomer)
+        self.client.post(reverse('groups:join'), {'invite_code': self.group.invite_code})
+        self.assertCounts(11, 5, 11)
+        self.client.post(reverse('groups:edit_wishlist', args=[self.group.invite_code]), {'wishlist': 'Tea'})
+        self.assertCounts(11, 6, 11)
+        self.client.post(reverse('groups:leave', args=[self.group.invite_code]))
+        self.assertCounts(10, 5, 10)
+
+    def test_wishlist_and_counter_change_together(self):
+        self.client.force_login(self.newcomer)
+        self.client.post(reverse('groups:join'), {'invite_code': self.group.invite_code})
+        url = reverse('groups:edit_wishlist', args=[self.group.invite_code])
+        with mock.patch.object(Group, 'adjust_counts', side_effect=RuntimeError('crashed')):
+            with self.assertRaises(RuntimeError):
+                self.client.post(url, {'wishlist': 'Tea'})
+        self.assertFalse(WishlistItem.objects.filter(group=self.group, user=self.newcomer).exists())
+        self.assertCounts(11, 5, 11)
+
+    def test_pages_and_api_leave_nothing_to_reconcile(self):
+        self.client.force_login(self.newcomer)
+        self.client.post(reverse('api:group-join'), {'invite_code': self.group.invite_code})
+        url = reverse('api:group-wishlist', args=[self.group.invite_code])
+        for items in [[{'item': 'Tea'}], [{'item': 'Tea'}, {'item': 'Mug'}], []]:
+            self.client.put(url, {'items': items}, content_type='application/json')
+        self.client.post(reverse('groups:edit_wishlist', args=[self.group.invite_code]), {'wishlist': 'Scarf'})
+        self.client.post(reverse('api:group-leave', args=[self.group.invite_code]))
+        self.group.refresh_from_db()
+        stored = (self.group.member_count, self.group.wishlist_count, self.group.matched_count)
+        self.assertEqual(tuple(self.group.reconcile_counts().values()), stored)
+
+    def test_reconcile_command_fixes_drift(self):
+        Group.objects.filter(id=self.group.id).update(member_count=3, matched_count=0)
+        out = io.StringIO()
+        call_command('reconcile_counters', '--dry-run', stdout=out)
+        self.assertIn('member_count 3 -> 10', out.getvalue())
+        self.assertCounts(3, 5, 0)
+        call_command('reconcile_counters', self.group.invite_code, stdout=io.StringIO())
+        self.assertCounts(10, 5, 10)
+
+class GroupEventTests(TestCase):
+    """Group changes are published for the live page once they commit"""
+
+    def setUp(self):
+        cache.clear()
+        self.group, self.host, self.guest = seed_group(10, matched=False)
+        self.newcomer = User.objects.create_user(username='newcomer', first_name='Noel')
+
+    def test_stream_is_for_members_and_off_without_redis(self):
+        url = reverse('groups:events', args=[self.group.invite_code])
+        self.client.force_login(self.newcomer)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_login(self.guest)
+        with self.settings(EVENTS_REDIS_URL=''):
+            self.assertEqual(self.client.get(url).status_code, 204)
+
+    @override_settings(EVENTS_REDIS_URL='redis://localhost:6379/0')
+    async def test_stream_is_only_served_under_asgi(self):
+        async def stream(group_id, snapshot):
+            yield events.encode('snapshot', await snapshot())
+
+        url = reverse('groups:events', args=[self.group.invite_code])
+        # The test client is WSGI, where a stream would hold a worker for minutes
+        await self.client.aforce_login(self.guest)
+        self.assertEqual((await sync_to_async(self.client.get)(url)).status_code, 204)
+
+        await self.async_client.aforce_login(self.guest)
+        with mock.patch.object(events, 'stream', stream):
+            response = await self.async_client.get(url)
+            self.assertEqual(response.status_code, 200)
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertIn(b'"member_count": 10', body)
+
+    @override_settings(EVENTS_REDIS_URL='redis://localhost:6379/0')
+    def test_join_and_wishlist_publish_on_commit(self):
+        self.client.force_login(self.newcomer)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('groups:join'), {'invite_code': self.group.invite_code})
+            self.client.post(reverse('groups:edit_wishlist', args=[self.group.invite_code]), {'wishlist': 'Tea'})
+        published = [(c.args, c.keywords) for c in callbacks if getattr(c, 'func', None) is events.publish_now]
+        self.assertEqual([args for args, _ in published], [
+            (self.group.id, events.MEMBER_JOINED), (self.group.id, events.WISHLIST_UPDATED),
+        ])
+        joined, wishlist = (data for _, data in published)
+        self.assertEqual(joined['participant']['name'], 'Noel')
+        self.assertEqual((joined['member_count'], wishlist['wishlist_count']), (11, 6))
+
+    @override_settings(EVENTS_REDIS_URL='redis://localhost:6379/0')
+    def test_wishlist_event_counts_come_from_the_database(self):
+        # The header is cached before someone else's join reaches the counters
+        for _ in range(2):
+            group_header(self.group.invite_code)
+        Group.objects.filter(id=self.group.id).update(member_count=F('member_count') + 1)
+        self.client.force_login(self.guest)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('groups:edit_wishlist', args=[self.group.invite_code]), {'wishlist': 'Tea'})
+        [data] = [c.keywords for c in callbacks if getattr(c, 'func', None) is events.publish_now]
+        self.group.refresh_from_db()
+        self.assertEqual(
+            (data['member_count'], data['wishlist_count']), (self.group.member_count, self.group.wishlist_count),
+        )
+        self.assertEqual(data['member_count'], 11)
+
+    @override_settings(EVENTS_REDIS_URL='redis://localhost:6379/0')
+    def test_membership_event_counts_are_the_stored_ones(self):
+        group = Group.objects.get(id=self.group.id)
+        # Someone else joins after this copy was loaded
+        add_member(Group.objects.get(id=self.group.id), User.objects.create_user(username='early'))
+        with self.captureOnCommitCallbacks() as callbacks:
+            add_member(group, self.newcomer)
+        [data] = [c.keywords for c in callbacks if getattr(c, 'func', None) is events.publish_now]
+        self.assertEqual(data['member_count'], 12)
+
+    def test_event_encoding(self):
+        self.assertEqual(events.encode('member_left', {'user_id': 3}), 'event: member_left\ndata: {"user_id": 3}\n\n')
+
+class GroupListingTests(TestCase):
+    """My groups and the profile list any number of groups in one query"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='regular')
+        cls.other = User.objects.create_user(username='other')
+        Group.objects.bulk_create([
+            Group(name=f'Group {i}', host=cls.user if i % 3 == 0 else cls.other, invite_code=f'LIST{i:04d}', member_count=2)
+            for i in range(GROUPS_PAGE_SIZE + 6)
+        ])
+        groups = list(Group.objects.order_by('id'))
+        Member.objects.bulk_create(
+            [Member(group=group, user=cls.user) for group in groups]
+            + [Member(group=group, user=cls.other) for group in groups]
+        )
+        Match.objects.create(group=groups[-1], giver=cls.user, receiver=cls.other)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_keyset_pages_cover_every_group_once(self):
+        with self.assertNumQueries(2):
+            first = self.client.get(reverse('groups:my_groups'))
+        groups = first.context['groups']
+        self.assertEqual(len(groups), GROUPS_PAGE_SIZE)
+        self.assertTrue(groups[0].has_match)
+        self.assertEqual(sum(group.is_host for group in groups), sum(group.host_id == self.user.id for group in groups))
+
+        with self.assertNumQueries(2):
+            second = self.client.get(reverse('groups:my_groups'), {'after': first.context['next_cursor']})
+        self.assertIsNone(second.context['next_cursor'])
+        ids = [group.id for group in groups + second.context['groups']]
+        self.assertEqual(ids, list(Group.objects.order_by('-id').values_list('id', flat=True)))
+
+    async def test_pages_run_natively_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+        group = await Group.objects.order_by('-id').afirst()
+        for url in [
+            reverse('groups:my_groups'),
+            reverse('groups:detail', args=[group.invite_code]),
+            reverse('groups:my_match', args=[group.invite_code]),
+        ]:
+            response = await self.async_client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+        self.assertEqual(response.context['receiver'].id, self.other.id)
+
+    def test_profile_counts_with_the_listing(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('accounts:profile'))
+        self.assertEqual(response.context['total_groups'], GROUPS_PAGE_SIZE + 6)
+        self.assertContains(response, 'your match is ready', count=1)
+
+class FragmentCacheTests(TestCase):
+    """Participant lists and group cards are rendered once per group version"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.group, cls.host, cls.guest = seed_group(6)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_participant_list_is_shared_until_the_group_changes(self):
+        url = reverse('groups:detail', args=[self.group.invite_code])
+        self.client.force_login(self.guest)
+        self.assertContains(self.client.get(url), 'Elf 2')
+        User.objects.filter(first_name='Elf 2').update(first_name='Rudolph')
+        self.client.force_login(self.host)
+        response = self.client.get(url)
+        self.assertContains(response, 'Elf 2')
+        # The fragment is shared; only the "You" badge follows the viewer
+        self.assertContains(response, f'var userId = {self.host.id};')
+        bump_group_version(self.group.id)
+        self.assertContains(self.client.get(url), 'Rudolph')
+
+    def test_warm_page_does_not_load_the_participants(self):
+        url = reverse('groups:detail', args=[self.group.invite_code])
+        self.client.force_login(self.guest)
+        self.client.get(url)
+        with mock.patch('groups.views.aparticipant_list', side_effect=AssertionError('participants loaded')):
+            response = self.client.get(url)
+        self.assertContains(response, 'Elf 2')
+        self.assertContains(response, f'data-user-id="{self.host.id}"')
+
+    @mock.patch('groups.caching.PARTICIPANTS_SHOWN', 4)
+    @mock.patch('groups.views.PARTICIPANTS_SHOWN', 4)
+    def test_large_lists_show_the_oldest_and_page_through_the_api(self):
+        url = reverse('groups:detail', args=[self.group.invite_code])
+        self.client.force_login(self.guest)
+        response = self.client.get(url)
+        shown = list(self.group.members.order_by('id').values_list('user_id', flat=True))
+        for user_id in shown[:4]:
+            self.assertContains(response, f'<div class="col-md-6" data-user-id="{user_id}">')
+        for user_id in shown[4:]:
+            self.assertNotContains(response, f'<div class="col-md-6" data-user-id="{user_id}">')
+        members_url = reverse('api:group-members', args=[self.group.invite_code])
+        self.assertContains(response, f'data-url="{members_url}?page_size=4&amp;fields=id"')
+
+        # The API's first page is the one shown; its cursor leads to the rest
+        page = self.client.get(members_url, {'page_size': 4, 'fields': 'id'}).json()
+        rest = self.client.get(page['next'].replace('fields=id', '')).json()
+        self.assertEqual([member['user']['id'] for member in rest['results']], shown[4:])
+
+    def test_detail_queries_do_not_grow_with_the_group(self):
+        bigger, _, bigger_guest = seed_group(40)
+
+        def queries(group, viewer):
+            cache.clear()
+            self.client.force_login(viewer)
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(self.client.get(reverse('groups:detail', args=[group.invite_code])).status_code, 200)
+            return len(captured)
+
+        self.assertEqual(queries(self.group, self.guest), queries(bigger, bigger_guest))
+
+    def test_joins_leaves_wishlists_and_matching_refresh_the_participants(self):
+        group, host, guest = seed_group(4, matched=False)
+        newcomer = User.objects.create_user(username='newcomer', first_name='Noel')
+        url = reverse('groups:detail', args=[group.invite_code])
+        self.client.force_login(host)
+        self.assertNotContains(self.client.get(url), 'Noel')
+        versions = [group_version(group.id)]
+
+        def changed():
+            versions.append(group_version(group.id))
+            return versions[-1] != versions[-2]
+
+        member = add_member(Group.objects.get(id=group.id), newcomer)
+        self.assertTrue(changed())
+        self.assertContains(self.client.get(url), 'Noel')
+        set_wishlist(Group.objects.get(id=group.id), member, [{'item': 'Tea'}])
+        self.assertTrue(changed())
+        remove_member(Group.objects.get(id=group.id), member)
+        self.assertTrue(changed())
+        self.assertNotContains(self.client.get(url), 'Noel')
+        run_matching_job(claim_matching_job(group.id).id, notify=False)
+        self.assertTrue(changed())
+        self.assertContains(self.client.get(url), 'Matching Complete')
+
+    def test_group_cards_follow_the_viewer_and_the_group(self):
+        url = reverse('groups:my_groups')
+        self.client.force_login(self.host)
+        self.assertContains(self.client.get(url), 'Open Group')
+        self.client.force_login(self.guest)
+        response = self.client.get(url)
+        self.assertContains(response, 'View Group')
+        self.assertNotContains(response, 'Open Group')
+        Group.objects.filter(id=self.group.id).update(name='Renamed')
+        self.assertNotContains(self.client.get(url), 'Renamed')
+        bump_group_version(self.group.id)
+        self.assertContains(self.client.get(url), 'Renamed')
+
+class InviteCodeTests(TestCase):
+    """Invite codes are drawn until unused and resolved through the cache"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.group, cls.host, cls.guest = seed_group(4)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_codes_are_redrawn_when_taken(self):
+        self.assertRegex(self.group.invite_code, rf'^[{INVITE_CODE_ALPHABET}]{{{INVITE_CODE_LENGTH}}}$')
+        codes = [self.group.invite_code, 'FRESHC0DE123']
+        with mock.patch('groups.models.generate_invite_code', side_effect=codes):
+            group = Group.objects.create(name='Second', host=self.host)
+        self.assertEqual(group.invite_code, 'FRESHC0DE123')
+        with mock.patch('groups.models.generate_invite_code', return_value=self.group.invite_code):
+            with self.assertRaises(IntegrityError):
+                Group.objects.create(name='Third', host=self.host)
+
+    def test_pages_share_the_cached_header(self):
+        self.client.force_login(self.guest)
+        urls = [
+            reverse('groups:detail', args=[self.group.invite_code]),
+            reverse('groups:my_match', args=[self.group.invite_code]),
+            reverse('groups:matching_status', args=[self.group.invite_code]),
+        ]
+        for url in urls:
+            self.client.get(url)
+        # Neither the code nor the group is looked up again
+        with CaptureQueriesContext(connection) as queries:
+            for url in urls:
+                self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse([query for query in queries if 'FROM "groups_group"' in query['sql']])
+        self.assertEqual(self.client.get(reverse('groups:detail', args=['no such code'])).status_code, 404)
+
+    @override_settings(DATABASE_ROUTERS=['config.db_routers.ReplicaRouter'])
+    def test_cached_reads_come_from_the_primary(self):
+        # No replica is configured here, so any read routed to it fails
+        def view(request):
+            group_header(self.group.invite_code)
+            participant_list(group_header(self.group.invite_code))
+            return is_member(self.group.id, self.guest.id)
+        self.assertTrue(read_replica(view)(RequestFactory().get('/')))
+
+    def test_deleted_group_is_forgotten(self):
+        group = Group.objects.create(name='Short-lived', host=self.host)
+        Member.objects.create(group=group, user=self.host)
+        self.client.force_login(self.host)
+        url = reverse('groups:detail', args=[group.invite_code])
+        self.client.get(url)
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('groups:delete', args=[group.invite_code]))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+class CacheSettingsTests(TestCase):
+    """The services every process shares are configured from the environment"""
+
+    def load_settings(self, module, **env):
+        # Settings are read once per process, so each variant is imported in a fresh one
+        return subprocess.run(
+            [sys.executable, '-c', f'import json, {module} as s; print(json.dumps([s.CACHES["default"], s.SESSION_ENGINE]))'],
+            cwd=settings.BASE_DIR, env={**os.environ, 'SECRET_KEY': 'x', 'ALLOWED_HOSTS': 'example.com', **env},
+            capture_output=True, text=True,
+        )
+
+    def test_production_requires_a_shared_cache(self):
+        result = self.load_settings('config.settings_production', REDIS_URL='')
+        self.assertIn('ImproperlyConfigured: REDIS_URL must be set', result.stderr)
+        result = self.load_settings('config.settings_production', REDIS_URL='redis://localhost:6379/0')
+        self.assertEqual(json.loads(result.stdout)[0]['BACKEND'], 'config.metrics.RedisCache')
+
+    def test_redis_cache_and_cached_sessions_come_from_the_environment(self):
+        result = self.load_settings('config.settings', REDIS_URL='redis://cache:6379/1', CACHE_KEY_PREFIX='elves')
+        caches, sessions = json.loads(result.stdout)
+        self.assertEqual(caches, {
+            'BACKEND': 'config.metrics.RedisCache', 'LOCATION': 'redis://cache:6379/1', 'KEY_PREFIX': 'elves',
+        })
+        self.assertEqual(sessions, 'django.contrib.sessions.backends.cached_db')
+        caches, _ = json.loads(self.load_settings('config.settings', REDIS_URL='').stdout)
+        self.assertEqual(caches['BACKEND'], 'config.metrics.LocMemCache')
+
+    def test_sessions_and_memberships_are_read_from_the_cache(self):
+        group, host, guest = seed_group(3)
+        self.assertEqual(membership_key(group.id, guest.id), f'group:{group.id}:member:{guest.id}')
+        self.client.force_login(guest)
+        url = reverse('groups:detail', args=[group.invite_code])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse([q['sql'] for q in queries if 'django_session' in q['sql'] or 'groups_member' in q['sql']])
+
+    @skipIf(find_spec('psycopg_pool'), 'psycopg 3 with its pool is installed')
+    def test_pool_requires_psycopg_3(self):
+        result = self.load_settings('config.settings', DB_HOST='db.example.com', DB_POOL='true')
+        self.assertIn('ImproperlyConfigured: DB_POOL requires psycopg 3', result.stderr)
+        result = self.load_settings('config.settings', DB_HOST='db.example.com', DB_POOL='false')
+        self.assertEqual(result.returncode, 0)
+
+@override_settings(METRICS_TOKEN='scrape-token')
+class MetricsTests(TestCase):
+    """Requests and tasks are counted per view or task and served to Prometheus"""
+
+    def setUp(self):
+        # Drop whatever earlier tests left unflushed
+        metrics.flush()
+        cache.clear()
+        self.group, self.host, self.guest = seed_group(10)
+
+    def scrape(self, token='scrape-token', **extra):
+        return self.client.get(reverse('metrics'), HTTP_AUTHORIZATION=f'Bearer {token}', **extra)
+
+    def test_views_are_measured(self):
+        self.client.force_login(self.guest)
+        for _ in range(2):
+            self.client.get(reverse('groups:detail', args=[self.group.invite_code]))
+        self.client.get('/no-such-page/')
+        body = self.scrape().content.decode()
+        self.assertIn('santa_requests_total{view="groups:detail",status="2xx"} 2', body)
+        self.assertIn('santa_requests_total{view="unmatched",status="4xx"} 1', body)
+        self.assertIn('santa_request_duration_seconds_bucket{view="groups:detail",le="+Inf"} 2', body)
+        self.assertIn('# TYPE santa_request_duration_seconds histogram', body)
+        self.assertRegex(body, r'santa_request_db_queries_total\{view="groups:detail"\} [1-9]')
+        self.assertRegex(body, r'santa_request_cache_hits_total\{view="groups:detail"\} [1-9]')
+
+    def test_tasks_are_measured(self):
+        from .tasks import send_match_notification
+        send_match_notification.apply(args=[Match.objects.filter(group=self.group).first().id])
+        body = self.scrape().content.decode()
+        self.assertIn('santa_tasks_total{task="groups.tasks.send_match_notification",state="SUCCESS"} 1', body)
+        self.assertRegex(body, r'santa_task_db_queries_total\{task="groups.tasks.send_match_notification"\} [1-9]')
+
+    def test_endpoint_needs_the_token_or_an_allowed_address(self):
+        # The test client comes from 127.0.0.1, which is not trusted by default
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+        self.assertEqual(self.scrape('guess').status_code, 404)
+        with self.settings(METRICS_TOKEN=''):
+            self.assertEqual(self.scrape('').status_code, 404)
+        with self.settings(METRICS_ALLOWED_IPS=['10.0.0.5']):
+            self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.5').status_code, 200)
+            self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.9').status_code, 404)
+
+    def test_slow_queries_are_logged(self):
+        self.client.force_login(self.guest)
+        with self.settings(METRICS_SLOW_QUERY_MS=0.000001), self.assertLogs('config.metrics.slow_queries') as logs:
+            self.client.get(reverse('groups:detail', args=[self.group.invite_code]))
+        self.assertIn('in groups:detail: SELECT', '\n'.join(logs.output))
+
+class GroupViewPerformanceTests(ViewBenchmarkMixin, TestCase):
+    """Query count, latency and memory of every groups view across group sizes"""
+    baseline_file = Path(__file__).with_name('perf_baselines.json')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sized_groups = {size: seed_group(size) for size in benchmark_sizes()}
+        cls.outsider = User.objects.create_user(username='outsider')
+
+    def each_group(self):
+        for size, (group, host, guest) in self.sized_groups.items():
+            with self.subTest(size=size):
+                yield size, group, host, guest
+
+    def reopen(self, group):
+        """Setup hook putting a matched group back into its pre-matching state"""
+        return lambda: Group.objects.filter(id=group.id).update(matching_done=False)
+
+    def test_my_groups(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(host)
+            response = self.benchmark('groups:my_groups', size, 'get', reverse('groups:my_groups'))
+            self.assertEqual(response.status_code, 200)
+
+    def test_create(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(host)
+            self.benchmark('groups:create GET', size, 'get', reverse('groups:create'))
+            response = self.benchmark('groups:create POST', size, 'post', reverse('groups:create'), {'name': 'New group'})
+            self.assertEqual(response.status_code, 302)
+
+    def test_join(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(self.outsider)
+            self.benchmark('groups:join_with_code', size, 'get', reverse('groups:join_with_code', args=[group.invite_code]))
+            response = self.benchmark(
+                'groups:join POST', size, 'post', reverse('groups:join'),
+                {'invite_code': group.invite_code}, setup=self.reopen(group),
+            )
+            self.assertRedirects(response, reverse('groups:detail', args=[group.invite_code]), fetch_redirect_response=False)
+
+    def test_detail(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(guest)
+            response = self.benchmark('groups:detail', size, 'get', reverse('groups:detail', args=[group.invite_code]))
+            self.assertEqual(response.status_code, 200)
+            response = self.benchmark(
+                'groups:detail unmatched', size, 'get', reverse('groups:detail', args=[group.invite_code]),
+                setup=self.reopen(group),
+            )
+            self.assertEqual(response.status_code, 200)
+            # Served from the fragment cache an earlier request filled
+            url = reverse('groups:detail', args=[group.invite_code])
+            response = self.benchmark('groups:detail cached', size, 'get', url, setup=partial(self.client.get, url))
+            self.assertEqual(response.status_code, 200)
+
+    def test_run_matching(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(host)
+            response = self.benchmark(
+                'groups:run_matching', size, 'post', reverse('groups:run_matching', args=[group.invite_code]),
+                setup=self.reopen(group),
+            )
+            self.assertEqual(response.status_code, 302)
+
+    def test_matching_status(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(guest)
+            response = self.benchmark('groups:matching_status', size, 'get', reverse('groups:matching_status', args=[group.invite_code]))
+            self.assertEqual(response.status_code, 200)
+
+    def test_export(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(host)
+            response = self.benchmark('groups:export', size, 'get', reverse('groups:export', args=[group.invite_code]))
+            self.assertGreater(response.streamed_bytes, 0)
+
+    def test_my_match(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(guest)
+            response = self.benchmark('groups:my_match', size, 'get', reverse('groups:my_match', args=[group.invite_code]))
+            self.assertEqual(response.status_code, 200)
+
+    def test_edit_wishlist(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(guest)
+            url = reverse('groups:edit_wishlist', args=[group.invite_code])
+            self.benchmark('groups:edit_wishlist GET', size, 'get', url)
+            response = self.benchmark('groups:edit_wishlist POST', size, 'post', url, {'wishlist': 'Scarf'})
+            self.assertEqual(response.status_code, 302)
+
+    def test_leave(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(guest)
+            response = self.benchmark(
+                'groups:leave', size, 'post', reverse('groups:leave', args=[group.invite_code]),
+                setup=self.reopen(group),
+            )
+            self.assertRedirects(response, reverse('groups:my_groups'), fetch_redirect_response=False)
+
+    def test_api_detail(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(guest)
+            response = self.benchmark('api:group-detail', size, 'get', reverse('api:group-detail', args=[group.invite_code]))
+            self.assertEqual(response.status_code, 200)
+
+    def test_api_members(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(guest)
+            response = self.benchmark('api:group-members', size, 'get', reverse('api:group-members', args=[group.invite_code]))
+            self.assertEqual(response.status_code, 200)
+
+    def test_delete(self):
+        for size, group, host, guest in self.each_group():
+            self.client.force_login(host)
+            response = self.benchmark(
+                'groups:delete', size, 'post', reverse('groups:delete', args=[group.invite_code]),
+                setup=self.reopen(group),
+            )
+            self.assertRedirects(response, reverse('groups:my_groups'), fetch_redirect_response=False)
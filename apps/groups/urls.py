@@ -12,6 +12,9 @@ urlpatterns = [
     # Group-specific pages (using invite_code for cleaner URLs)
     path('<str:invite_code>/', views.group_detail, name='detail'),
     path('<str:invite_code>/match/', views.run_matching, name='run_matching'),
+    path('<str:invite_code>/match/status/', views.matching_status, name='matching_status'),
+    path('<str:invite_code>/events/', views.group_events, name='events'),
+    path('<str:invite_code>/export/', views.export_matches, name='export'),
     path('<str:invite_code>/my-match/', views.my_match, name='my_match'),
     path('<str:invite_code>/wishlist/', views.edit_wishlist, name='edit_wishlist'),
     path('<str:invite_code>/leave/', views.leave_group, name='leave'),
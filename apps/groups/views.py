@@ -1,12 +1,43 @@
+import asyncio
+from functools import partial
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db import IntegrityError
-from django.http import Http404
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.handlers.asgi import ASGIRequest
+from django.db import IntegrityError, transaction
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from config.db_routers import read_replica
+from . import events, wishlists
+from .caching import (
+    FRAGMENT_TIMEOUT, PARTICIPANTS_SHOWN, agroup_header, agroup_id_for, agroup_version, agroup_versions,
+    aparticipant_list, ais_member, group_header, group_id_for, is_member,
+)
 from .models import Group, Member, Match
+from .exports import FORMATS as EXPORT_FORMATS, stream_export
 from .forms import GroupCreateForm, JoinGroupForm, WishlistForm
-from .matcher import SecretSantaMatcher
-# from .tasks import send_all_match_notifications  # Uncomment when Celery is set up
+from .listings import agroups_page, parse_cursor, user_groups
+from .membership import add_member, remove_member, set_wishlist
+from .tasks import awith_receiver_wishlist, claim_matching_job, run_matching_job
+
+async def _auser(request):
+    """The signed-in user, also set on the request so templates never load it synchronously"""
+    request.user = await request.auser()
+    return request.user
+
+def _group_or_404(invite_code):
+    """The cached header of the group a /groups/<invite_code>/ page is about"""
+    group = group_header(invite_code)
+    if group is None:
+        raise Http404("No group with this invite code")
+    return group
+
+async def _agroup_or_404(invite_code):
+    group = await agroup_header(invite_code)
+    if group is None:
+        raise Http404("No group with this invite code")
+    return group
 
 @login_required
 def create_group(request):
@@ -16,6 +47,7 @@ def create_group(request):
         if form.is_valid():
             group = form.save(commit=False)
             group.host = request.user
+            group.member_count = 1  # the host, added below
             group.save()
             
             # Auto-join creator as member
@@ -41,58 +73,77 @@ def join_group(request, invite_code=None):
         form = JoinGroupForm(request.POST)
         if form.is_valid():
             code = form.cleaned_data['invite_code'].upper().strip()
-            try:
-                group = Group.objects.get(invite_code=code)
-                
-                if group.matching_done:
-                    messages.error(request, '🚫 This group has already done their Secret Santa matching. You cannot join.')
+            group_id = group_id_for(code)
+            if group_id is None:
+                messages.error(request, '❌ Invalid invite code. Please check and try again.')
+            
+            # Check if already a member
+            elif is_member(group_id, request.user.id):
+                group = group_header(code)
+                messages.info(request, f'You are already a member of "{group.name}"!')
+                return redirect('groups:detail', invite_code=group.invite_code)
+            
+            else:
+                # Whether they are spliced into the matches is decided on the current row
+                group = Group.objects.get(id=group_id)
+                try:
+                    add_member(group, request.user)
+                except ValueError as e:
+                    messages.error(request, f'🚫 You cannot join this group after matching: {e}')
                     return redirect('groups:join')
-                
-                # Check if already a member
-                if Member.objects.filter(group=group, user=request.user).exists():
-                    messages.info(request, f'You are already a member of "{group.name}"!')
-                    return redirect('groups:detail', invite_code=group.invite_code)
-                
-                Member.objects.create(group=group, user=request.user)
                 messages.success(request, f'🎄 Welcome! You joined "{group.name}"!')
                 return redirect('groups:detail', invite_code=group.invite_code)
-            
-            except Group.DoesNotExist:
-                messages.error(request, '❌ Invalid invite code. Please check and try again.')
     else:
         form = JoinGroupForm(initial=initial)
     
     return render(request, 'groups/join.html', {'form': form})
 
 @login_required
-def group_detail(request, invite_code):
+@read_replica
+async def group_detail(request, invite_code):
     """View group details - 'Santa's Workshop' page"""
-    group = get_object_or_404(Group, invite_code=invite_code)
+    user = await _auser(request)
+    group = await _agroup_or_404(invite_code)
     
     # Check membership
-    try:
-        user_member = Member.objects.get(group=group, user=request.user)
-    except Member.DoesNotExist:
+    if not await ais_member(group.id, user.id):
         messages.error(request, 'You need to join this group first!')
-        return redirect('groups:join', invite_code=invite_code)
+        return redirect('groups:join_with_code', invite_code=invite_code)
+    
+    user_member = Member(group=group, user=user)
     
-    members = group.members.select_related('user').all()
+    # Latest background matching run, to show progress or a failure
+    async def latest_job():
+        return None if group.matching_done else await group.matching_jobs.order_by('-id').afirst()
     
-    # Check if user has a match
-    match = Match.objects.filter(group=group, giver=request.user).first()
+    async def wishlist_items():
+        return [item async for item in wishlists.items_of(user_member)]
     
-    # Count members with wishlists
-    wishlist_count = members.exclude(wishlist='').exclude(wishlist__isnull=True).count()
+    # The participant list and its rendered fragment are cached under the same version;
+    # the list is only loaded when the fragment has to be rendered again
+    version = await agroup_version(group.id)
+    participants_html = await cache.aget(make_template_fragment_key('participants', [group.id, version]))
+    
+    async def participants():
+        return None if participants_html is not None else await aparticipant_list(group, version)
+    
+    members, matching_job, user_wishlist = await asyncio.gather(participants(), latest_job(), wishlist_items())
     
     context = {
         'group': group,
         'members': members,
+        'participants_html': participants_html,
+        'group_version': version,
+        'fragment_timeout': FRAGMENT_TIMEOUT,
+        'participants_shown': PARTICIPANTS_SHOWN,
         'user_member': user_member,
-        'match': match,
-        'is_host': group.host == request.user,
-        'member_count': members.count(),
-        'wishlist_count': wishlist_count,
-        'ready_to_match': members.count() >= 2 and not group.matching_done,
+        'user_wishlist': user_wishlist,
+        'matching_job': matching_job,
+        'is_host': group.host_id == user.id,
+        'member_count': group.member_count,
+        'wishlist_count': group.wishlist_count,
+        'ready_to_match': group.member_count >= 2 and not group.matching_done,
+        'live_events': events.enabled(),
     }
     
     return render(request, 'groups/detail.html', context)
@@ -100,7 +151,7 @@ def group_detail(request, invite_code):
 @login_required
 def run_matching(request, invite_code):
     """Run the Secret Santa matching algorithm - Host only"""
-    group = get_object_or_404(Group, invite_code=invite_code)
+    group = _group_or_404(invite_code)
     
     if request.method != 'POST':
         return redirect('groups:detail', invite_code=invite_code)
@@ -109,93 +160,171 @@ def run_matching(request, invite_code):
         messages.error(request, '🚫 Only the group host can run the matching!')
         return redirect('groups:detail', invite_code=invite_code)
     
+    # Decided on the current row, not the cached header
+    group.refresh_from_db()
+    
     if group.matching_done:
         messages.warning(request, 'Matching has already been done for this group.')
         return redirect('groups:detail', invite_code=invite_code)
     
-    member_count = group.members.count()
+    member_count = group.member_count
     if member_count < 2:
         messages.error(request, f'❌ Need at least 2 participants. Currently have {member_count}.')
         return redirect('groups:detail', invite_code=invite_code)
     
-    try:
-        matcher = SecretSantaMatcher(group)
-        matches = matcher.create_matches()
-        
-        # TODO: Uncomment when Celery is configured
-        # send_all_match_notifications.delay(group.id)
-        
-        messages.success(
-            request, 
-            f'🎅 Ho ho ho! Matching complete! {len(matches)} Secret Santas have been assigned. '
-            f'Everyone can now view their match!'
-        )
+    job = claim_matching_job(group.id, total=member_count)
+    if job is None:
+        messages.info(request, '⏳ Matching is already in progress.')
         return redirect('groups:detail', invite_code=invite_code)
     
-    except Exception as e:
-        messages.error(request, f'❌ Error during matching: {str(e)}')
+    # Run the matcher in the background so large groups don't block the request
+    transaction.on_commit(partial(run_matching_job.delay, job.id))
+    
+    messages.info(
+        request,
+        f'🎅 Ho ho ho! Matching {member_count} Secret Santas... '
+        f'This page will update as soon as everyone has been assigned.'
+    )
+    return redirect('groups:detail', invite_code=invite_code)
+
+@login_required
+def matching_status(request, invite_code):
+    """Progress of the latest matching run as JSON - polled by the group page"""
+    group = _group_or_404(invite_code)
+    
+    if not is_member(group.id, request.user.id):
+        raise Http404("You are not a member of this group")
+    
+    job = group.matching_jobs.order_by('-id').first()
+    if job is None:
+        return JsonResponse({'status': None, 'matching_done': group.matching_done})
+    
+    return JsonResponse({
+        'status': job.status,
+        'progress': job.live_progress,
+        'total': job.total,
+        'error': job.error,
+        'matching_done': group.matching_done,
+    })
+
+@login_required
+async def group_events(request, invite_code):
+    """Live joins, leaves, wishlist changes and matching progress as Server-Sent Events"""
+    user = await request.auser()
+    group_id = await agroup_id_for(invite_code)
+    
+    if group_id is None or not await ais_member(group_id, user.id):
+        raise Http404("You are not a member of this group")
+    
+    # A WSGI worker would sit on the stream for its whole life, so only ASGI serves it
+    if not events.enabled() or not isinstance(request, ASGIRequest):
+        # 204 tells EventSource not to reconnect; the page polls instead
+        return HttpResponse(status=204)
+    
+    async def snapshot():
+        group = await Group.objects.only('member_count', 'wishlist_count', 'matching_done').aget(id=group_id)
+        return {'matching_done': group.matching_done, **events.counts(group)}
+    
+    response = StreamingHttpResponse(events.stream(group_id, snapshot), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+def export_matches(request, invite_code):
+    """Download every match with wishlists and notification status - Host only"""
+    group = _group_or_404(invite_code)
+    
+    if group.host != request.user:
+        messages.error(request, '🚫 Only the group host can export the matches!')
+        return redirect('groups:detail', invite_code=invite_code)
+    
+    if not group.matching_done:
+        messages.info(request, '⏳ There is nothing to export until the matching has been done.')
         return redirect('groups:detail', invite_code=invite_code)
+    
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'csv'
+    
+    # Rows are generated while the response is sent, never held in memory
+    response = StreamingHttpResponse(stream_export(group, fmt), content_type=EXPORT_FORMATS[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{group.invite_code}-matches.{fmt}"'
+    return response
 
 @login_required
-def my_match(request, invite_code):
+@read_replica
+async def my_match(request, invite_code):
     """View your Secret Santa assignment - 'Your Secret Mission' page"""
-    group = get_object_or_404(Group, invite_code=invite_code)
+    user = await _auser(request)
+    group = await _agroup_or_404(invite_code)
+    
+    # Membership and the match don't depend on each other, so look both up at once
+    member, matches = await asyncio.gather(
+        ais_member(group.id, user.id),
+        awith_receiver_wishlist(Match.objects.filter(group=group, giver=user)),
+    )
     
     # Verify membership
-    if not Member.objects.filter(group=group, user=request.user).exists():
+    if not member:
         raise Http404("You are not a member of this group")
     
-    try:
-        match = Match.objects.select_related('receiver').get(group=group, giver=request.user)
-        receiver_member = Member.objects.get(group=group, user=match.receiver)
-        
-        context = {
-            'group': group,
-            'match': match,
-            'receiver': match.receiver,
-            'receiver_member': receiver_member,
-        }
-        
-        return render(request, 'groups/my_match.html', context)
-    
-    except Match.DoesNotExist:
+    if not matches:
         messages.info(request, '⏳ Matching hasn\'t been done yet. Ask your host to run the matching!')
         return redirect('groups:detail', invite_code=invite_code)
+    
+    match = matches[0]
+    context = {
+        'group': group,
+        'match': match,
+        'receiver': match.receiver,
+        'receiver_wishlist': match.receiver_wishlist,
+    }
+    
+    return render(request, 'groups/my_match.html', context)
 
 @login_required
 def edit_wishlist(request, invite_code):
     """Edit your gift wishlist"""
-    group = get_object_or_404(Group, invite_code=invite_code)
+    group = _group_or_404(invite_code)
     member = get_object_or_404(Member, group=group, user=request.user)
     
     if request.method == 'POST':
-        form = WishlistForm(request.POST, instance=member)
+        form = WishlistForm(request.POST)
         if form.is_valid():
-            form.save()
+            set_wishlist(group, member, form.cleaned_data['wishlist'])
             messages.success(request, '✅ Your wishlist has been saved! Your Secret Santa will appreciate the hints!')
             return redirect('groups:detail', invite_code=invite_code)
     else:
-        form = WishlistForm(instance=member)
+        form = WishlistForm(initial={'wishlist': wishlists.as_text(wishlists.items_of(member))})
     
     return render(request, 'groups/edit_wishlist.html', {'form': form, 'group': group})
 
 @login_required
-def my_groups(request):
+@read_replica
+async def my_groups(request):
     """View all groups the user is part of - 'My Santa Groups' page"""
-    memberships = request.user.memberships.select_related('group', 'group__host').all()
-    hosted_groups = request.user.hosted_groups.prefetch_related('members').all()
+    user = await _auser(request)
+    groups, next_cursor = await agroups_page(user_groups(user), after=parse_cursor(request.GET.get('after')))
+    
+    # Each card is a fragment cached per group version
+    versions = await agroup_versions([group.id for group in groups])
+    for group in groups:
+        group.version = versions[group.id]
     
     context = {
-        'memberships': memberships,
-        'hosted_groups': hosted_groups,
-        'total_count': memberships.count(),
+        'groups': groups,
+        'fragment_timeout': FRAGMENT_TIMEOUT,
+        'participants_shown': PARTICIPANTS_SHOWN,
+        'next_cursor': next_cursor,
+        'is_first_page': 'after' not in request.GET,
     }
     return render(request, 'groups/my_groups.html', context)
 
 @login_required
 def leave_group(request, invite_code):
-    """Leave a group (cannot leave if matching is done or if you're the host)"""
-    group = get_object_or_404(Group, invite_code=invite_code)
+    """Leave a group (the host cannot leave)"""
+    group = _group_or_404(invite_code)
     
     if request.method != 'POST':
         return redirect('groups:detail', invite_code=invite_code)
@@ -204,22 +333,25 @@ def leave_group(request, invite_code):
         messages.error(request, '🚫 As the host, you cannot leave. You can delete the group instead.')
         return redirect('groups:detail', invite_code=invite_code)
     
-    if group.matching_done:
-        messages.error(request, '🚫 Cannot leave after matching has been done. Someone is counting on you!')
-        return redirect('groups:detail', invite_code=invite_code)
+    # Whether the matches need rewiring is decided on the current row
+    group.refresh_from_db()
     
     try:
         member = Member.objects.get(group=group, user=request.user)
-        member.delete()
-        messages.success(request, f'You have left "{group.name}".')
-        return redirect('groups:my_groups')
+        remove_member(group, member)
+    except ValueError as e:
+        messages.error(request, f'🚫 You cannot leave after matching: {e}')
+        return redirect('groups:detail', invite_code=invite_code)
     except Member.DoesNotExist:
         return redirect('home')
+    else:
+        messages.success(request, f'You have left "{group.name}".')
+        return redirect('groups:my_groups')
 
 @login_required  
 def delete_group(request, invite_code):
     """Delete a group - Host only, before matching"""
-    group = get_object_or_404(Group, invite_code=invite_code)
+    group = _group_or_404(invite_code)
     
     if request.method != 'POST':
         return redirect('groups:detail', invite_code=invite_code)
@@ -228,6 +360,8 @@ def delete_group(request, invite_code):
         messages.error(request, '🚫 Only the host can delete this group.')
         return redirect('groups:detail', invite_code=invite_code)
     
+    group.refresh_from_db()
+    
     if group.matching_done:
         messages.error(request, '🚫 Cannot delete a group after matching. People are expecting gifts!')
         return redirect('groups:detail', invite_code=invite_code)
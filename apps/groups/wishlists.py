@@ -0,0 +1,134 @@
+"""Wishlists as structured items, and searching them.
+
+A wishlist is written as text, one gift idea per line, optionally followed
+by a price hint and a link separated by ``|``:
+
+    Cozy blanket | about $40 | https://example.com/blanket
+    Any book by Ursula K. Le Guin
+
+and stored as one WishlistItem per line, so pages and emails read a few
+short rows instead of a text blob. Item names are indexed for full-text
+search: a GIN index on PostgreSQL, an FTS5 table kept in step by triggers
+on SQLite (both created by migration 0008).
+"""
+import re
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef
+from django.db.models.expressions import RawSQL
+from .models import WishlistItem
+
+MAX_ITEMS = 20
+
+# Search results returned at most
+SEARCH_LIMIT = 50
+
+# Text search configuration of the PostgreSQL index; queries must use the same one
+SEARCH_CONFIG = 'english'
+
+# SQLite FTS5 table mirroring WishlistItem.item
+FTS_TABLE = 'groups_wishlistitem_fts'
+
+_bullet = re.compile(r'^\s*(?:[-*•]|\d+[.)])\s+')
+_url = re.compile(r'https?://\S+')
+
+def parse(text):
+    """The items written in ``text``, as WishlistItem field dicts in order"""
+    items = []
+    for line in text.splitlines():
+        line = _bullet.sub('', line).strip()
+        if not line:
+            continue
+        item, *extras = [part.strip() for part in line.split('|')]
+        price_hint = link = ''
+        if not extras and (found := _url.search(item)):
+            # A bare link written into the line
+            link = found.group()
+            item = ' '.join(f'{item[:found.start()]} {item[found.end():]}'.split())
+        for extra in extras:
+            if _url.fullmatch(extra):
+                link = extra
+            elif extra:
+                price_hint = extra
+        items.append({'item': item or link, 'price_hint': price_hint, 'link': link})
+    return items
+
+def validate(items):
+    """Check parsed items against the field limits; raises ValidationError"""
+    if len(items) > MAX_ITEMS:
+        raise ValidationError(f'Add at most {MAX_ITEMS} gift ideas.')
+    errors = []
+    for number, item in enumerate(items, 1):
+        for field in ('item', 'price_hint', 'link'):
+            limit = WishlistItem._meta.get_field(field).max_length
+            if len(item[field]) > limit:
+                errors.append(f'Idea {number}: the {field.replace("_", " ")} is longer than {limit} characters.')
+        if item['link']:
+            try:
+                URLValidator()(item['link'])
+            except ValidationError:
+                errors.append(f'Idea {number}: {item["link"]} is not a valid link.')
+    if errors:
+        raise ValidationError(errors)
+    return items
+
+def as_text(items):
+    """Items written back as text, one per line; ``parse`` reads it again"""
+    return '\n'.join(line(item.item, item.price_hint, item.link) for item in items)
+
+def line(item, price_hint='', link=''):
+    return ' | '.join(part for part in (item, price_hint, link) if part)
+
+def items_of(member):
+    """A member's wishlist items, in order"""
+    return WishlistItem.objects.filter(group_id=member.group_id, user_id=member.user_id)
+
+def replace(member, items):
+    """Make ``items`` (field dicts) the member's whole wishlist; returns whether they had one before"""
+    # Joins the caller's transaction, if any; a failure leaves the old list either way
+    with transaction.atomic(savepoint=False):
+        deleted, _ = items_of(member).delete()
+        WishlistItem.objects.bulk_create(
+            WishlistItem(group_id=member.group_id, user_id=member.user_id, position=position, **item)
+            for position, item in enumerate(items)
+        )
+    return bool(deleted)
+
+def has_wishlist():
+    """Annotation for Member querysets: whether the member listed any ideas"""
+    return Exists(WishlistItem.objects.filter(group=OuterRef('group'), user=OuterRef('user')))
+
+def for_receivers(matches):
+    """Wishlist items of whoever ``matches`` (a Match queryset) buy for.
+
+    Matches spanning several groups can bring back a few items of a receiver
+    in another of those groups; callers pair items up by (group, user).
+    """
+    # Two indexed IN lookups; a correlated EXISTS per item would scan the table
+    return WishlistItem.objects.filter(
+        group_id__in=matches.values('group_id'), user_id__in=matches.values('receiver_id'),
+    )
+
+def search(group, query, limit=SEARCH_LIMIT):
+    """Items on ``group``'s wishlists matching every word of ``query``"""
+    items = WishlistItem.objects.filter(group=group).select_related('user')
+    if not query.split():
+        return items.none()
+    vendor = connections[items.db].vendor
+    if vendor == 'postgresql':
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+        # The same expression as the GIN index, so the index is used
+        document = SearchVector('item', config=SEARCH_CONFIG)
+        terms = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+        items = items.annotate(document=document, rank=SearchRank(document, terms))
+        items = items.filter(document=terms).order_by('-rank', 'id')
+    elif vendor == 'sqlite':
+        # Each word quoted, so FTS5 query syntax typed by users is searched for literally
+        terms = ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+        matching = RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [terms])
+        items = items.filter(id__in=matching)
+    else:
+        for word in query.split():
+            items = items.filter(item__icontains=word)
+    return items[:limit]
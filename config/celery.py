@@ -1,6 +1,9 @@
 import os
 from celery import Celery
 
+# Connects the task signals that record per-task metrics
+from . import metrics  # noqa: F401
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 app = Celery('secret_santa')
@@ -0,0 +1,347 @@
+"""Per-view and per-task metrics, exposed in the Prometheus text format.
+
+Every request (tagged with its URL name, e.g. ``groups:detail``) and every
+Celery task (tagged with its task name) records its total latency, database
+queries and query time, cache hits and misses and template render time.
+
+Samples are added up in memory and flushed to the shared cache every
+``METRICS_FLUSH_SECONDS``, so web and worker processes report into the same
+totals; ``metrics_view`` serves them to Prometheus, to holders of
+``METRICS_TOKEN`` and to ``METRICS_ALLOWED_IPS``. Durations are kept as
+integer microseconds in the cache and exposed in seconds. Queries slower
+than ``METRICS_SLOW_QUERY_MS`` are logged to ``config.metrics.slow_queries``.
+"""
+import hmac
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from urllib.parse import quote, unquote
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from celery.signals import task_postrun, task_prerun, worker_process_shutdown
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends import locmem, redis
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import Http404, HttpResponse
+from django.template.backends import django as django_backend
+
+slow_query_log = logging.getLogger('config.metrics.slow_queries')
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+SERIES_KEY = 'metrics:all-series'
+
+_current = ContextVar('metrics_sample', default=None)
+_missing = object()
+
+class Sample:
+    """What one request or task spent its time on"""
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_us = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.render_us = 0
+
+def _us(seconds):
+    return int(seconds * 1_000_000)
+
+def start(kind, name):
+    """Start recording a sample; returns the token to pass to ``finish``"""
+    for connection in connections.all(initialized_only=True):
+        _instrument(connection)
+    return _current.set(Sample(kind, name))
+
+def finish(token, outcome):
+    """Stop recording and add the sample to the totals"""
+    sample = _current.get()
+    _current.reset(token)
+    if sample is not None:
+        _totals.add(sample, outcome, time.perf_counter() - sample.started)
+
+class _Totals:
+    """Counters not yet flushed to the cache, keyed by series"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.flushed = time.monotonic()
+
+    def add(self, sample, outcome, elapsed):
+        kind, name = sample.kind, sample.name
+        series = {
+            (f'{kind}s_total', kind, name, outcome): 1,
+            (f'{kind}_duration_seconds_count', kind, name, ''): 1,
+            (f'{kind}_duration_seconds_sum', kind, name, ''): _us(elapsed),
+            (f'{kind}_db_queries_total', kind, name, ''): sample.queries,
+            (f'{kind}_db_duration_seconds_total', kind, name, ''): sample.query_us,
+            (f'{kind}_cache_hits_total', kind, name, ''): sample.cache_hits,
+            (f'{kind}_cache_misses_total', kind, name, ''): sample.cache_misses,
+            (f'{kind}_render_duration_seconds_total', kind, name, ''): sample.render_us,
+        }
+        # Cumulative buckets, as Prometheus expects
+        for bound in [*LATENCY_BUCKETS, '+Inf']:
+            if bound == '+Inf' or elapsed <= bound:
+                series[(f'{kind}_duration_seconds_bucket', kind, name, str(bound))] = 1
+        with self.lock:
+            for key, value in series.items():
+                self.counts[key] = self.counts.get(key, 0) + value
+        if time.monotonic() - self.flushed >= settings.METRICS_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            self.flushed = time.monotonic()
+        amounts = {_cache_key(series): value for series, value in counts.items() if value}
+        if amounts:
+            cache.add_totals(amounts)
+
+_totals = _Totals()
+
+def _cache_key(series):
+    return 'metrics:' + ':'.join(quote(part, safe='') for part in series)
+
+def _parse_key(key):
+    return tuple(unquote(part) for part in key.split(':')[1:])
+
+def flush():
+    _totals.flush()
+
+# Database
+
+def _record_query(execute, sql, params, many, context):
+    began = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - began
+        sample = _current.get()
+        if sample is not None:
+            sample.queries += 1
+            sample.query_us += _us(elapsed)
+        if settings.METRICS_SLOW_QUERY_MS and elapsed * 1000 >= settings.METRICS_SLOW_QUERY_MS:
+            slow_query_log.warning(
+                '%.1fms in %s: %s', elapsed * 1000, sample.name if sample else 'unknown', sql,
+            )
+
+def _instrument(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+connection_created.connect(_instrument, dispatch_uid='config.metrics')
+
+# Cache
+
+_series_lock = threading.Lock()
+
+class MeteredCacheMixin:
+    """Counts hits and misses of ``get`` and ``get_many`` (and their async forms).
+
+    Also stores the flushed totals: ``add_totals`` adds to the counters and
+    remembers their keys under SERIES_KEY, which ``series`` returns.
+    """
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _missing, version)
+        sample = _current.get()
+        if sample is not None:
+            if value is _missing:
+                sample.cache_misses += 1
+            else:
+                sample.cache_hits += 1
+        return default if value is _missing else value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = super().get_many(keys, version)
+        sample = _current.get()
+        if sample is not None:
+            sample.cache_hits += len(values)
+            sample.cache_misses += len(keys) - len(values)
+        return values
+
+    def add_totals(self, amounts):
+        # Only this process shares a local-memory cache, so a lock makes it atomic
+        with _series_lock:
+            for key, value in amounts.items():
+                try:
+                    self.incr(key, value)
+                except ValueError:
+                    self.set(key, value, None)
+            known = self.series()
+            if not known.issuperset(amounts):
+                self.set(SERIES_KEY, known | set(amounts), None)
+
+    def series(self):
+        return self.get(SERIES_KEY) or set()
+
+class LocMemCache(MeteredCacheMixin, locmem.LocMemCache):
+    pass
+
+class RedisCache(MeteredCacheMixin, redis.RedisCache):
+    def add_totals(self, amounts):
+        # One round trip; INCRBY starts missing counters at zero and SADD adds to the set atomically
+        with self._cache.get_client(write=True).pipeline(transaction=False) as pipe:
+            for key, value in amounts.items():
+                pipe.incrby(self.make_and_validate_key(key), value)
+            pipe.sadd(self.make_and_validate_key(SERIES_KEY), *amounts)
+            pipe.execute()
+
+    def series(self):
+        members = self._cache.get_client().smembers(self.make_and_validate_key(SERIES_KEY))
+        return {member.decode() for member in members}
+
+# Templates
+
+class Template(django_backend.Template):
+    def render(self, context=None, request=None):
+        began = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            sample = _current.get()
+            if sample is not None:
+                sample.render_us += _us(time.perf_counter() - began)
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The Django template backend, timing each top-level render"""
+
+    def from_string(self, template_code):
+        return Template(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return Template(template.template, self)
+
+# Requests
+
+class MetricsMiddleware:
+    """Record a sample for every request, tagged with its URL name"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = start('request', '')
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            self.record(token, request, response)
+
+    async def __acall__(self, request):
+        token = start('request', '')
+        response = None
+        try:
+            response = await self.get_response(request)
+            return response
+        finally:
+            self.record(token, request, response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Named as soon as the URL resolves, so the slow-query log can say which view ran a query
+        _current.get().name = request.resolver_match.view_name
+
+    def record(self, token, request, response):
+        sample = _current.get()
+        if not sample.name:
+            sample.name = 'unmatched'
+        status = f'{response.status_code // 100}xx' if response is not None else '5xx'
+        finish(token, status)
+
+# Celery tasks
+
+_task_tokens = {}
+
+@task_prerun.connect(dispatch_uid='config.metrics')
+def _task_started(task_id=None, task=None, **kwargs):
+    _task_tokens[task_id] = start('task', task.name)
+
+@task_postrun.connect(dispatch_uid='config.metrics')
+def _task_finished(task_id=None, state=None, **kwargs):
+    token = _task_tokens.pop(task_id, None)
+    if token is not None:
+        finish(token, state or 'UNKNOWN')
+
+@worker_process_shutdown.connect(dispatch_uid='config.metrics')
+def _worker_stopping(**kwargs):
+    flush()
+
+# Exposition
+
+# Label names per kind: (the name's label, the outcome's label)
+LABELS = {'request': ('view', 'status'), 'task': ('task', 'state')}
+
+def render_prometheus():
+    """All flushed totals as Prometheus text"""
+    keys = cache.series()
+    values = cache.get_many(sorted(keys))
+    series = {}
+    for key in keys:
+        metric, kind, name, extra = _parse_key(key)
+        series[metric, kind, name, extra] = values.get(key, 0)
+    # A bucket nothing has fallen into yet was never stored
+    for metric, kind, name, extra in list(series):
+        if metric.endswith('_bucket'):
+            for bound in [*LATENCY_BUCKETS, '+Inf']:
+                series.setdefault((metric, kind, name, str(bound)), 0)
+
+    families = {}
+    for (metric, kind, name, extra), value in sorted(series.items(), key=_sort_key):
+        # Durations are stored in microseconds; bucket and count values are plain counts
+        if metric.endswith(('_seconds_sum', '_seconds_total')):
+            value = value / 1_000_000
+        name_label, outcome_label = LABELS[kind]
+        labels = f'{name_label}="{_escape(name)}"'
+        if metric.endswith('_bucket'):
+            labels += f',le="{extra}"'
+        elif extra:
+            labels += f',{outcome_label}="{_escape(extra)}"'
+        family = metric.removesuffix('_bucket').removesuffix('_count').removesuffix('_sum')
+        families.setdefault(family, []).append(f'santa_{metric}{{{labels}}} {value}')
+
+    lines = []
+    for family, samples in families.items():
+        kind = 'histogram' if family.endswith('_duration_seconds') else 'counter'
+        lines.append(f'# TYPE santa_{family} {kind}')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+def _sort_key(item):
+    (metric, kind, name, extra), _ = item
+    family = metric.removesuffix('_bucket').removesuffix('_count').removesuffix('_sum')
+    # Buckets in ascending order, then _count and _sum, per view or task
+    bound = float(extra) if metric.endswith('_bucket') else 0
+    return family, name, not metric.endswith('_bucket'), metric, bound, extra
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _may_scrape(request):
+    if settings.METRICS_TOKEN:
+        expected = f'Bearer {settings.METRICS_TOKEN}'.encode()
+        if hmac.compare_digest(request.headers.get('Authorization', '').encode(), expected):
+            return True
+    return request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+
+def metrics_view(request):
+    """Prometheus scrape endpoint, only answered with METRICS_TOKEN or for METRICS_ALLOWED_IPS"""
+    if not _may_scrape(request):
+        raise Http404
+    flush()
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
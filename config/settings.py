@@ -10,11 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 import sys
+from importlib.util import find_spec
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
-from decouple import config
+from decouple import Csv, config
+from django.core.exceptions import ImproperlyConfigured
 
 sys.path.insert(0, str(BASE_DIR / 'apps'))
 
@@ -39,6 +41,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'rest_framework',
     'accounts',
     'groups',
 ]
@@ -46,6 +49,8 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'accounts.User'
 
 MIDDLEWARE = [
+    # First, so its latency covers every other middleware
+    'config.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -59,7 +64,8 @@ ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing renders for config.metrics
+        'BACKEND': 'config.metrics.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -78,12 +84,84 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# PostgreSQL is used when DB_HOST is set, SQLite otherwise.
+
+if config('DB_HOST', default=''):
+    _postgres = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': config('DB_NAME', default='santa_matcher'),
+        'USER': config('DB_USER', default='postgres'),
+        'PASSWORD': config('DB_PASSWORD', default=''),
+        'HOST': config('DB_HOST'),
+        'PORT': config('DB_PORT', default='5432'),
+        # Keep connections open between requests instead of reconnecting each time
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {},
     }
-}
+
+    # Server-side connection pool; requires psycopg 3 (pip install "psycopg[pool]")
+    # and replaces persistent connections.
+    if config('DB_POOL', default=False, cast=bool):
+        # Fail at startup instead of on the first query
+        if find_spec('psycopg') is None or find_spec('psycopg_pool') is None:
+            raise ImproperlyConfigured('DB_POOL requires psycopg 3 with its pool: pip install "psycopg[pool]"')
+        _postgres['CONN_MAX_AGE'] = 0
+        _postgres['OPTIONS']['pool'] = {
+            'min_size': config('DB_POOL_MIN_SIZE', default=2, cast=int),
+            'max_size': config('DB_POOL_MAX_SIZE', default=10, cast=int),
+            'timeout': config('DB_POOL_TIMEOUT', default=10, cast=int),
+        }
+
+    DATABASES = {'default': _postgres}
+
+    # Optional read replica for views decorated with config.db_routers.read_replica
+    if config('DB_REPLICA_HOST', default=''):
+        DATABASES['replica'] = {
+            **_postgres,
+            'OPTIONS': dict(_postgres['OPTIONS']),
+            'HOST': config('DB_REPLICA_HOST'),
+            'PORT': config('DB_REPLICA_PORT', default=_postgres['PORT']),
+            'TEST': {'MIRROR': 'default'},
+        }
+        DATABASE_ROUTERS = ['config.db_routers.ReplicaRouter']
+        MIDDLEWARE.append('config.db_routers.PinPrimaryAfterWriteMiddleware')
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+REDIS_URL = config('REDIS_URL', default='')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'config.metrics.RedisCache',
+            'LOCATION': REDIS_URL,
+            'KEY_PREFIX': config('CACHE_KEY_PREFIX', default='santa'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'config.metrics.LocMemCache',
+            'KEY_PREFIX': config('CACHE_KEY_PREFIX', default='santa'),
+        }
+    }
+
+# Redis for live group events (pub/sub); leave empty to have pages poll instead
+EVENTS_REDIS_URL = config('EVENTS_REDIS_URL', default=REDIS_URL)
+EVENTS_CHANNEL_PREFIX = config('CACHE_KEY_PREFIX', default='santa')
+
+# Sessions are read from the cache and only written through to the database
+SESSION_ENGINE = config('SESSION_ENGINE', default='django.contrib.sessions.backends.cached_db')
 
 
 # Password validation
@@ -126,3 +204,52 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Celery
+# https://docs.celeryq.dev/en/stable/django/first-steps-with-django.html
+
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default=REDIS_URL or 'redis://localhost:6379/0')
+
+# Needed for chords (bulk matching waits for every group before notifying)
+CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default=CELERY_BROKER_URL)
+
+# Run tasks inline (no worker needed) for local development
+CELERY_TASK_ALWAYS_EAGER = config('CELERY_TASK_ALWAYS_EAGER', default=False, cast=bool)
+
+# Notification delivery limits per recipient domain: (messages per second, burst)
+NOTIFICATION_RATE_LIMITS = {
+    'default': (config('NOTIFICATION_RATE', default=10, cast=float), config('NOTIFICATION_BURST', default=50, cast=int)),
+}
+
+
+# REST API
+# https://www.django-rest-framework.org/api-guide/settings/
+
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+    'DEFAULT_PERMISSION_CLASSES': [
+        'rest_framework.permissions.IsAuthenticated',
+    ],
+}
+
+
+# Metrics
+# Scraped from /metrics in the Prometheus text format, see config/metrics.py
+
+# How often each process adds its totals to the shared cache
+METRICS_FLUSH_SECONDS = config('METRICS_FLUSH_SECONDS', default=10, cast=float)
+
+# Log queries slower than this many milliseconds (0 = off)
+METRICS_SLOW_QUERY_MS = config('METRICS_SLOW_QUERY_MS', default=0, cast=float)
+
+# Scrapers send "Authorization: Bearer <token>" (empty = no token accepted)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# Addresses allowed to scrape /metrics without the token. This is checked
+# against REMOTE_ADDR, which behind a reverse proxy is the proxy's address for
+# every visitor; only list addresses here when the app is reached directly.
+METRICS_ALLOWED_IPS = config('METRICS_ALLOWED_IPS', default='', cast=Csv())
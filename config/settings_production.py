@@ -0,0 +1,48 @@
+"""
+Production settings for santa_matcher.
+
+Select with DJANGO_SETTINGS_MODULE=config.settings_production. Everything in
+config.settings still applies and is configured from the environment the
+same way; this profile only changes what must differ from development.
+
+https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
+"""
+from decouple import Csv, config
+from django.core.exceptions import ImproperlyConfigured
+
+from .settings import *  # noqa: F401,F403
+from .settings import REDIS_URL, TEMPLATES
+
+DEBUG = False
+
+ALLOWED_HOSTS = config('ALLOWED_HOSTS', cast=Csv())
+
+CSRF_TRUSTED_ORIGINS = config('CSRF_TRUSTED_ORIGINS', default='', cast=Csv())
+
+SESSION_COOKIE_SECURE = config('SESSION_COOKIE_SECURE', default=True, cast=bool)
+CSRF_COOKIE_SECURE = config('CSRF_COOKIE_SECURE', default=True, cast=bool)
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/#redis
+
+# Group versions, membership flags, invite codes and delivery claims live in
+# the cache and must be the same for every worker process. The local-memory
+# fallback keeps one copy per process, so a bump in one never reaches the rest.
+if not REDIS_URL:
+    raise ImproperlyConfigured("REDIS_URL must be set in production: the cache has to be shared by all workers")
+
+
+# Templates
+# https://docs.djangoproject.com/en/5.2/ref/templates/api/#django.template.loaders.cached.Loader
+
+# Each template is read and compiled once per process, then reused. Django
+# already does this when no loaders are listed; listing them keeps it that
+# way if another loader is ever added.
+TEMPLATES[0]['APP_DIRS'] = False
+TEMPLATES[0]['OPTIONS']['loaders'] = [
+    ('django.template.loaders.cached.Loader', [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]),
+]
@@ -1,10 +1,13 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView
+from config.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', TemplateView.as_view(template_name='home.html'), name='home'),
     path('accounts/', include('accounts.urls')),
     path('groups/', include('groups.urls')),
+    path('api/', include('groups.api_urls')),
+    path('metrics', metrics_view, name='metrics'),
 ]